@@ -0,0 +1,83 @@
+"""
+Minimal in-process metrics registry with Prometheus text output.
+
+Counters and gauges are kept per worker process. Collectors are callables
+evaluated on every scrape, for values that are cheaper to compute on demand
+or that are shared between processes (e.g. file-lock occupancy).
+"""
+import hmac
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._values = defaultdict(float)
+        self._types = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'counter')
+            self._values[self._key(name, labels)] += amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'gauge')
+            self._values[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def register_collector(self, name, collector, metric_type='gauge'):
+        """
+        collector() возвращает пары (labels, value) на момент опроса.
+        """
+        with self._lock:
+            self._types[name] = metric_type
+            self._collectors.append((name, collector))
+
+    def samples(self):
+        with self._lock:
+            samples = [(name, dict(labels), value) for (name, labels), value in self._values.items()]
+            collectors = list(self._collectors)
+        for name, collector in collectors:
+            samples.extend((name, labels, value) for labels, value in collector())
+        return samples
+
+    def render(self):
+        lines = []
+        seen = set()
+        for name, labels, value in sorted(self.samples(), key=lambda sample: (sample[0], sorted(sample[1].items()))):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# TYPE {name} {self._types.get(name, "untyped")}')
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in sorted(labels.items()))
+            lines.append(f'{name}{{{label_text}}} {value:g}' if label_text else f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+metrics = MetricsRegistry()
+
+
+def metrics_view(request):
+    # Адрес клиента за локальным прокси всегда 127.0.0.1, поэтому доступ только по токену
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
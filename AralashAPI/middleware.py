@@ -0,0 +1,179 @@
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from AralashAPI.metrics import metrics
+from AralashAPI.resilience import request_deadline
+
+CRITICAL = 'critical'
+NORMAL = 'normal'
+LOW = 'low'
+PRIORITIES = (CRITICAL, NORMAL, LOW)
+
+
+def parse_request_start(value):
+    """
+    X-Request-Start от прокси: "t=<время>" в секундах, миллисекундах или микросекундах.
+    """
+    try:
+        started = float(value.strip().removeprefix('t='))
+    except (AttributeError, ValueError):
+        return None
+    if started > 1e14:
+        return started / 1e6
+    if started > 1e11:
+        return started / 1e3
+    return started
+
+
+def queue_delay(request, now):
+    """
+    Сколько запрос ждал в очереди (секунды) по X-Request-Start; None, если заголовку
+    не доверяем или значение неправдоподобно.
+    """
+    config = settings.LOAD_SHEDDING
+    if not config['TRUST_REQUEST_START']:
+        return None
+    request_start = parse_request_start(request.META.get('HTTP_X_REQUEST_START'))
+    if request_start is None:
+        return None
+    delay = now - request_start
+    if delay < 0 or delay * 1000 > config['MAX_DELAY_MS']:
+        return None
+    return delay
+
+
+class LoadShedder:
+    """
+    Per-process overload detector in the spirit of CoDel.
+
+    Queueing delay (from the proxy's X-Request-Start) is smoothed into one EWMA
+    over all admitted requests. Requests without the header carry no signal:
+    their latency is mostly service time (password hashing, SMTP), not queueing.
+    Once it stays above the target for a full interval, low-priority requests
+    are shed; above twice the target normal ones are shed too. Critical
+    requests are always admitted and keep the signal fresh; without traffic
+    the signal expires after one interval.
+    """
+
+    def __init__(self, target, interval, alpha):
+        self.target = target
+        self.interval = interval
+        self.alpha = alpha
+        self.inflight = dict.fromkeys(PRIORITIES, 0)
+        self.class_delay = dict.fromkeys(PRIORITIES, 0.0)
+        self.delay = 0.0
+        self._updated_at = None
+        self._above_since = None
+        self._lock = threading.Lock()
+
+    def observe(self, priority, delay, now):
+        with self._lock:
+            if self._updated_at is None or now - self._updated_at > self.interval:
+                self.delay = delay
+            else:
+                self.delay += self.alpha * (delay - self.delay)
+            self.class_delay[priority] += self.alpha * (delay - self.class_delay[priority])
+            self._updated_at = now
+
+    def level(self, now):
+        """
+        0 - норма, 1 - сбрасываем low, 2 - сбрасываем low и normal.
+        """
+        with self._lock:
+            if self._updated_at is None or now - self._updated_at > self.interval or self.delay <= self.target:
+                self._above_since = None
+                return 0
+            if self._above_since is None:
+                self._above_since = now
+            if now - self._above_since < self.interval:
+                return 0
+            return 2 if self.delay > 2 * self.target else 1
+
+    def admit(self, priority, now):
+        level = self.level(now)
+        if (priority == LOW and level >= 1) or (priority == NORMAL and level >= 2):
+            metrics.inc('http_shed_requests_total', priority=priority)
+            return False
+        with self._lock:
+            self.inflight[priority] += 1
+        return True
+
+    def finish(self, priority):
+        with self._lock:
+            self.inflight[priority] -= 1
+
+    def samples(self):
+        with self._lock:
+            return [({'priority': priority}, count) for priority, count in self.inflight.items()]
+
+    def delay_samples(self):
+        with self._lock:
+            return [({'priority': priority}, delay * 1000) for priority, delay in self.class_delay.items()]
+
+
+shedder = LoadShedder(
+    target=settings.LOAD_SHEDDING['TARGET_MS'] / 1000,
+    interval=settings.LOAD_SHEDDING['INTERVAL_MS'] / 1000,
+    alpha=settings.LOAD_SHEDDING['ALPHA'],
+)
+metrics.register_collector('http_inflight_requests', shedder.samples)
+metrics.register_collector('http_queue_delay_ms', shedder.delay_samples)
+
+
+def classify(url_name):
+    config = settings.LOAD_SHEDDING
+    if url_name in config['CRITICAL']:
+        return CRITICAL
+    if url_name in config['LOW']:
+        return LOW
+    return NORMAL
+
+
+class LoadSheddingMiddleware:
+    """
+    Классифицирует запросы по имени маршрута и при перегрузке отвечает 503
+    на низкоприоритетные, чтобы мерчантские эндпоинты сохраняли время ответа.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.load_shedding_priority = None
+        response = self.get_response(request)
+        if request.load_shedding_priority is not None:
+            shedder.finish(request.load_shedding_priority)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        now = time.time()
+        priority = classify(request.resolver_match.url_name)
+        delay = queue_delay(request, now)
+        if delay is not None:
+            shedder.observe(priority, delay, now)
+
+        if not shedder.admit(priority, now):
+            return JsonResponse(
+                {'error': 'Service is overloaded, please retry later.'},
+                status=503,
+                headers={'Retry-After': '1'},
+            )
+        request.load_shedding_priority = priority
+        return None
+
+
+class DeadlineMiddleware:
+    """
+    Задает бюджет времени на исходящие вызовы запроса (SMTP, Firebase),
+    см. AralashAPI.resilience.timeout_for.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_deadline(settings.RESILIENCE['REQUEST_BUDGET']):
+            return self.get_response(request)
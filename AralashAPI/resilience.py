@@ -0,0 +1,206 @@
+"""
+Failure isolation for outbound dependencies (SMTP, Firebase certificates,
+merchant callback hosts).
+
+Every call gets a timeout that is the smaller of the dependency's own
+timeout and what is left of the request's deadline budget, and goes through
+a circuit breaker. After FAILURE_THRESHOLD consecutive failures the breaker
+opens and calls fail immediately with DependencyUnavailable (503 with
+Retry-After in DRF views) instead of waiting on a dead host. After
+RESET_TIMEOUT one probe call is let through; its outcome closes or reopens
+the breaker.
+
+Breakers are per worker process. Their state and trip counts are exported
+by /metrics as circuit_breaker_state (0 closed, 1 half-open, 2 open) and
+circuit_breaker_trips_total.
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from AralashAPI.metrics import metrics
+
+
+class DependencyUnavailable(APIException):
+    status_code = 503
+    default_code = 'dependency_unavailable'
+
+    def __init__(self, dependency, retry_after=1):
+        super().__init__(f'{dependency} is temporarily unavailable, please retry later.')
+        self.dependency = dependency
+        self.retry_after = retry_after
+        # DRF добавляет Retry-After по атрибуту wait
+        self.wait = max(math.ceil(retry_after), 1)
+
+
+class CircuitOpenError(DependencyUnavailable):
+    pass
+
+
+class DeadlineExceeded(DependencyUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Можно ли сейчас обращаться к зависимости. В полуоткрытом состоянии
+        пропускается один пробный вызов, остальные получают отказ.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 1
+            return max(self.reset_timeout - (self.clock() - self._opened_at), 1)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+                self.trips += 1
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    @contextmanager
+    def guard(self, failures=(Exception,), ignore=()):
+        """
+        Выполняет блок через breaker. Исключения из failures считаются отказом
+        зависимости; ignore (например, отказ SMTP принять конкретный адрес) и
+        остальные исключения означают, что зависимость ответила.
+        """
+        self.check()
+        try:
+            yield
+        except ignore:
+            self.record_success()
+            raise
+        except failures:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.record_success()
+            raise
+        else:
+            self.record_success()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(dependency, key=None):
+    """
+    Breaker зависимости; key разделяет экземпляры, например хосты мерчантов.
+    """
+    name = dependency if key is None else f'{dependency}:{key}'
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                config = settings.RESILIENCE['DEPENDENCIES'][dependency]
+                breaker = _breakers[name] = CircuitBreaker(
+                    name, config['FAILURE_THRESHOLD'], config['RESET_TIMEOUT']
+                )
+    return breaker
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def _state_samples():
+    return [({'name': name}, CircuitBreaker.STATE_VALUES[breaker.state]) for name, breaker in list(_breakers.items())]
+
+
+def _trip_samples():
+    return [({'name': name}, breaker.trips) for name, breaker in list(_breakers.items())]
+
+
+metrics.register_collector('circuit_breaker_state', _state_samples)
+metrics.register_collector('circuit_breaker_trips_total', _trip_samples, metric_type='counter')
+
+
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+@contextmanager
+def request_deadline(budget):
+    """
+    Бюджет времени на исходящие вызовы в пределах одного запроса.
+    """
+    token = _deadline.set(time.monotonic() + budget)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def timeout_for(dependency, timeout=None):
+    """
+    Таймаут вызова: собственный таймаут зависимости, урезанный до остатка бюджета запроса.
+    Если бюджета не осталось, вызов не делается вовсе.
+    """
+    if timeout is None:
+        timeout = settings.RESILIENCE['DEPENDENCIES'][dependency]['TIMEOUT']
+    remaining = remaining_budget()
+    if remaining is None:
+        return timeout
+    if remaining < settings.RESILIENCE['MIN_TIMEOUT']:
+        metrics.inc('deadline_exceeded_total', dependency=dependency)
+        raise DeadlineExceeded(dependency)
+    return min(timeout, remaining)
@@ -13,8 +13,6 @@ from datetime import timedelta
 from pathlib import Path
 import environ
 import os
-import firebase_admin
-from firebase_admin import credentials
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -84,6 +82,8 @@ SILENCED_SYSTEM_CHECKS = ["security.W019"]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'AralashAPI.middleware.LoadSheddingMiddleware',
+    'AralashAPI.middleware.DeadlineMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -181,17 +181,185 @@ AUTH_USER_MODEL = 'user.User'
 LOGGING_DIR = os.path.join(BASE_DIR, 'logs')
 os.makedirs(LOGGING_DIR, exist_ok=True)
 
+# Кэш: по умолчанию память процесса, для нескольких воркеров задайте CACHE_URL (например redis://)
+# Без общего кэша поколения ключей мерчантов читаются из БД на каждый запрос (см. api.utils.get_key_generation)
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# Кэш проверенных auth_login/auth_secret для мерчантских эндпоинтов
+
+API_CREDENTIAL_CACHE = {
+    'TTL': 60,
+    'NEGATIVE_TTL': 5,
+    'MAX_SIZE': 10000,
+}
+
+# Учет месячных запросов мерчантов: 'atomic' - один UPSERT на запрос,
+# 'buffered' - счетчики в памяти процесса, запись пачкой раз в FLUSH_INTERVAL_MS
+# или после FLUSH_EVENTS запросов. OVERSHOOT - допустимое превышение лимита на воркер.
+
+REQUEST_COUNTERS = {
+    'MODE': env('REQUEST_COUNTERS_MODE', default='atomic'),
+    'FLUSH_INTERVAL_MS': 500,
+    'FLUSH_EVENTS': 100,
+    'OVERSHOOT': 0,
+}
+
+# Ограничение всплесков запросов мерчантов (token bucket): RATE - запросов в секунду,
+# BURST - емкость корзины. Отдельные корзины на API-ключ и на компанию.
+
+MERCHANT_THROTTLE = {
+    'DEFAULT_PLAN': 'FREE',
+    'PLANS': {
+        'FREE': {
+            'key': {'RATE': 2, 'BURST': 10},
+            'company': {'RATE': 5, 'BURST': 20},
+        },
+        'BASIC': {
+            'key': {'RATE': 10, 'BURST': 50},
+            'company': {'RATE': 25, 'BURST': 100},
+        },
+        'PREMIUM': {
+            'key': {'RATE': 50, 'BURST': 200},
+            'company': {'RATE': 100, 'BURST': 400},
+        },
+    },
+}
+
+# Одновременные запросы мерчантов на компанию в пределах хоста (слоты на flock).
+# Сверх лимита запрос ждет QUEUE_TIMEOUT секунд и получает 429.
+
+MERCHANT_CONCURRENCY = {
+    'DEFAULT_PLAN': 'FREE',
+    'PLANS': {
+        'FREE': 2,
+        'BASIC': 5,
+        'PREMIUM': 20,
+    },
+    'QUEUE_TIMEOUT': 0.5,
+    'POLL_INTERVAL': 0.01,
+    'LOCK_DIR': env('MERCHANT_CONCURRENCY_LOCK_DIR', default='/tmp/aralashapi-concurrency'),
+}
+
+# Сброс нагрузки: при задержке очереди выше TARGET_MS дольше INTERVAL_MS запросы класса LOW
+# получают 503, выше 2*TARGET_MS - и обычные. CRITICAL не сбрасываются никогда.
+# Задержка берется из X-Request-Start прокси (nginx: proxy_set_header X-Request-Start "t=${msec}");
+# без заголовка запросы не сбрасываются. Классы задаются именами маршрутов.
+# Заголовок учитывается только с TRUST_REQUEST_START - когда прокси всегда перезаписывает
+# значение клиента; задержки из будущего и длиннее MAX_DELAY_MS отбрасываются.
+
+LOAD_SHEDDING = {
+    'TARGET_MS': 200,
+    'INTERVAL_MS': 1000,
+    'ALPHA': 0.2,
+    'TRUST_REQUEST_START': env.bool('LOAD_SHEDDING_TRUST_REQUEST_START', default=False),
+    'MAX_DELAY_MS': 30000,
+    'CRITICAL': {
+        'withdrawal_request', 'confirm_withdrawal', 'cancel_withdrawal', 'get_withdrawal_info',
+        'mass_payout', 'confirm_withdrawals', 'cancel_withdrawals', 'get_withdrawals_info',
+        'create-invoice', 'invoice-info', 'merchant_token', 'quota_status', 'callback_settings',
+    },
+    'LOW': {
+        'schema-swagger-ui', 'schema-redoc', 'schema-json',
+        'user-statistics-list', 'company-statistics-list', 'company-list-create', 'user-company-list',
+        'business-type-list-create', 'subscription-list', 'subscription-detail', 'subscription-history-list',
+    },
+}
+
+# Callback-и мерчантам: пишутся в outbox в одной транзакции со сменой статуса и
+# отправляются командой deliver_callbacks. Повтор через BACKOFF_BASE * 2^(попытка-1)
+# секунд (не более BACKOFF_MAX), после MAX_ATTEMPTS попыток запись помечается dead.
+# LEASE - на сколько секунд запись закрепляется за воркером на время отправки.
+# Асинхронный воркер держит не больше GLOBAL_CONCURRENCY отправок, на один хост -
+# HOST_CONCURRENCY keep-alive соединений; при остановке ждет текущие DRAIN_TIMEOUT секунд.
+# Компании с callback_batching получают события по одному url массивом: окно накопления
+# BATCH_WINDOW секунд (должно быть меньше LEASE и BACKOFF_BASE), не больше BATCH_MAX_SIZE событий.
+
+CALLBACK_OUTBOX = {
+    'CONNECT_TIMEOUT': 3,
+    'READ_TIMEOUT': 10,
+    'MAX_ATTEMPTS': 10,
+    'BACKOFF_BASE': 10,
+    'BACKOFF_MAX': 6 * 3600,
+    'BATCH_SIZE': 100,
+    'LEASE': 60,
+    'POLL_INTERVAL': 1,
+    'GLOBAL_CONCURRENCY': 500,
+    'HOST_CONCURRENCY': 20,
+    'IDLE_TIMEOUT': 30,
+    'FLUSH_INTERVAL_MS': 200,
+    'DRAIN_TIMEOUT': 15,
+    'BATCH_WINDOW': 2,
+    'BATCH_MAX_SIZE': 100,
+}
+
+# Пакетные операции с заявками на вывод: не больше MAX_IDS id в одном запросе
+# и MAX_PAYOUTS выплат в одной массовой выплате. Квота списывается по единице
+# за каждый id или выплату.
+
+WITHDRAWAL_BATCH = {
+    'MAX_IDS': 500,
+    'MAX_PAYOUTS': 1000,
+}
+
+# Пакетные выплаты (manage.py process_payouts): заявки в processing группируются по method и
+# currency. Пакет уходит, когда набралось MAX_SIZE заявок или самая старая ждет дольше MAX_AGE
+# секунд; METHODS переопределяет пороги для метода. PROVIDERS - путь к классу провайдера
+# (api.payouts.PayoutProvider) для метода; методы без провайдера пакетами не выплачиваются.
+
+PAYOUT_BATCHING = {
+    'MAX_SIZE': 100,
+    'MAX_AGE': 15 * 60,
+    'POLL_INTERVAL': 30,
+    'METHODS': {
+        'BITCOIN': {'MAX_SIZE': 250, 'MAX_AGE': 60 * 60},
+        'ETHEREUM': {'MAX_SIZE': 250, 'MAX_AGE': 30 * 60},
+    },
+    'PROVIDERS': {},
+}
+
+# Исходящие зависимости: у каждой свой таймаут (секунды), а на все вызовы одного запроса -
+# общий бюджет REQUEST_BUDGET. После FAILURE_THRESHOLD отказов подряд breaker размыкается
+# и вызовы сразу получают 503 на RESET_TIMEOUT секунд. Для callback-ов breaker свой на каждый
+# хост мерчанта, таймауты - в CALLBACK_OUTBOX.
+
+RESILIENCE = {
+    'REQUEST_BUDGET': 8,
+    'MIN_TIMEOUT': 0.1,
+    'DEPENDENCIES': {
+        'smtp': {'TIMEOUT': 5, 'FAILURE_THRESHOLD': 3, 'RESET_TIMEOUT': 30},
+        'firebase': {'TIMEOUT': 3, 'FAILURE_THRESHOLD': 3, 'RESET_TIMEOUT': 30},
+        'callback': {'FAILURE_THRESHOLD': 5, 'RESET_TIMEOUT': 60},
+    },
+}
+
+# Метрики в формате Prometheus: GET /metrics с заголовком "Authorization: Bearer <METRICS_TOKEN>"
+# (в Prometheus - authorization.credentials). Без токена эндпоинт закрыт.
+
+METRICS_TOKEN = env('METRICS_TOKEN', default=None)
+
+# Время жизни подписанных мерчантских токенов (секунды)
+
+MERCHANT_TOKEN_LIFETIME = 900
+
 # Настройка REST
+# Политика по умолчанию для кабинета: JWT, Basic с кэшем проверок и сессия админки.
+# Мерчантские эндпоинты задают свой список в api.views.MerchantAPIView.
+# NUM_PROXIES - сколько доверенных прокси перед приложением добавляют адрес в X-Forwarded-For
+# (за одним nginx - 1). При 0 IP для ограничений берется из REMOTE_ADDR, а заголовок клиента
+# игнорируется; без значения DRF доверял бы X-Forwarded-For целиком.
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
+        'user.authentication.ClaimsJWTAuthentication',
+        'user.authentication.CachedBasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    'PAGE_SIZE': 9
+    'PAGE_SIZE': 9,
+    'NUM_PROXIES': env.int('NUM_PROXIES', default=0),
 }
 
 SIMPLE_JWT = {
@@ -227,6 +395,38 @@ SIMPLE_JWT = {
 
 }
 
+# Кэш проверки is_active для пользователей из JWT (в памяти процесса)
+
+JWT_ACTIVE_USER_CACHE = {
+    'TTL': 300,
+    'MAX_SIZE': 10000,
+}
+
+# Ограничение эндпоинтов, отправляющих письма (скользящее окно в секундах):
+# запросов с одного IP и писем на один адрес
+
+EMAIL_SEND_THROTTLE = {
+    'WINDOW': 3600,
+    'IP_LIMIT': 20,
+    'EMAIL_LIMIT': 5,
+}
+
+# Кэш успешных проверок Basic-аутентификации (в памяти процесса)
+
+BASIC_AUTH_CACHE = {
+    'TTL': 30,
+    'MAX_SIZE': 10000,
+}
+
+# Отзыв refresh-токенов при ротации: фильтр Блума в памяти поверх таблицы RevokedToken
+
+REFRESH_TOKEN_REVOCATION = {
+    'CAPACITY': 100000,
+    'ERROR_RATE': 0.001,
+    'SYNC_INTERVAL': 5,
+    'PRUNE_INTERVAL': 3600,
+}
+
 #google auth
 
 AUTHENTICATION_BACKENDS = (
@@ -237,7 +437,13 @@ AUTHENTICATION_BACKENDS = (
 SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = env('SOCIAL_AUTH_GOOGLE_OAUTH2_KEY')
 SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = env('SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET')
 
+# Firebase инициализируется при первом обращении (user.firebase).
+# PROJECT_ID по умолчанию берется из файла сервисного аккаунта.
 
-
-cred = credentials.Certificate(f"{BASE_DIR}/aralashapi-firebase-adminsdk-4ncbc-ef933bd4a5.json")
-firebase_admin.initialize_app(cred)
\ No newline at end of file
+FIREBASE = {
+    'CREDENTIALS': f"{BASE_DIR}/aralashapi-firebase-adminsdk-4ncbc-ef933bd4a5.json",
+    'PROJECT_ID': env('FIREBASE_PROJECT_ID', default=None),
+    'CERTS_URL': 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com',
+    'CERTS_MIN_REFRESH': 60,
+    'TOKEN_CACHE_SIZE': 10000,
+}
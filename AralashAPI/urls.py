@@ -22,6 +22,8 @@ from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework import permissions
 
+from AralashAPI.metrics import metrics_view
+
 schema_view = get_schema_view(
     openapi.Info(
         title="AralashAPI",
@@ -41,6 +43,7 @@ urlpatterns = [
                   re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0),
                           name='schema-json'),
                   path('admin/', admin.site.urls),
+                  path('metrics', metrics_view, name='metrics'),
                   path('apiV1/', include('api.urls')),
                   path('apiV1/user/', include('user.urls')),
               ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) + static(settings.MEDIA_URL,
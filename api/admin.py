@@ -1,17 +1,19 @@
 from django.contrib import messages
+from django.db import transaction
 from django.urls import path, reverse
 from django.shortcuts import redirect
+from django.utils import timezone
 from django.utils.html import format_html
 from django.contrib import admin
 from user.models import User, BusinessType, Company, UserCompanyRelation, MonthlyUserStatistics, Subscription
-from api.models import PaymentMethod, Invoice, Withdrawal, WithdrawalRequest
+from api.models import CallbackOutbox, PaymentMethod, PayoutBatch, Invoice, Withdrawal, WithdrawalRequest
 
 
 class WithdrawalRequestAdmin(admin.ModelAdmin):
-    list_display = [ 'user', 'amount', 'status', 'process_withdrawal_button','id']
+    list_display = [ 'user', 'amount', 'status', 'process_withdrawal_button','id', 'payout_batch']
 
     def process_withdrawal_button(self, obj):
-        if obj.status == 'processing':
+        if obj.status == 'processing' and obj.payout_batch_id is None:
             return format_html(
                 '<a class="button" href="{}">Mark as Payed and Deduct Balance</a>',
                 reverse('admin:process_withdrawal', args=[obj.id])
@@ -47,12 +49,54 @@ from .models import APIKey
 
 @admin.register(APIKey)
 class APIKeyAdmin(admin.ModelAdmin):
-    list_display = ('key', 'company', 'created_at', 'is_active')
+    list_display = ('display_prefix', 'company', 'user', 'created_at', 'is_active', 'key_format')
 
-    search_fields = ('key', 'company__usercompanyrelation__user__email')
+    search_fields = ('=id', 'company__name', 'user__email', 'company__usercompanyrelation__user__email')
 
     list_filter = ('is_active', 'created_at')
 
+    fields = ('company', 'user', 'is_active', 'display_prefix', 'secret_hash', 'key')
+    readonly_fields = ('display_prefix', 'secret_hash', 'key')
+    actions = ['rotate_keys', 'hash_legacy_keys']
+
+    def key_format(self, obj):
+        if obj.key is not None:
+            return 'legacy UUID'
+        return 'hashed'
+    key_format.short_description = 'Format'
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск по полному ключу или его префиксу ak_<id>_
+        key_id, _ = APIKey.parse_raw_key(search_term.rstrip('_') + '_x')
+        if key_id is not None:
+            return queryset.filter(pk=key_id), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def save_model(self, request, obj, form, change):
+        secret = None if change else obj.set_new_secret()
+        super().save_model(request, obj, form, change)
+        if secret is not None:
+            self.message_user(request, f"New API key (shown only once): {obj.format_raw_key(secret)}",
+                              messages.WARNING)
+
+    @admin.action(description='Deactivate and issue new keys')
+    def rotate_keys(self, request, queryset):
+        for old_key in queryset.filter(is_active=True):
+            old_key.is_active = False
+            old_key.save()
+            new_key, raw_key = APIKey.objects.create_key(company=old_key.company, user=old_key.user)
+            self.message_user(request, f"{old_key.display_prefix} replaced, new key (shown only once): {raw_key}",
+                              messages.WARNING)
+
+    @admin.action(description='Hash legacy UUID keys')
+    def hash_legacy_keys(self, request, queryset):
+        keys = list(queryset.filter(key__isnull=False))
+        for api_key in keys:
+            api_key.secret_hash = APIKey.hash_secret(api_key.key)
+            api_key.key = None
+        APIKey.objects.bulk_update(keys, ['secret_hash', 'key'])
+        self.message_user(request, f"Hashed {len(keys)} legacy keys.", messages.SUCCESS)
+
 
 
 
@@ -121,6 +165,40 @@ class InvoiceAdmin(admin.ModelAdmin):
     list_filter = ('status', 'created_at')
     ordering = ('-created_at',)
 
+    def save_model(self, request, obj, form, change):
+        # Смена статуса и callback о ней фиксируются одной транзакцией
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if change and 'status' in form.changed_data:
+                CallbackOutbox.objects.enqueue(obj)
+
+
+@admin.register(CallbackOutbox)
+class CallbackOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'event', 'object_id', 'url', 'status', 'attempts', 'next_attempt_at', 'created_at')
+    search_fields = ('=object_id', 'url', 'company__name')
+    list_filter = ('status', 'event', 'created_at')
+    ordering = ('-created_at',)
+    readonly_fields = ('payload', 'last_error', 'attempts', 'delivered_at', 'created_at')
+    actions = ['retry_callbacks']
+
+    @admin.action(description='Retry delivery now')
+    def retry_callbacks(self, request, queryset):
+        retried = queryset.exclude(status=CallbackOutbox.DELIVERED).update(
+            status=CallbackOutbox.PENDING, attempts=0, next_attempt_at=timezone.now()
+        )
+        self.message_user(request, f"Queued {retried} callbacks for delivery.", messages.SUCCESS)
+
+
+@admin.register(PayoutBatch)
+class PayoutBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'method', 'currency', 'status', 'size', 'total_amount', 'provider_reference', 'created_at',
+                    'settled_at')
+    search_fields = ('=id', 'provider_reference')
+    list_filter = ('status', 'method', 'created_at')
+    ordering = ('-created_at',)
+    readonly_fields = ('size', 'total_amount', 'provider_reference', 'error', 'created_at', 'settled_at')
+
 
 @admin.register(Withdrawal)
 class WithdrawalAdmin(admin.ModelAdmin):
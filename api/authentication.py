@@ -1,17 +1,62 @@
-from rest_framework.authentication import BaseAuthentication
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
 from rest_framework.exceptions import AuthenticationFailed
-from .models import APIKey
+from .tokens import read_merchant_token
+from .utils import load_merchant_context
 
 
 class APIKeyAuthentication(BaseAuthentication):
+    """
+    API-Login: <email>
+    API-Key: <api key>
+
+    Учетные данные читаются из заголовков, поэтому неверный ключ отклоняется
+    до разбора тела запроса. request.auth содержит MerchantContext.
+    """
+
     def authenticate(self, request):
         key = request.headers.get('API-Key')
         if not key:
             return None
 
+        login = request.headers.get('API-Login')
+        if not login:
+            raise AuthenticationFailed('API-Login header is required')
+
+        context = load_merchant_context(login, key)
+        if context is None:
+            raise AuthenticationFailed('Invalid API-Login or API-Key')
+
+        return context.user, context
+
+    def authenticate_header(self, request):
+        return 'API-Key'
+
+
+class MerchantTokenAuthentication(BaseAuthentication):
+    """
+    Authorization: Merchant <token>
+
+    Токен выдается эндпоинтом merchant-token и проверяется только по подписи,
+    без запросов к БД. request.auth содержит MerchantContext.
+    """
+    keyword = 'Merchant'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid merchant token header')
+
         try:
-            api_key = APIKey.objects.get(key=key, is_active=True)
-        except APIKey.DoesNotExist:
-            raise AuthenticationFailed('Invalid API Key')
+            token = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed('Invalid merchant token header')
+
+        context = read_merchant_token(token)
+        if context is None:
+            raise AuthenticationFailed('Invalid or expired merchant token')
+        return context.user, context
 
-        return api_key.user, None
+    def authenticate_header(self, request):
+        return self.keyword
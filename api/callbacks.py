@@ -0,0 +1,235 @@
+"""
+Delivery of merchant callbacks queued in CallbackOutbox.
+
+Rows are written in the same transaction as the status change they report
+(CallbackOutbox.objects.enqueue), so a callback exists if and only if the
+change was committed. Delivery runs outside of request handling in the
+deliver_callbacks command: due rows are leased to a worker, POSTed with
+strict timeouts and either marked delivered, rescheduled with exponential
+backoff, or dead-lettered after MAX_ATTEMPTS.
+
+Companies with callback_batching get their events coalesced: rows wait for
+the end of an aligned BATCH_WINDOW (or until BATCH_MAX_SIZE of them pile up)
+and all events for one callback URL go out as one JSON array signed with
+the company's callback_secret. A batch succeeds or fails as a whole.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from AralashAPI.metrics import metrics
+from AralashAPI.resilience import CircuitOpenError, breaker_for
+
+from .models import CallbackOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempts):
+    """
+    Пауза перед следующей попыткой (секунды), с разбросом +-20%, чтобы повторы
+    к одному хосту не приходили одновременно.
+    """
+    config = settings.CALLBACK_OUTBOX
+    delay = min(config['BACKOFF_BASE'] * 2 ** (attempts - 1), config['BACKOFF_MAX'])
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim_due(batch_size, now=None):
+    """
+    Закрепляет до batch_size готовых записей за воркером, сдвигая next_attempt_at
+    на LEASE секунд. Записи, заблокированные другими воркерами, пропускаются;
+    если воркер упадет, запись снова станет доступна по истечении аренды.
+    """
+    now = now or timezone.now()
+    CallbackOutbox.objects.release_full_batches(now)
+    with transaction.atomic():
+        entries = list(
+            CallbackOutbox.objects.due(now).select_related('company').select_for_update(
+                skip_locked=True, of=('self',)
+            ).order_by('id')[:batch_size]
+        )
+        CallbackOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).update(
+            next_attempt_at=now + timedelta(seconds=settings.CALLBACK_OUTBOX['LEASE'])
+        )
+    return entries
+
+
+def release(entries, now=None):
+    """
+    Снимает аренду с записей, которые воркер забрал, но не отправлял.
+    """
+    CallbackOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).update(next_attempt_at=now or timezone.now())
+
+
+def group_deliveries(entries):
+    """
+    Разбивает записи на отправки: обычные по одной, пакетные - по (компания, url)
+    в порядке постановки, не больше BATCH_MAX_SIZE событий в отправке.
+    """
+    max_size = settings.CALLBACK_OUTBOX['BATCH_MAX_SIZE']
+    deliveries = []
+    batches = {}
+    for entry in entries:
+        if not entry.batched:
+            deliveries.append([entry])
+            continue
+        batch = batches.get((entry.company_id, entry.url))
+        if batch is None or len(batch) >= max_size:
+            batch = batches[(entry.company_id, entry.url)] = []
+            deliveries.append(batch)
+        batch.append(entry)
+    return deliveries
+
+
+def sign_batch(secret, timestamp, body):
+    return hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+def build_request(delivery):
+    """
+    Возвращает (url, body, headers) для одной отправки. Одиночное событие уходит
+    как раньше - объектом; пакет - массивом {"id", "event", "data"} с подписью
+    HMAC-SHA256 от "<timestamp>.<body>" в X-Callback-Signature.
+    """
+    first = delivery[0]
+    if not first.batched:
+        body = json.dumps(first.payload).encode()
+        return first.url, body, {
+            'Content-Type': 'application/json',
+            'X-Callback-Id': str(first.pk),
+            'X-Callback-Event': first.event,
+        }
+
+    body = json.dumps([
+        {'id': entry.pk, 'event': entry.event, 'data': entry.payload} for entry in delivery
+    ]).encode()
+    timestamp = int(time.time())
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Callback-Batch': str(len(delivery)),
+        'X-Callback-Timestamp': str(timestamp),
+    }
+    if first.company.callback_secret:
+        headers['X-Callback-Signature'] = 'sha256=' + sign_batch(first.company.callback_secret, timestamp, body)
+    return first.url, body, headers
+
+
+def send_callback(delivery, session):
+    config = settings.CALLBACK_OUTBOX
+    url, body, headers = build_request(delivery)
+    response = session.post(
+        url,
+        data=body,
+        headers=headers,
+        timeout=(config['CONNECT_TIMEOUT'], config['READ_TIMEOUT']),
+    )
+    response.raise_for_status()
+
+
+def _apply_delivered(entry, now):
+    entry.attempts += 1
+    entry.status = CallbackOutbox.DELIVERED
+    entry.delivered_at = now
+    entry.last_error = ''
+    metrics.inc('callback_deliveries_total', result='delivered')
+
+
+def _apply_failed(entry, error, now, delay):
+    entry.attempts += 1
+    entry.last_error = error[:1000]
+    if entry.attempts >= settings.CALLBACK_OUTBOX['MAX_ATTEMPTS']:
+        entry.status = CallbackOutbox.DEAD
+        logger.warning('Callback %s to %s is dead after %s attempts: %s', entry.pk, entry.url, entry.attempts, error)
+        metrics.inc('callback_deliveries_total', result='dead')
+    else:
+        entry.next_attempt_at = now + timedelta(seconds=delay)
+        metrics.inc('callback_deliveries_total', result='retry')
+
+
+def _apply_deferred(entry, error, now):
+    # Breaker хоста разомкнут: отправки не было, попытка не засчитывается
+    entry.last_error = str(error)
+    entry.next_attempt_at = now + timedelta(seconds=error.retry_after)
+    metrics.inc('callback_deliveries_total', result='deferred')
+
+
+def host_breaker(url):
+    return breaker_for('callback', urlsplit(url).netloc)
+
+
+RESULT_FIELDS = ['attempts', 'status', 'delivered_at', 'last_error', 'next_attempt_at']
+
+
+def record_results(results, now=None):
+    """
+    Сохраняет итоги пачки отправок одним bulk_update.
+    results - пары (entry, error): error равен None для доставленных, текст ошибки
+    для неудачных и CircuitOpenError для не отправленных из-за разомкнутого breaker-а.
+    """
+    now = now or timezone.now()
+    entries = []
+    delays = {}
+    for entry, error in results:
+        if error is None:
+            _apply_delivered(entry, now)
+        elif isinstance(error, CircuitOpenError):
+            _apply_deferred(entry, error, now)
+        else:
+            # События одного пакета повторяются вместе, одной отправкой
+            key = (entry.company_id, entry.url, entry.attempts) if entry.batched else entry.pk
+            if key not in delays:
+                delays[key] = backoff_delay(entry.attempts + 1)
+            _apply_failed(entry, error, now, delays[key])
+        entries.append(entry)
+    CallbackOutbox.objects.bulk_update(entries, RESULT_FIELDS)
+
+
+def deliver_due(session=None, batch_size=None, now=None):
+    """
+    Отправляет одну пачку готовых callback-ов. Возвращает число обработанных записей.
+    Новая отправка начинается, только если успеет до конца аренды (CONNECT_TIMEOUT +
+    READ_TIMEOUT); остальные записи пачки освобождаются для следующего прохода,
+    иначе их забрал бы и отправил повторно другой воркер.
+    """
+    config = settings.CALLBACK_OUTBOX
+    session = session or requests.Session()
+    deadline = time.monotonic() + config['LEASE'] - config['CONNECT_TIMEOUT'] - config['READ_TIMEOUT']
+    entries = claim_due(batch_size or config['BATCH_SIZE'], now)
+    results = []
+    deliveries = group_deliveries(entries)
+    for index, delivery in enumerate(deliveries):
+        if results and time.monotonic() >= deadline:
+            release([entry for rest in deliveries[index:] for entry in rest], now)
+            break
+        breaker = host_breaker(delivery[0].url)
+        try:
+            breaker.check()
+            send_callback(delivery, session)
+        except CircuitOpenError as e:
+            error = e
+        except requests.RequestException as e:
+            error = str(e)
+            # 4xx - ошибка на стороне обработчика мерчанта, хост при этом жив
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code < 500:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        else:
+            error = None
+            breaker.record_success()
+        results.extend((entry, error) for entry in delivery)
+    if results:
+        record_results(results, now)
+    return len(results)
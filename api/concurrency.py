@@ -0,0 +1,135 @@
+import errno
+import logging
+import os
+import random
+import re
+import time
+
+from django.conf import settings
+
+from AralashAPI.metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: ограничение не применяется
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SLOT_FILE_RE = re.compile(r'^company-(\d+)-\d+\.lock$')
+
+
+class CompanySlots:
+    """
+    Host-wide semaphore of in-flight requests per company.
+
+    Each company has `limit` slot files in a shared directory; a request holds
+    an exclusive flock on one of them. Locks belong to the open file, so they
+    work across worker processes and threads and are released by the kernel
+    if a worker dies.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, company_id, slot):
+        return os.path.join(self.directory, f'company-{company_id}-{slot}.lock')
+
+    def _try_lock(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return fd
+
+    def acquire(self, company_id, limit, timeout=0, poll_interval=0.01):
+        """
+        Занимает свободный слот компании, ожидая до timeout секунд.
+        Возвращает дескриптор слота или None, если все слоты заняты.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            # Случайный стартовый слот, чтобы воркеры не толкались на первом файле
+            start = random.randrange(limit)
+            for offset in range(limit):
+                fd = self._try_lock(self._path(company_id, (start + offset) % limit))
+                if fd is not None:
+                    return fd
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def release(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def occupancy(self):
+        """
+        Число занятых слотов по компаниям на этом хосте.
+        """
+        busy = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return busy
+        for name in names:
+            match = SLOT_FILE_RE.match(name)
+            if match is None:
+                continue
+            company_id = int(match.group(1))
+            fd = self._try_lock(os.path.join(self.directory, name))
+            if fd is None:
+                busy[company_id] = busy.get(company_id, 0) + 1
+            else:
+                self.release(fd)
+                busy.setdefault(company_id, 0)
+        return busy
+
+
+company_slots = CompanySlots(settings.MERCHANT_CONCURRENCY['LOCK_DIR'])
+
+
+def get_concurrency_limit(subscription):
+    config = settings.MERCHANT_CONCURRENCY
+    plan = subscription.name if subscription else config['DEFAULT_PLAN']
+    return config['PLANS'].get(plan, config['PLANS'][config['DEFAULT_PLAN']])
+
+
+def acquire_company_slot(context):
+    """
+    Возвращает (acquired, fd). fd равен None, если ограничение не применяется.
+    """
+    if fcntl is None:
+        return True, None
+    config = settings.MERCHANT_CONCURRENCY
+    fd = company_slots.acquire(
+        context.company.pk,
+        get_concurrency_limit(context.subscription),
+        timeout=config['QUEUE_TIMEOUT'],
+        poll_interval=config['POLL_INTERVAL'],
+    )
+    if fd is None:
+        metrics.inc('merchant_concurrency_rejected_total', company=context.company.pk)
+        return False, None
+    return True, fd
+
+
+def release_company_slot(fd):
+    if fd is not None:
+        company_slots.release(fd)
+
+
+def _occupancy_samples():
+    if fcntl is None:
+        return []
+    return [({'company': company_id}, busy) for company_id, busy in company_slots.occupancy().items()]
+
+
+metrics.register_collector('merchant_inflight_requests', _occupancy_samples)
@@ -0,0 +1,388 @@
+"""
+Asyncio dispatcher for merchant callbacks.
+
+One process keeps many callbacks in flight: connections are pooled per
+merchant host and reused with HTTP/1.1 keep-alive. Concurrency is limited per
+host (a slow merchant cannot take all slots) and globally. Every request has
+a connect timeout and one deadline for sending it and reading the whole
+response. A delivery that waited for its slots until its outbox lease can no
+longer cover that is not sent: the row may already belong to another worker.
+
+The client speaks just the subset of HTTP/1.1 a callback needs (POST a
+prepared body, read status and discard the response body) over asyncio streams, so the worker
+has no extra dependencies.
+"""
+import asyncio
+import logging
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from AralashAPI.metrics import metrics
+from AralashAPI.resilience import CircuitOpenError
+
+from .callbacks import build_request, claim_due, group_deliveries, host_breaker, record_results
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 64 * 1024
+
+
+class CallbackError(Exception):
+    pass
+
+
+class StaleConnection(CallbackError):
+    """
+    Переиспользованное соединение закрыто сервером до ответа - запрос можно повторить.
+    """
+
+
+class LeaseExpired(Exception):
+    """
+    Слот освободился слишком поздно: аренда записи истечет раньше, чем кончатся таймауты.
+    """
+
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        self.writer.close()
+
+
+class HostPool:
+    """
+    Keep-alive connections to one scheme://host:port, at most `limit` in use.
+    """
+
+    def __init__(self, scheme, host, port, limit, connect_timeout, idle_timeout, ssl_context=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.semaphore = asyncio.Semaphore(limit)
+        self.idle = []
+        self.opened = 0
+
+    async def _open(self):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host, self.port, ssl=self.ssl_context,
+                    server_hostname=self.host if self.ssl_context else None,
+                ),
+                self.connect_timeout,
+            )
+        except asyncio.TimeoutError:
+            raise CallbackError(f'Connect timeout to {self.host}:{self.port}')
+        except OSError as e:
+            raise CallbackError(f'Connection to {self.host}:{self.port} failed: {e}')
+        self.opened += 1
+        return Connection(reader, writer)
+
+    async def acquire(self, fresh=False):
+        now = time.monotonic()
+        while self.idle and not fresh:
+            connection = self.idle.pop()
+            if connection.reader.at_eof() or now - connection.last_used > self.idle_timeout:
+                connection.close()
+                continue
+            connection.reused = True
+            return connection
+        return await self._open()
+
+    def release(self, connection, reusable):
+        if reusable:
+            connection.last_used = time.monotonic()
+            connection.reused = False
+            self.idle.append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+async def _read_response(reader):
+    """
+    Читает ответ, тело отбрасывается. Возвращает (status, keep_alive).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise StaleConnection('Connection closed before response')
+    try:
+        version, code = status_line.decode('latin-1').split(None, 2)[:2]
+        code = int(code)
+    except ValueError:
+        raise CallbackError(f'Malformed status line: {status_line[:100]!r}')
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if code in (204, 304) or 100 <= code < 200:
+        return code, keep_alive
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        received = 0
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            received += size
+            if received > MAX_BODY_SIZE:
+                return code, False
+            await reader.readexactly(size + 2)
+        return code, keep_alive
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        if length > MAX_BODY_SIZE:
+            return code, False
+        await reader.readexactly(length)
+        return code, keep_alive
+    # Без длины тело заканчивается закрытием соединения
+    await reader.read(MAX_BODY_SIZE)
+    return code, False
+
+
+class CallbackDispatcher:
+
+    def __init__(self, global_limit, host_limit, connect_timeout, read_timeout, idle_timeout=30):
+        self.global_semaphore = asyncio.Semaphore(global_limit)
+        self.global_limit = global_limit
+        self.host_limit = host_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.pools = {}
+        self.inflight = 0
+        self._ssl_context = None
+
+    @classmethod
+    def from_settings(cls):
+        config = settings.CALLBACK_OUTBOX
+        return cls(
+            global_limit=config['GLOBAL_CONCURRENCY'],
+            host_limit=config['HOST_CONCURRENCY'],
+            connect_timeout=config['CONNECT_TIMEOUT'],
+            read_timeout=config['READ_TIMEOUT'],
+            idle_timeout=config['IDLE_TIMEOUT'],
+        )
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise CallbackError(f'Unsupported callback URL: {url}')
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        pool = self.pools.get(key)
+        if pool is None:
+            ssl_context = None
+            if parts.scheme == 'https':
+                if self._ssl_context is None:
+                    self._ssl_context = ssl.create_default_context()
+                ssl_context = self._ssl_context
+            pool = self.pools[key] = HostPool(
+                parts.scheme, parts.hostname, port, self.host_limit,
+                self.connect_timeout, self.idle_timeout, ssl_context,
+            )
+        return pool, parts
+
+    @staticmethod
+    def _request(pool, parts, body, headers):
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        default_port = 443 if pool.scheme == 'https' else 80
+        host = pool.host if pool.port == default_port else f'{pool.host}:{pool.port}'
+        lines = [f'POST {target} HTTP/1.1', f'Host: {host}', f'Content-Length: {len(body)}', 'Connection: keep-alive']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _exchange(self, pool, request, fresh=False):
+        connection = await pool.acquire(fresh=fresh)
+        reusable = False
+        sent = False
+
+        async def roundtrip():
+            nonlocal sent
+            connection.writer.write(request)
+            await connection.writer.drain()
+            sent = True
+            return await _read_response(connection.reader)
+
+        try:
+            code, reusable = await asyncio.wait_for(roundtrip(), self.read_timeout)
+        except asyncio.TimeoutError:
+            if not sent:
+                raise CallbackError(f'Write timeout to {pool.host}')
+            raise CallbackError(f'Read timeout from {pool.host}')
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            if connection.reused:
+                raise StaleConnection(str(e))
+            raise CallbackError(f'Connection to {pool.host} failed: {e!r}')
+        except StaleConnection:
+            if connection.reused:
+                raise
+            raise CallbackError(f'{pool.host} closed the connection without response')
+        except ValueError as e:
+            raise CallbackError(f'Malformed response from {pool.host}: {e}')
+        finally:
+            pool.release(connection, reusable)
+        return code
+
+    async def send(self, delivery, deadline=None):
+        """
+        Отправляет одно событие или пакет событий (см. group_deliveries).
+        Возвращает None при ответе 2xx, иначе текст ошибки; CircuitOpenError,
+        если breaker хоста разомкнут и отправка не делалась; LeaseExpired, если
+        слоты освободились после deadline (time.monotonic()) и отправка не делалась.
+        """
+        try:
+            url, body, headers = build_request(delivery)
+            pool, parts = self._pool(url)
+            request = self._request(pool, parts, body, headers)
+        except CallbackError as e:
+            return str(e)
+        breaker = host_breaker(url)
+        # Сначала слот хоста, потом глобальный: медленный хост не держит глобальные слоты в очереди.
+        # Аренду и breaker проверяем уже со слотами - ждавшие в очереди к медленному или
+        # упавшему хосту не отправляются
+        async with pool.semaphore, self.global_semaphore:
+            if deadline is not None and time.monotonic() >= deadline:
+                return LeaseExpired()
+            if not breaker.allow():
+                return CircuitOpenError(breaker.name, breaker.retry_after())
+            self.inflight += 1
+            try:
+                try:
+                    code = await self._exchange(pool, request)
+                except StaleConnection:
+                    # Сервер закрыл keep-alive соединение, пока оно простаивало
+                    code = await self._exchange(pool, request, fresh=True)
+            except CallbackError as e:
+                breaker.record_failure()
+                return str(e)
+            except BaseException:
+                breaker.record_success()
+                raise
+            finally:
+                self.inflight -= 1
+        # 4xx - ошибка на стороне обработчика мерчанта, хост при этом жив
+        if code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if 200 <= code < 300:
+            return None
+        return f'HTTP {code}'
+
+    async def deliver(self, entries):
+        deliveries = group_deliveries(entries)
+        errors = await asyncio.gather(*(self.send(delivery) for delivery in deliveries))
+        return [(entry, error) for delivery, error in zip(deliveries, errors) for entry in delivery]
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def connections_opened(self):
+        return sum(pool.opened for pool in self.pools.values())
+
+
+async def run_dispatcher(dispatcher, stop, once=False, batch_size=None):
+    """
+    Главный цикл воркера: забирает готовые записи из outbox, пока в полете меньше
+    2 * global_limit отправок, и сохраняет результаты пачками. Записи, до которых
+    очередь дошла слишком поздно для их аренды, не отправляются и не сохраняются:
+    их заберет следующий опрос. После stop новые записи
+    не берутся, текущие отправки ждем не дольше DRAIN_TIMEOUT; прерванные вернутся
+    в очередь по истечении аренды. С once воркер выходит, когда очередь пуста.
+    """
+    config = settings.CALLBACK_OUTBOX
+    flush_interval = config['FLUSH_INTERVAL_MS'] / 1000
+    batch_size = batch_size or config['BATCH_SIZE']
+    lease = config['LEASE'] - dispatcher.connect_timeout - dispatcher.read_timeout
+    tasks = set()
+    results = []
+    processed = 0
+    next_claim_at = 0
+    last_claimed = 0
+    flushed_at = time.monotonic()
+
+    async def deliver(delivery, deadline):
+        error = await dispatcher.send(delivery, deadline)
+        if isinstance(error, LeaseExpired):
+            # Запись вернется в очередь по истечении аренды, итог не сохраняем
+            metrics.inc('callback_deliveries_total', len(delivery), result='lease_expired')
+            return
+        results.extend((entry, error) for entry in delivery)
+
+    async def flush():
+        nonlocal processed, flushed_at
+        flushed_at = time.monotonic()
+        if results:
+            batch = results[:]
+            del results[:]
+            await sync_to_async(record_results)(batch)
+            processed += len(batch)
+
+    try:
+        while not stop.is_set():
+            limit = min(dispatcher.global_limit * 2 - len(tasks), batch_size)
+            if limit > 0 and time.monotonic() >= next_claim_at:
+                # Отправку надо начать так, чтобы она закончилась до конца аренды
+                deadline = time.monotonic() + lease
+                entries = await sync_to_async(claim_due)(limit)
+                last_claimed = len(entries)
+                tasks.update(
+                    asyncio.create_task(deliver(delivery, deadline)) for delivery in group_deliveries(entries)
+                )
+                if last_claimed < limit:
+                    # Очередь пуста - следующий опрос базы не раньше POLL_INTERVAL
+                    next_claim_at = time.monotonic() + config['POLL_INTERVAL']
+            metrics.set('callback_dispatcher_inflight', len(tasks))
+
+            if not tasks:
+                await flush()
+                if once:
+                    if not last_claimed:
+                        break
+                    # Могли освободиться события, ждавшие доставки предыдущих по тому же объекту
+                    next_claim_at = 0
+                    continue
+                try:
+                    await asyncio.wait_for(stop.wait(), max(next_claim_at - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            done, tasks = await asyncio.wait(tasks, timeout=flush_interval, return_when=asyncio.FIRST_COMPLETED)
+            if len(results) >= batch_size or time.monotonic() - flushed_at >= flush_interval:
+                await flush()
+
+        if tasks:
+            done, tasks = await asyncio.wait(tasks, timeout=config['DRAIN_TIMEOUT'])
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                logger.warning('%s callbacks still in flight after drain, they will be retried', len(tasks))
+        await flush()
+    finally:
+        dispatcher.close()
+        metrics.set('callback_dispatcher_inflight', 0)
+    return processed
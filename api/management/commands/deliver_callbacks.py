@@ -0,0 +1,56 @@
+import asyncio
+import signal
+import time
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.callbacks import deliver_due
+from api.dispatcher import CallbackDispatcher, run_dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued merchant callbacks with retries, exponential backoff and dead-lettering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Deliver everything that is due and exit')
+        parser.add_argument('--batch-size', type=int, default=settings.CALLBACK_OUTBOX['BATCH_SIZE'])
+        parser.add_argument('--sync', action='store_true',
+                            help='Send callbacks one by one with requests instead of the asyncio dispatcher')
+
+    def handle(self, *args, **options):
+        if options['sync']:
+            total = self.deliver_sync(options['once'], options['batch_size'])
+        else:
+            total = asyncio.run(self.deliver_async(options['once'], options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(f'Callbacks processed: {total}.'))
+
+    def deliver_sync(self, once, batch_size):
+        session = requests.Session()
+        total = 0
+        try:
+            while True:
+                processed = deliver_due(session=session, batch_size=batch_size)
+                total += processed
+                if processed:
+                    continue
+                if once:
+                    break
+                time.sleep(settings.CALLBACK_OUTBOX['POLL_INTERVAL'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            session.close()
+        return total
+
+    async def deliver_async(self, once, batch_size):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        # SIGTERM/SIGINT: перестаем брать новые записи и дожидаемся отправок в полете
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        return await run_dispatcher(CallbackDispatcher.from_settings(), stop, once=once, batch_size=batch_size)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import APIKey
+
+
+class Command(BaseCommand):
+    help = 'Replace plaintext UUID API keys with their SHA-256 hashes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        total = 0
+        # Мерчанты продолжают пользоваться старыми UUID: ключ ищется по хэшу, открытое значение стирается
+        while True:
+            with transaction.atomic():
+                keys = list(
+                    APIKey.objects.select_for_update().filter(key__isnull=False).order_by('pk')[:chunk_size]
+                )
+                if not keys:
+                    break
+                for api_key in keys:
+                    api_key.secret_hash = APIKey.hash_secret(api_key.key)
+                    api_key.key = None
+                APIKey.objects.bulk_update(keys, ['secret_hash', 'key'])
+            total += len(keys)
+            self.stdout.write(f'Hashed {total} keys...')
+
+        self.stdout.write(self.style.SUCCESS(f'Legacy API keys hashed: {total}.'))
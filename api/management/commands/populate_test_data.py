@@ -82,7 +82,7 @@ class Command(BaseCommand):
         companies = Company.objects.all()
         for company in companies:
             if not APIKey.objects.filter(company=company).exists():
-                APIKey.objects.create(company=company)
+                APIKey.objects.create_key(company=company)
         self.stdout.write(self.style.SUCCESS('API keys created.'))
 
         # Создание инвойсов
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.models import PayoutBatch
+from api.payouts import load_providers, run_payouts
+
+
+class Command(BaseCommand):
+    help = 'Group processing withdrawal requests into payout batches and pay them through the configured providers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Pay the batches that are ready and exit')
+
+    def handle(self, *args, **options):
+        providers = load_providers()
+        if not providers:
+            self.stdout.write(self.style.WARNING('No payout providers configured in PAYOUT_BATCHING.'))
+            return
+        settled = failed = 0
+        try:
+            while True:
+                for batch in run_payouts(providers):
+                    batch.refresh_from_db(fields=['status'])
+                    if batch.status == PayoutBatch.SETTLED:
+                        settled += 1
+                    elif batch.status == PayoutBatch.FAILED:
+                        failed += 1
+                if options['once']:
+                    break
+                time.sleep(settings.PAYOUT_BATCHING['POLL_INTERVAL'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Payout batches settled: {settled}, failed: {failed}.'))
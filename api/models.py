@@ -1,23 +1,116 @@
+import hashlib
+import hmac
 import secrets
 import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
 from decimal import Decimal
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, Exists, ExpressionWrapper, F, OuterRef, Q, Sum, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from user.models import User, Company
 
 
+class APIKeyQuerySet(models.QuerySet):
+    def for_raw_key(self, raw_key):
+        """
+        Сужает выборку до строки ключа: по первичному ключу для нового формата
+        и по хэшу (или старому UUID) для ключей, выданных до перехода.
+        Секрет после выборки проверяется через APIKey.check_secret.
+        """
+        key_id, secret = APIKey.parse_raw_key(raw_key)
+        if key_id is not None:
+            return self.filter(pk=key_id)
+        lookup = models.Q(secret_hash=APIKey.hash_legacy_key(raw_key))
+        try:
+            lookup |= models.Q(key=uuid.UUID(str(raw_key)))
+        except ValueError:
+            pass
+        return self.filter(lookup)
+
+    def get_by_raw_key(self, raw_key, **kwargs):
+        for api_key in self.for_raw_key(raw_key).filter(**kwargs):
+            if api_key.check_secret(raw_key):
+                return api_key
+        raise APIKey.DoesNotExist
+
+    def create_key(self, company, user=None, **kwargs):
+        """
+        Создает ключ и возвращает (api_key, raw_key). Открытый ключ нигде не хранится.
+        """
+        api_key = self.model(company=company, user=user, **kwargs)
+        secret = api_key.set_new_secret()
+        api_key.save(using=self._db)
+        return api_key, api_key.format_raw_key(secret)
+
+
 class APIKey(models.Model):
+    PREFIX = 'ak'
+    SECRET_BYTES = 32
 
-    key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    # Старый формат: UUID в открытом виде. Новые ключи хранят только хэш секрета.
+    key = models.UUIDField(unique=True, null=True, blank=True, editable=False)
+    secret_hash = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
     company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
 
+    objects = APIKeyQuerySet.as_manager()
+
+    @staticmethod
+    def hash_secret(secret):
+        return hashlib.sha256(str(secret).encode()).hexdigest()
+
+    @classmethod
+    def hash_legacy_key(cls, raw_key):
+        # UUID сравнивался без учета регистра, поэтому хэшируем каноническую запись
+        try:
+            raw_key = uuid.UUID(str(raw_key))
+        except ValueError:
+            pass
+        return cls.hash_secret(raw_key)
+
+    @classmethod
+    def parse_raw_key(cls, raw_key):
+        """
+        Returns (key_id, secret) for keys in the ak_<id>_<secret> format, otherwise (None, None).
+        """
+        prefix, _, rest = str(raw_key).partition('_')
+        key_id, _, secret = rest.partition('_')
+        if prefix != cls.PREFIX or not key_id.isdigit() or not secret:
+            return None, None
+        return int(key_id), secret
+
+    @property
+    def display_prefix(self):
+        return f'{self.PREFIX}_{self.pk}_'
+
+    def set_new_secret(self):
+        secret = secrets.token_urlsafe(self.SECRET_BYTES)
+        self.secret_hash = self.hash_secret(secret)
+        self.key = None
+        return secret
+
+    def format_raw_key(self, secret):
+        return f'{self.display_prefix}{secret}'
+
+    def check_secret(self, raw_key):
+        key_id, secret = self.parse_raw_key(raw_key)
+        if key_id is not None:
+            return key_id == self.pk and self.secret_hash is not None and hmac.compare_digest(
+                self.hash_secret(secret), self.secret_hash
+            )
+        if self.secret_hash is not None:
+            return hmac.compare_digest(self.hash_legacy_key(raw_key), self.secret_hash)
+        return self.key is not None and hmac.compare_digest(str(self.key), str(raw_key))
+
     def __str__(self):
 
-        return f'APIKey {self.key} for {self.company.name}'
+        return f'APIKey {self.display_prefix} for {self.company.name}'
 
 
 
@@ -47,6 +140,17 @@ class Invoice(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, default='created')
 
+    CALLBACK_OBJECT = 'invoice'
+
+    def callback_payload(self):
+        return {
+            "status": self.status,
+            "id": str(self.id),
+            "type": self.type,
+            "amount": float(self.amount),
+            "amount_currency": self.amount_currency,
+        }
+
     def __str__(self):
         return f"Invoice {self.id} - {self.status}"
 
@@ -64,7 +168,77 @@ class Withdrawal(models.Model):
         return f"Payment {self.id} - {self.status}"
 
 
+class WithdrawalRequestQuerySet(models.QuerySet):
+    def transition(self, pk, target, **values):
+        """
+        Переводит заявку в статус target одним условным
+        UPDATE ... WHERE id = pk AND status IN (допустимые исходные статусы).
+        Компания и прочие условия задаются filter-ом до вызова.
+        Возвращает True, если строка обновлена, False - если заявки нет
+        или ее статус уже не позволяет переход.
+        """
+        sources = WithdrawalRequest.TRANSITIONS[target]
+        return self.filter(pk=pk, status__in=sources).update(status=target, **values) == 1
+
+    def advance(self, pk, target, company=None):
+        """
+        transition и постановка callback-а о новом статусе в одной транзакции.
+        Возвращает обновленную заявку или None, если переход не состоялся.
+        """
+        rows = self if company is None else self.filter(company=company)
+        with transaction.atomic(using=self.db):
+            if not rows.transition(pk, target):
+                return None
+            withdrawal_request = self.get(pk=pk)
+            CallbackOutbox.objects.enqueue(withdrawal_request, company=company or withdrawal_request.company)
+        return withdrawal_request
+
+    def advance_many(self, ids, target, company):
+        """
+        Пакетный переход: одна выборка id__in по компании (строки блокируются до
+        конца транзакции), один UPDATE для всех подходящих и callback-и одним INSERT.
+        Возвращает ({id: заявка} для найденных, множество id, перешедших в target).
+        """
+        sources = WithdrawalRequest.TRANSITIONS[target]
+        with transaction.atomic(using=self.db):
+            rows = {row.pk: row for row in self.filter(company=company, pk__in=ids).select_for_update()}
+            advanced = [row for row in rows.values() if row.status in sources]
+            if advanced:
+                self.filter(pk__in=[row.pk for row in advanced], status__in=sources).update(status=target)
+                for row in advanced:
+                    row.status = target
+                CallbackOutbox.objects.enqueue_many(advanced, company=company)
+        return rows, {row.pk for row in advanced}
+
+    def outstanding_total(self, user):
+        """
+        Сколько спишут с баланса пользователя еще не оплаченные заявки
+        (та же формула, что в set_payed_and_deduct_balance). Заявки отправляемых
+        пакетов уже списаны с баланса и не учитываются.
+        """
+        charge = ExpressionWrapper(
+            Coalesce('deduction_amount', Value(Decimal('0'))) + F('commission') * Value(Decimal('0.01')),
+            output_field=models.DecimalField(max_digits=30, decimal_places=8),
+        )
+        total = self.filter(
+            user=user, status__in=(WithdrawalRequest.CREATED, WithdrawalRequest.PROCESSING)
+        ).exclude(payout_batch__status=PayoutBatch.SENDING).aggregate(total=Sum(charge))['total']
+        return total or Decimal('0')
+
+
 class WithdrawalRequest(models.Model):
+    CREATED = 'created'
+    PROCESSING = 'processing'
+    PAYED = 'payed'
+    CANCELLED = 'cancelled'
+
+    # Статус -> из каких статусов в него можно перейти
+    TRANSITIONS = {
+        PROCESSING: (CREATED,),
+        CANCELLED: (CREATED,),
+        PAYED: (PROCESSING,),
+    }
+
     PAYMENT_METHOD_CHOICES = [
         ('LZTMARKET', 'LZTMARKET'),
         ('BITCOIN', 'BITCOIN'),
@@ -95,20 +269,205 @@ class WithdrawalRequest(models.Model):
     deduction_amount = models.DecimalField(max_digits=20, decimal_places=8, null=True, blank=True)
     currency = models.CharField(max_length=10, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=50, default='created')
+    status = models.CharField(max_length=50, default=CREATED)
+    # Пакет выплаты (api.payouts), в который попала заявка в статусе processing
+    payout_batch = models.ForeignKey('PayoutBatch', on_delete=models.SET_NULL, null=True, blank=True,
+                                     related_name='withdrawals')
+
+    objects = WithdrawalRequestQuerySet.as_manager()
+
+    CALLBACK_OBJECT = 'withdrawal'
+
+    def callback_payload(self):
+        return {
+            "status": self.status,
+            "id": self.id,
+            "method": self.method,
+            "amount": float(self.amount),
+            "deduction_amount": float(self.deduction_amount) if self.deduction_amount is not None else None,
+            "subtract_from": self.subtract_from,
+            "currency": self.currency
+        }
+
+    def payment_total(self):
+        return (self.deduction_amount or 0) + (self.commission / Decimal('100'))
 
     def set_payed_and_deduct_balance(self):
-        if self.status == 'created':
-            total_deduction = self.deduction_amount + (self.commission / Decimal('100'))
-            if self.user.balance >= total_deduction:
-                self.user.balance -= total_deduction
-                self.user.save()
-                self.status = 'payed'
-                self.save()
-            else:
+        """
+        Переводит заявку из processing в payed и списывает сумму с баланса
+        пользователя. Оба изменения - условные UPDATE в одной транзакции:
+        повторный или параллельный вызов не спишет баланс дважды.
+        """
+        total_deduction = self.payment_total()
+        with transaction.atomic():
+            # Заявку из пакета выплатит api.payouts
+            if not WithdrawalRequest.objects.filter(payout_batch__isnull=True).transition(self.pk, self.PAYED):
+                raise ValueError("Withdrawal request cannot be paid in its current status")
+            deducted = User.objects.filter(pk=self.user_id, balance__gte=total_deduction).update(
+                balance=models.F('balance') - total_deduction
+            )
+            if not deducted:
                 raise ValueError("Insufficient balance to pay the withdrawal request")
+            self.status = self.PAYED
+            CallbackOutbox.objects.enqueue(self, company=self.company)
+        self.user.refresh_from_db(fields=['balance'])
 
     def __str__(self):
         return f"{self.user.email} - {self.amount} {self.amount_currency} - {self.method}"
 
 
+
+
+class CallbackOutboxQuerySet(models.QuerySet):
+    def enqueue(self, instance, company=None):
+        """
+        Ставит callback о текущем статусе объекта в очередь. Вызывается в той же
+        транзакции, что и смена статуса: событие появится только вместе с ней.
+        """
+        entry = self._entry(instance, company)
+        if entry is None:
+            return None
+        entry.save(force_insert=True, using=self.db)
+        return entry
+
+    def enqueue_many(self, instances, company=None):
+        """
+        То же для многих объектов одним INSERT.
+        """
+        entries = [entry for entry in (self._entry(instance, company) for instance in instances) if entry is not None]
+        return self.bulk_create(entries)
+
+    def _entry(self, instance, company):
+        if not instance.callback_url:
+            return None
+        payload = instance.callback_payload()
+        batched = company is not None and company.callback_batching
+        return self.model(
+            company=company,
+            user_id=instance.user_id,
+            event=f"{instance.CALLBACK_OBJECT}.{payload['status']}",
+            object_type=instance.CALLBACK_OBJECT,
+            object_id=str(instance.pk),
+            url=instance.callback_url,
+            payload=payload,
+            batched=batched,
+            next_attempt_at=self.batch_window_end() if batched else timezone.now(),
+        )
+
+    @staticmethod
+    def batch_window_end(now=None):
+        """
+        Конец текущего окна накопления. Окна выровнены по времени, поэтому все события
+        окна становятся готовыми одновременно и уходят одним пакетом.
+        """
+        now = now or timezone.now()
+        window = settings.CALLBACK_OUTBOX['BATCH_WINDOW']
+        return datetime.fromtimestamp((now.timestamp() // window + 1) * window, tz=dt_timezone.utc)
+
+    def release_full_batches(self, now=None):
+        """
+        Делает готовыми накопленные пакеты, набравшие BATCH_MAX_SIZE событий, не дожидаясь
+        конца окна. Возвращает число затронутых записей.
+        """
+        now = now or timezone.now()
+        config = settings.CALLBACK_OUTBOX
+        waiting = self.filter(
+            status=CallbackOutbox.PENDING,
+            batched=True,
+            next_attempt_at__gt=now,
+            next_attempt_at__lte=now + timedelta(seconds=config['BATCH_WINDOW']),
+        )
+        full = waiting.values('company_id', 'url').annotate(events=Count('id')).filter(
+            events__gte=config['BATCH_MAX_SIZE']
+        )
+        lookup = Q()
+        for group in full:
+            lookup |= Q(company_id=group['company_id'], url=group['url'])
+        if not lookup:
+            return 0
+        return waiting.filter(lookup).update(next_attempt_at=now)
+
+    def due(self, now=None):
+        """
+        Готовые к отправке записи. Событие объекта ждет, пока более ранние события
+        того же объекта не будут доставлены или не попадут в dead, чтобы мерчант
+        получал статусы в порядке их смены.
+        """
+        earlier = CallbackOutbox.objects.filter(
+            status=CallbackOutbox.PENDING,
+            object_type=OuterRef('object_type'),
+            object_id=OuterRef('object_id'),
+            pk__lt=OuterRef('pk'),
+        )
+        return self.filter(
+            status=CallbackOutbox.PENDING, next_attempt_at__lte=now or timezone.now()
+        ).exclude(Exists(earlier))
+
+
+class CallbackOutbox(models.Model):
+    PENDING = 'pending'
+    DELIVERED = 'delivered'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (DELIVERED, 'Delivered'),
+        (DEAD, 'Dead'),
+    ]
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    event = models.CharField(max_length=50)
+    object_type = models.CharField(max_length=20)
+    object_id = models.CharField(max_length=64)
+    url = models.URLField(max_length=500)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    # Событие компании с пакетной доставкой: уходит в массиве вместе с другими по тому же url
+    batched = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    objects = CallbackOutboxQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+            # Проверка в due(), что по объекту нет более ранней недоставленной записи
+            models.Index(fields=['object_type', 'object_id', 'status']),
+        ]
+
+    def __str__(self):
+        return f"{self.event} {self.object_id} -> {self.url} ({self.status})"
+
+
+class PayoutBatch(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SETTLED = 'settled'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SETTLED, 'Settled'),
+        (FAILED, 'Failed'),
+    ]
+
+    method = models.CharField(max_length=50, choices=WithdrawalRequest.PAYMENT_METHOD_CHOICES)
+    currency = models.CharField(max_length=10, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    size = models.PositiveIntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=20, decimal_places=8, default=0)
+    provider_reference = models.CharField(max_length=255, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    settled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.method} {self.currency or ''} x{self.size} ({self.status})"
+
@@ -0,0 +1,243 @@
+"""
+Batched payouts of confirmed withdrawal requests.
+
+Requests in 'processing' are grouped by method and currency. A group becomes
+a PayoutBatch once it has MAX_SIZE requests or its oldest request has waited
+MAX_AGE seconds (PAYOUT_BATCHING, with per-method overrides). Each batch is
+sent through the PayoutProvider configured for its method as one provider
+call, and then settled in one transaction: all requests become 'payed' and
+the callbacks are queued.
+
+Before the provider call the batch is marked 'sending' and its amount is
+debited from the locked user rows, only where the balance covers it, so
+parallel batches of one user (e.g. BTC and ETH) cannot overdraw it. If the
+worker dies between the call and settlement the batch stays 'sending' (with
+its amount debited) and must be reconciled with the provider by hand; it is
+never resent automatically, so a crash cannot pay twice. A batch the provider
+rejects is refunded, marked 'failed' and its requests return to the pool for
+the next run.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from AralashAPI.metrics import metrics
+from user.models import User
+
+from .models import CallbackOutbox, PayoutBatch, WithdrawalRequest
+
+logger = logging.getLogger(__name__)
+
+
+class PayoutError(Exception):
+    pass
+
+
+class PayoutProvider:
+    """
+    Интерфейс провайдера выплат. send_batch выплачивает все заявки пакета одной
+    операцией и возвращает ее идентификатор у провайдера; при отказе - PayoutError.
+    batch.pk стоит передавать провайдеру как ключ идемпотентности.
+    """
+
+    def send_batch(self, batch, withdrawals):
+        raise NotImplementedError
+
+
+class FakePayoutProvider(PayoutProvider):
+    """
+    Локальный провайдер для тестов и разработки: ничего не отправляет,
+    запоминает пакеты и может имитировать отказ.
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def send_batch(self, batch, withdrawals):
+        if self.fail:
+            raise PayoutError('Provider rejected the batch')
+        self.batches.append((batch.pk, [withdrawal.pk for withdrawal in withdrawals]))
+        return f'fake-{batch.pk}'
+
+
+def batch_limits(method):
+    config = settings.PAYOUT_BATCHING
+    override = config['METHODS'].get(method, {})
+    return override.get('MAX_SIZE', config['MAX_SIZE']), override.get('MAX_AGE', config['MAX_AGE'])
+
+
+def load_providers():
+    return {method: import_string(path)() for method, path in settings.PAYOUT_BATCHING['PROVIDERS'].items()}
+
+
+def _unbatched(method, currency):
+    return WithdrawalRequest.objects.filter(
+        status=WithdrawalRequest.PROCESSING, payout_batch__isnull=True, method=method, currency=currency
+    )
+
+
+def form_batches(methods, now=None):
+    """
+    Собирает готовые пакеты для методов из methods. Группа готова, если в ней не
+    меньше MAX_SIZE заявок или самая старая создана раньше now - MAX_AGE.
+    Возвращает созданные PayoutBatch.
+    """
+    now = now or timezone.now()
+    groups = WithdrawalRequest.objects.filter(
+        status=WithdrawalRequest.PROCESSING, payout_batch__isnull=True, method__in=methods
+    ).values('method', 'currency').annotate(count=Count('id'), oldest=Min('created_at')).order_by('method', 'currency')
+
+    batches = []
+    for group in groups:
+        max_size, max_age = batch_limits(group['method'])
+        full, rest = divmod(group['count'], max_size)
+        if rest and group['oldest'] <= now - timedelta(seconds=max_age):
+            full += 1
+        for _ in range(full):
+            batch = _claim_batch(group['method'], group['currency'], max_size)
+            if batch is None:
+                break
+            batches.append(batch)
+    return batches
+
+
+def _claim_batch(method, currency, max_size):
+    # Самые старые заявки группы; занятые параллельным запуском пропускаются
+    with transaction.atomic():
+        ids = list(
+            _unbatched(method, currency).select_for_update(skip_locked=True).order_by('created_at', 'id')
+            .values_list('pk', flat=True)[:max_size]
+        )
+        if not ids:
+            return None
+        batch = PayoutBatch.objects.create(method=method, currency=currency)
+        claimed = _unbatched(method, currency).filter(pk__in=ids).update(payout_batch=batch)
+        totals = batch.withdrawals.aggregate(total=models.Sum('amount'))
+        batch.size = claimed
+        batch.total_amount = totals['total'] or 0
+        batch.save(update_fields=['size', 'total_amount'])
+    return batch
+
+
+def _reserve(batch):
+    """
+    Забирает пакет из pending и резервирует сумму заявок на балансах: строки
+    пользователей блокируются, списание условное (balance >= суммы), как в
+    set_payed_and_deduct_balance. Заявки пользователей, чей баланс ее не покрывает,
+    возвращаются в очередь. Возвращает (заявки, {user_id: сумма}) или None, если
+    пакет уже забрал другой запуск.
+    """
+    with transaction.atomic():
+        # Пакет забирает тот, кто первым переведет его из pending
+        if not PayoutBatch.objects.filter(pk=batch.pk, status=PayoutBatch.PENDING).update(status=PayoutBatch.SENDING):
+            return None
+        withdrawals = list(batch.withdrawals.select_related('company').order_by('id'))
+        totals = defaultdict(int)
+        for withdrawal in withdrawals:
+            totals[withdrawal.user_id] += withdrawal.payment_total()
+        # Блокировки в порядке pk, чтобы параллельные пакеты не ждали друг друга по кругу
+        list(User.objects.select_for_update().filter(pk__in=totals).order_by('pk').values_list('pk', flat=True))
+        reserved = {
+            user_id: amount for user_id, amount in totals.items()
+            if User.objects.filter(pk=user_id, balance__gte=amount).update(balance=models.F('balance') - amount)
+        }
+        uncovered = [withdrawal.pk for withdrawal in withdrawals if withdrawal.user_id not in reserved]
+        if uncovered:
+            logger.warning('Payout batch %s: %s requests skipped, insufficient balance', batch.pk, len(uncovered))
+            WithdrawalRequest.objects.filter(pk__in=uncovered).update(payout_batch=None)
+    return [withdrawal for withdrawal in withdrawals if withdrawal.user_id in reserved], reserved
+
+
+def _refund(reserved):
+    for user_id, amount in reserved.items():
+        User.objects.filter(pk=user_id).update(balance=models.F('balance') + amount)
+
+
+def execute_batch(batch, provider):
+    """
+    Выплачивает пакет через провайдера и проводит его. Сумма заявок списывается
+    с балансов до вызова провайдера (_reserve) и возвращается, если провайдер
+    отказал. Возвращает True, если пакет проведен.
+    """
+    reservation = _reserve(batch)
+    if reservation is None:
+        return False
+    withdrawals, reserved = reservation
+    if not withdrawals:
+        _fail(batch, 'Insufficient balance for every request in the batch')
+        return False
+
+    batch.status = PayoutBatch.SENDING
+    batch.size = len(withdrawals)
+    batch.total_amount = sum(withdrawal.amount for withdrawal in withdrawals)
+    batch.save(update_fields=['size', 'total_amount'])
+    try:
+        reference = provider.send_batch(batch, withdrawals)
+    except PayoutError as e:
+        logger.warning('Payout batch %s failed: %s', batch.pk, e)
+        with transaction.atomic():
+            _refund(reserved)
+            WithdrawalRequest.objects.filter(payout_batch=batch).update(payout_batch=None)
+            _fail(batch, str(e))
+        return False
+
+    settle_batch(batch, withdrawals, reference)
+    return True
+
+
+def _fail(batch, error):
+    batch.status = PayoutBatch.FAILED
+    batch.error = error[:1000]
+    batch.save(update_fields=['status', 'error'])
+    metrics.inc('payout_batches_total', method=batch.method, result='failed')
+
+
+def settle_batch(batch, withdrawals, reference):
+    """
+    Проводит выплаченный пакет одной транзакцией: заявки processing -> payed,
+    callback-и и статус пакета. Балансы уже списаны в _reserve.
+    """
+    for withdrawal in withdrawals:
+        withdrawal.status = WithdrawalRequest.PAYED
+    with transaction.atomic():
+        payed = WithdrawalRequest.objects.filter(
+            pk__in=[withdrawal.pk for withdrawal in withdrawals], payout_batch=batch,
+            status__in=WithdrawalRequest.TRANSITIONS[WithdrawalRequest.PAYED],
+        ).update(status=WithdrawalRequest.PAYED)
+        if payed != len(withdrawals):
+            # Заявки пакета вручную не проводятся, так что это требует сверки с провайдером
+            logger.error('Payout batch %s: %s of %s requests changed status while sending',
+                         batch.pk, len(withdrawals) - payed, len(withdrawals))
+        by_company = defaultdict(list)
+        for withdrawal in withdrawals:
+            by_company[withdrawal.company_id].append(withdrawal)
+        for company_withdrawals in by_company.values():
+            CallbackOutbox.objects.enqueue_many(company_withdrawals, company=company_withdrawals[0].company)
+        batch.status = PayoutBatch.SETTLED
+        batch.provider_reference = reference
+        batch.settled_at = timezone.now()
+        batch.save(update_fields=['status', 'provider_reference', 'settled_at'])
+    metrics.inc('payout_batches_total', method=batch.method, result='settled')
+    metrics.inc('payout_withdrawals_total', len(withdrawals), method=batch.method)
+
+
+def run_payouts(providers=None, now=None):
+    """
+    Один проход: собирает готовые пакеты и выплачивает все ожидающие, в том числе
+    оставшиеся в pending после прерванного запуска.
+    providers - {метод: PayoutProvider}, по умолчанию из PAYOUT_BATCHING['PROVIDERS'].
+    Возвращает список обработанных пакетов.
+    """
+    providers = load_providers() if providers is None else providers
+    form_batches(list(providers), now)
+    batches = list(PayoutBatch.objects.filter(status=PayoutBatch.PENDING, method__in=list(providers)).order_by('id'))
+    for batch in batches:
+        execute_batch(batch, providers[batch.method])
+    return batches
@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 from .models import PaymentMethod, Invoice, Withdrawal,WithdrawalRequest
@@ -30,24 +31,56 @@ class WithdrawalRequestSerializer(serializers.ModelSerializer):
             'receive_amount', 'deduction_amount', 'currency'
         ]
         read_only_fields = ['commission', 'rub_amount', 'receive_amount', 'deduction_amount', 'currency']
+        extra_kwargs = {
+            'auth_login': {'required': False},
+            'auth_secret': {'required': False},
+        }
 
 class ConfirmWithdrawalRequestSerializer(serializers.Serializer):
-    auth_login = serializers.CharField()
-    auth_secret = serializers.CharField()
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
     id = serializers.CharField()
 
 class CancelWithdrawalRequestSerializer(serializers.Serializer):
-    auth_login = serializers.CharField()
-    auth_secret = serializers.CharField()
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
     id = serializers.CharField()
 
 
 class GetWithdrawalRequestSerializer(serializers.Serializer):
-    auth_login = serializers.CharField()
-    auth_secret = serializers.CharField()
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
     id = serializers.CharField()
 
 
+class WithdrawalBatchSerializer(serializers.Serializer):
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False,
+        max_length=settings.WITHDRAWAL_BATCH['MAX_IDS'],
+    )
+
+    def validate_ids(self, value):
+        # Повторы не нужны ни в выборке, ни в квоте
+        return list(dict.fromkeys(value))
+
+
+class MassPayoutSerializer(serializers.Serializer):
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
+    payouts = WithdrawalRequestSerializer(
+        many=True, allow_empty=False, max_length=settings.WITHDRAWAL_BATCH['MAX_PAYOUTS'],
+    )
+
+
+class CallbackSettingsSerializer(serializers.Serializer):
+    auth_login = serializers.CharField(required=False)
+    auth_secret = serializers.CharField(required=False)
+    batching = serializers.BooleanField(required=False)
+    rotate_secret = serializers.BooleanField(default=False)
+
+
 class WithdrawalSerializer(serializers.ModelSerializer):
     class Meta:
         model = Withdrawal
@@ -0,0 +1,80 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from user.models import Company, Subscription, User, UserCompanyRelation
+from .models import APIKey
+from .utils import invalidate_company_credentials, invalidate_user_credentials
+
+
+def _invalidate_company(company_id):
+    # Второй сброс после коммита убирает записи, закэшированные по еще не зафиксированным данным
+    invalidate_company_credentials(company_id)
+    transaction.on_commit(lambda: invalidate_company_credentials(company_id))
+
+
+@receiver([post_save, post_delete], sender=APIKey)
+def invalidate_api_key_credentials(sender, instance, **kwargs):
+    _invalidate_company(instance.company_id)
+
+
+@receiver([post_save, post_delete], sender=UserCompanyRelation)
+def invalidate_relation_credentials(sender, instance, **kwargs):
+    _invalidate_company(instance.company_id)
+
+
+@receiver(post_delete, sender=UserCompanyRelation)
+def deactivate_relation_keys(sender, instance, **kwargs):
+    # Ключи нового формата привязаны к сотруднику и проверяются без связи с компанией
+    APIKey.objects.filter(company_id=instance.company_id, user_id=instance.user_id).update(is_active=False)
+
+
+@receiver([post_save, post_delete], sender=Company)
+def invalidate_company_instance_credentials(sender, instance, **kwargs):
+    _invalidate_company(instance.pk)
+
+
+@receiver([post_save, pre_delete], sender=Subscription)
+def invalidate_subscription_credentials(sender, instance, **kwargs):
+    # Закэшированные компании держат лимиты подписки
+    for company_id in Company.objects.filter(subscription_id=instance.pk).values_list('id', flat=True):
+        _invalidate_company(company_id)
+
+
+# Поля пользователя, от которых зависит проверка ключа
+USER_CREDENTIAL_FIELDS = ('email', 'is_active')
+
+
+def _user_credentials_changed(instance):
+    """
+    Сравнивает email и is_active с загруженными из БД (User._loaded_values).
+    Незагруженное поле не сохраняется и не меняется; поле, присвоенное без
+    загрузки, считается измененным.
+    """
+    loaded = getattr(instance, '_loaded_values', {})
+    return any(
+        name in instance.__dict__ and (name not in loaded or loaded[name] != instance.__dict__[name])
+        for name in USER_CREDENTIAL_FIELDS
+    )
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user_instance_credentials(sender, instance, update_fields=None, created=False, **kwargs):
+    if created:
+        return
+    if kwargs['signal'] is post_save:
+        # Баланс и прочие поля на проверку ключа не влияют
+        changed = _user_credentials_changed(instance) and (
+            update_fields is None or bool(set(USER_CREDENTIAL_FIELDS) & set(update_fields))
+        )
+        instance._loaded_values = {
+            **getattr(instance, '_loaded_values', {}),
+            **{name: instance.__dict__[name] for name in USER_CREDENTIAL_FIELDS if name in instance.__dict__},
+        }
+        if not changed:
+            return
+    company_ids = list(
+        UserCompanyRelation.objects.filter(user_id=instance.pk).values_list('company_id', flat=True)
+    )
+    invalidate_user_credentials(instance.pk, company_ids)
+    transaction.on_commit(lambda: invalidate_user_credentials(instance.pk, company_ids))
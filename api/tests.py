@@ -1,10 +1,46 @@
 # tests.py
+import asyncio
+import hashlib
+import hmac
+import json
+import socket
+import tempfile
+import threading
+import time
 import uuid
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlsplit
+from io import StringIO
 
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.test import APITestCase, APIClient, APIRequestFactory
 from rest_framework import status
-from .models import APIKey, User, APIKey, Invoice, Withdrawal
+from AralashAPI.metrics import metrics
+from AralashAPI.resilience import CircuitOpenError, breaker_for, reset_breakers
+from AralashAPI.middleware import CRITICAL, LOW, NORMAL, LoadShedder, classify, parse_request_start
+from user.models import BusinessType, Company, MonthlyCompanyStatistics, Subscription, UserCompanyRelation
+from .authentication import MerchantTokenAuthentication
+from .concurrency import CompanySlots, company_slots
+from .dispatcher import CallbackDispatcher, LeaseExpired, run_dispatcher
+from .payouts import FakePayoutProvider, execute_batch, form_batches, run_payouts
+from .throttling import THROTTLE_CACHE_KEY, TokenBucketStore, bucket_store
+from .callbacks import deliver_due
+from .models import APIKey, User, APIKey, CallbackOutbox, Invoice, PayoutBatch, Withdrawal, WithdrawalRequest
+from .tokens import issue_merchant_token, read_merchant_token
+from .utils import KEY_GENERATION_CACHE_KEY, credential_cache, load_merchant_context, verify_key
 
 
 class APITests(APITestCase):
@@ -353,4 +389,1064 @@ class GeneralStatisticsAPITests(APITestCase):
         print("Response Data:", response.data)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
         self.assertIn('error', response.data)
-        self.assertEqual(response.data['error'], 'Invalid auth_login or auth_secret')
\ No newline at end of file
+        self.assertEqual(response.data['error'], 'Invalid auth_login or auth_secret')
+
+class MerchantFixtureMixin:
+    """
+    Пользователь с верифицированной компанией и API-ключом. С key_headers клиент
+    отправляет ключ в заголовках API-Login/API-Key; с shared_cache кэш Django
+    файловый, как общий кэш воркеров (иначе поколения ключей читаются из БД).
+    """
+    subscription_name = 'BASIC'
+    max_requests_per_month = 100
+    key_headers = True
+    shared_cache = False
+
+    def setUp(self):
+        if self.shared_cache:
+            location = tempfile.TemporaryDirectory()
+            self.addCleanup(location.cleanup)
+            shared = override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location.name,
+            }})
+            shared.enable()
+            self.addCleanup(shared.disable)
+        cache.clear()
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+        credential_cache.clear()
+        self.user = User.objects.create_user(username='merchant', email='merchant@example.com', password='password')
+        business_type = BusinessType.objects.create(name='IT', code='IT')
+        self.subscription = Subscription.objects.create(name=self.subscription_name,
+                                                        max_requests_per_month=self.max_requests_per_month)
+        self.company = Company.objects.create(name='Shop', business_type=business_type, registration_number='REG-1',
+                                              address='Bishkek', subscription=self.subscription)
+        UserCompanyRelation.objects.create(user=self.user, company=self.company, is_verified=True)
+        self.api_key, self.raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        if self.key_headers:
+            self.client.credentials(HTTP_API_LOGIN=self.user.email, HTTP_API_KEY=self.raw_key)
+
+
+class VerifyKeyCacheTests(MerchantFixtureMixin, APITestCase):
+    key_headers = False
+    shared_cache = True
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def test_cached_credentials_skip_database(self):
+        is_valid, user, company = verify_key(self.user.email, self.raw_key)
+        self.assertTrue(is_valid)
+        with self.assertNumQueries(0):
+            is_valid, user, company = verify_key(self.user.email, self.raw_key)
+        self.assertTrue(is_valid)
+        self.assertEqual(company, self.company)
+
+    def test_cached_instances_are_not_shared(self):
+        verify_key(self.user.email, self.raw_key)
+        _, user, company = verify_key(self.user.email, self.raw_key)
+        company.callback_batching = True
+        user.balance = 1000
+        _, other_user, other_company = verify_key(self.user.email, self.raw_key)
+        self.assertIsNot(other_company, company)
+        self.assertFalse(other_company.callback_batching)
+        self.assertEqual(other_user.balance, 0)
+
+    def test_invalid_secret_is_cached(self):
+        self.assertFalse(verify_key(self.user.email, str(uuid.uuid4()))[0])
+        self.assertFalse(verify_key(self.user.email, 'invalid_key')[0])
+        with self.assertNumQueries(0):
+            self.assertFalse(verify_key(self.user.email, 'invalid_key')[0])
+
+    def test_deactivated_key_stops_working(self):
+        self.assertTrue(verify_key(self.user.email, self.raw_key)[0])
+        response = self.client.post(reverse('deactivate_key'), {'key': self.raw_key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(verify_key(self.user.email, self.raw_key)[0])
+
+    def test_removed_relation_stops_working(self):
+        self.assertTrue(verify_key(self.user.email, self.raw_key)[0])
+        UserCompanyRelation.objects.filter(user=self.user).delete()
+        self.assertFalse(verify_key(self.user.email, self.raw_key)[0])
+
+
+class MerchantContextTests(MerchantFixtureMixin, APITestCase):
+    max_requests_per_month = 2
+    key_headers = False
+    shared_cache = True
+
+    def setUp(self):
+        super().setUp()
+        self.inactive_key, self.inactive_raw_key = APIKey.objects.create_key(company=self.company, user=self.user,
+                                                                             is_active=False)
+
+    def test_context_is_loaded_in_one_query(self):
+        with self.assertNumQueries(1):
+            context = load_merchant_context(self.user.email, self.raw_key)
+            self.assertEqual(context.api_key_id, self.api_key.id)
+            self.assertEqual(context.requests_limit, 2)
+            self.assertIsNone(context.company_requests_made)
+        self.assertEqual(context.consume_requests(), (True, 1))
+        with self.assertNumQueries(0):
+            context = load_merchant_context(self.user.email, self.raw_key)
+        with self.assertNumQueries(1):
+            context = context.with_usage()
+        self.assertEqual(context.company_requests_made, 1)
+        self.assertEqual(context.user_requests_made, 1)
+        self.assertEqual(context.requests_remaining(), 1)
+
+    def test_inactive_key_is_rejected(self):
+        self.assertIsNone(load_merchant_context(self.user.email, self.inactive_raw_key))
+
+    def test_withdrawal_request_respects_quota(self):
+        self.client.force_authenticate(self.user)
+        data = {
+            'auth_login': self.user.email,
+            'auth_secret': self.raw_key,
+            'amount': '10.00',
+            'method': 'BITCOIN',
+            'wallet': 'wallet',
+            'subtract_from': 'balance',
+        }
+        for expected in (status.HTTP_201_CREATED, status.HTTP_201_CREATED, status.HTTP_400_BAD_REQUEST):
+            response = self.client.post(reverse('withdrawal_request'), data, format='json')
+            self.assertEqual(response.status_code, expected)
+        # Отклоненный запрос не списывается
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 2)
+
+
+class MerchantTokenTests(MerchantFixtureMixin, APITestCase):
+    subscription_name = 'PREMIUM'
+    key_headers = False
+    shared_cache = True
+
+    def setUp(self):
+        super().setUp()
+        response = self.client.post(reverse('merchant_token'), {
+            'auth_login': self.user.email,
+            'auth_secret': self.raw_key,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.token = response.data['token']
+
+    def test_token_is_verified_without_database(self):
+        request = APIRequestFactory().post('/', HTTP_AUTHORIZATION=f'Merchant {self.token}')
+        with self.assertNumQueries(0):
+            user, context = MerchantTokenAuthentication().authenticate(request)
+            self.assertEqual(context.company.pk, self.company.pk)
+            self.assertEqual(context.subscription.name, 'PREMIUM')
+            self.assertEqual(user.email, self.user.email)
+
+    def test_token_authenticates_merchant_endpoint(self):
+        Invoice.objects.create(user=self.user, amount=100, amount_currency='USD', type='purchase', lifetime=60)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Merchant {self.token}')
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    def test_regenerated_key_revokes_token(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('regenerate_key'), {'key': self.raw_key})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.client.force_authenticate(None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Merchant {self.token}')
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revocation_survives_cache_eviction(self):
+        generation_key = KEY_GENERATION_CACHE_KEY.format(self.company.pk)
+        cache.delete(generation_key)
+        token = issue_merchant_token(load_merchant_context(self.user.email, self.raw_key))
+        self.api_key.is_active = False
+        self.api_key.save()
+        cache.delete(generation_key)
+        self.assertIsNone(read_merchant_token(token))
+
+    def test_local_cache_does_not_delay_revocation(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertIsNotNone(read_merchant_token(self.token))
+            # Сброс в другом воркере: его локальный кэш этому процессу не виден
+            Company.objects.filter(pk=self.company.pk).update(key_generation=F('key_generation') + 1)
+            self.assertIsNone(read_merchant_token(self.token))
+
+    def test_balance_top_up_keeps_token(self):
+        self.client.force_authenticate(User.objects.get(pk=self.user.pk))
+        response = self.client.post(reverse('balance_topup'), {'amount': '10.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(read_merchant_token(self.token))
+        self.client.force_authenticate(None)
+
+        # Пользователь из JWT загружает email и is_active только при сохранении
+        response = self.client.post(reverse('token_obtain_pair'), {'email': self.user.email, 'password': 'password'})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {response.data["access"]}')
+        response = self.client.post(reverse('balance_topup'), {'amount': '10.00'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Merchant {self.token}')
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user = User.objects.get(pk=self.user.pk)
+        user.email = 'new@example.com'
+        user.save()
+        self.assertIsNone(read_merchant_token(self.token))
+
+    def test_tampered_token_is_rejected(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Merchant {self.token[:-2]}xx')
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class APIKeyHeaderAuthenticationTests(MerchantFixtureMixin, APITestCase):
+    key_headers = False
+
+    def test_header_credentials_authenticate(self):
+        Invoice.objects.create(user=self.user, amount=100, amount_currency='USD', type='purchase', lifetime=60)
+        self.client.credentials(HTTP_API_LOGIN=self.user.email, HTTP_API_KEY=self.raw_key)
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    def test_invalid_header_is_rejected_before_body_parsing(self):
+        self.client.credentials(HTTP_API_LOGIN=self.user.email, HTTP_API_KEY=str(uuid.uuid4()))
+        response = self.client.generic('POST', reverse('payment-history'), '{not json', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_missing_login_header_is_rejected(self):
+        self.client.credentials(HTTP_API_KEY=self.raw_key)
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_body_credentials_still_supported(self):
+        response = self.client.post(reverse('payment-history'), {
+            'auth_login': self.user.email,
+            'auth_secret': self.raw_key,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+
+class HashedAPIKeyTests(MerchantFixtureMixin, APITestCase):
+    key_headers = False
+
+    def test_raw_key_is_not_stored(self):
+        api_key, raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        self.assertTrue(raw_key.startswith(api_key.display_prefix))
+        self.assertNotIn(raw_key.split('_', 2)[2], api_key.secret_hash)
+        self.assertIsNone(api_key.key)
+        self.assertTrue(api_key.check_secret(raw_key))
+        self.assertFalse(api_key.check_secret(raw_key[:-1] + 'x'))
+
+    def test_new_key_is_resolved_by_primary_key(self):
+        api_key, raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        with self.assertNumQueries(1):
+            context = load_merchant_context(self.user.email, raw_key)
+        self.assertEqual(context.api_key_id, api_key.pk)
+        self.assertIsNone(load_merchant_context(self.user.email, raw_key[:-1] + 'x'))
+
+    def test_legacy_key_survives_hashing(self):
+        legacy_key = APIKey.objects.create(company=self.company, key=uuid.uuid4())
+        raw_key = str(legacy_key.key)
+        self.assertIsNotNone(load_merchant_context(self.user.email, raw_key))
+        call_command('hash_legacy_api_keys', stdout=StringIO())
+        credential_cache.clear()
+        legacy_key.refresh_from_db()
+        self.assertIsNone(legacy_key.key)
+        self.assertIsNotNone(load_merchant_context(self.user.email, raw_key))
+        self.assertIsNotNone(load_merchant_context(self.user.email, raw_key.upper()))
+
+    def test_removed_relation_deactivates_owned_keys(self):
+        api_key, raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        UserCompanyRelation.objects.filter(user=self.user, company=self.company).delete()
+        api_key.refresh_from_db()
+        self.assertFalse(api_key.is_active)
+        self.assertIsNone(load_merchant_context(self.user.email, raw_key))
+
+
+THROTTLE_PLANS = {
+    'DEFAULT_PLAN': 'FREE',
+    'PLANS': {
+        'FREE': {'key': {'RATE': 1, 'BURST': 2}, 'company': {'RATE': 1, 'BURST': 3}},
+    },
+}
+
+
+@override_settings(MERCHANT_THROTTLE=THROTTLE_PLANS)
+class MerchantBurstThrottleTests(MerchantFixtureMixin, APITestCase):
+    subscription_name = 'FREE'
+    shared_cache = True
+
+    def test_burst_is_rejected_with_headers(self):
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['RateLimit-Limit'], '2')
+        self.assertEqual(response['RateLimit-Remaining'], '1')
+        self.client.post(reverse('payment-history'), {}, format='json')
+
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response['RateLimit-Remaining'], '0')
+
+    def test_company_bucket_is_shared_between_keys(self):
+        _, other_raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        for raw_key in (self.raw_key, self.raw_key, other_raw_key):
+            self.client.credentials(HTTP_API_LOGIN=self.user.email, HTTP_API_KEY=raw_key)
+            response = self.client.post(reverse('payment-history'), {}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_company_rejection_does_not_charge_key(self):
+        _, other_raw_key = APIKey.objects.create_key(company=self.company, user=self.user)
+        with mock.patch('api.throttling.time.time', return_value=1000.0):
+            for raw_key, expected in ((self.raw_key, status.HTTP_200_OK), (other_raw_key, status.HTTP_200_OK),
+                                      (other_raw_key, status.HTTP_200_OK), (self.raw_key, 429)):
+                self.client.credentials(HTTP_API_LOGIN=self.user.email, HTTP_API_KEY=raw_key)
+                response = self.client.post(reverse('payment-history'), {}, format='json')
+                self.assertEqual(response.status_code, expected)
+            # У ключа остался один токен из двух
+            key = THROTTLE_CACHE_KEY.format('key', self.api_key.pk)
+            self.assertEqual(bucket_store.acquire(key, rate=1, burst=2)[:2], (True, 0))
+
+    def test_bucket_refills(self):
+        store = TokenBucketStore()
+        with mock.patch('api.throttling.time.time', return_value=1000.0):
+            self.assertTrue(store.acquire('bucket', rate=1, burst=2)[0])
+            self.assertTrue(store.acquire('bucket', rate=1, burst=2)[0])
+            allowed, remaining, reset, retry_after = store.acquire('bucket', rate=1, burst=2)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(retry_after, 1)
+        with mock.patch('api.throttling.time.time', return_value=1001.0):
+            self.assertTrue(store.acquire('bucket', rate=1, burst=2)[0])
+
+    def test_cache_failure_falls_back_to_process_memory(self):
+        store = TokenBucketStore()
+        with mock.patch('api.throttling.cache.get', side_effect=ConnectionError), \
+                mock.patch('api.throttling.cache.set', side_effect=ConnectionError), \
+                self.assertLogs('api.throttling', 'WARNING'):
+            self.assertTrue(store.acquire('bucket', rate=1, burst=1)[0])
+            self.assertFalse(store.acquire('bucket', rate=1, burst=1)[0])
+
+
+CONCURRENCY = {
+    'DEFAULT_PLAN': 'FREE',
+    'PLANS': {'FREE': 1},
+    'QUEUE_TIMEOUT': 0.05,
+    'POLL_INTERVAL': 0.01,
+    'LOCK_DIR': None,
+}
+
+
+@override_settings(MERCHANT_CONCURRENCY=CONCURRENCY)
+class CompanyConcurrencyTests(MerchantFixtureMixin, APITestCase):
+    subscription_name = 'FREE'
+
+    def setUp(self):
+        super().setUp()
+        self.lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.lock_dir.cleanup)
+        patcher = mock.patch.object(company_slots, 'directory', self.lock_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.slots = CompanySlots(self.lock_dir.name)
+
+    def test_slots_are_exclusive(self):
+        first = self.slots.acquire(self.company.pk, 2)
+        second = self.slots.acquire(self.company.pk, 2)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.slots.acquire(self.company.pk, 2, timeout=0.02))
+        self.assertEqual(self.slots.occupancy(), {self.company.pk: 2})
+        self.slots.release(first)
+        self.assertEqual(self.slots.occupancy(), {self.company.pk: 1})
+        self.slots.release(second)
+
+    def test_request_over_limit_gets_429(self):
+        held = self.slots.acquire(self.company.pk, 1)
+        try:
+            response = self.client.post(reverse('payment-history'), {}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn(f'merchant_inflight_requests{{company="{self.company.pk}"}} 1', metrics.render())
+            self.assertGreaterEqual(metrics.get('merchant_concurrency_rejected_total', company=self.company.pk), 1)
+        finally:
+            self.slots.release(held)
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_slot_is_released_after_response(self):
+        for _ in range(2):
+            response = self.client.post(reverse('payment-history'), {}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.slots.occupancy(), {self.company.pk: 0})
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_endpoint(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(METRICS_TOKEN=None):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer None')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(LOAD_SHEDDING={**settings.LOAD_SHEDDING, 'TRUST_REQUEST_START': True})
+class LoadSheddingTests(APITestCase):
+    def setUp(self):
+        patcher = mock.patch('AralashAPI.middleware.shedder', LoadShedder(target=0.1, interval=1, alpha=1))
+        self.shedder = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_low_priority_is_shed_after_interval(self):
+        self.shedder.observe(CRITICAL, 0.5, now=100)
+        self.assertTrue(self.shedder.admit(LOW, now=100))
+        self.shedder.observe(CRITICAL, 0.15, now=101)
+        self.assertFalse(self.shedder.admit(LOW, now=101.5))
+        self.assertTrue(self.shedder.admit(NORMAL, now=101.5))
+        self.shedder.observe(CRITICAL, 0.5, now=101.6)
+        self.assertFalse(self.shedder.admit(NORMAL, now=101.7))
+        self.assertTrue(self.shedder.admit(CRITICAL, now=101.7))
+
+    def test_signal_expires_without_traffic(self):
+        self.shedder.observe(CRITICAL, 0.5, now=100)
+        self.shedder.level(now=100)
+        self.assertEqual(self.shedder.level(now=100.5), 0)
+        self.assertEqual(self.shedder.level(now=102), 0)
+
+    def test_middleware_sheds_dashboard_but_not_merchant_routes(self):
+        self.shedder.interval = 0
+        started = f't={time.time() - 1:.3f}'
+        response = self.client.get(reverse('subscription-list'), HTTP_X_REQUEST_START=started)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        response = self.client.post(reverse('create-invoice'), {}, format='json', HTTP_X_REQUEST_START=started)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.shedder.inflight, {CRITICAL: 0, NORMAL: 0, LOW: 0})
+
+    def test_untrusted_or_implausible_request_start_is_ignored(self):
+        self.shedder.interval = 0
+        for started, trusted in (('t=1', True), (f't={time.time() + 60:.3f}', True), (f't={time.time() - 1:.3f}', False)):
+            with override_settings(LOAD_SHEDDING={**settings.LOAD_SHEDDING, 'TRUST_REQUEST_START': trusted}):
+                response = self.client.get(reverse('subscription-list'), HTTP_X_REQUEST_START=started)
+            self.assertNotEqual(response.status_code, 503, started)
+        self.assertEqual(self.shedder.delay, 0)
+
+    def test_merchant_routes_are_critical(self):
+        for url_name in ('mass_payout', 'confirm_withdrawals', 'cancel_withdrawals', 'get_withdrawals_info',
+                         'quota_status', 'callback_settings'):
+            self.assertEqual(classify(url_name), CRITICAL, url_name)
+
+    def test_parse_request_start(self):
+        self.assertEqual(parse_request_start('t=1700000000.5'), 1700000000.5)
+        self.assertEqual(parse_request_start('1700000000500'), 1700000000.5)
+        self.assertEqual(parse_request_start('t=1700000000500000'), 1700000000.5)
+        self.assertIsNone(parse_request_start('garbage'))
+
+
+class QuotaStatusTests(MerchantFixtureMixin, APITestCase):
+    max_requests_per_month = 10
+    shared_cache = True
+
+    def test_merchant_response_carries_quota_headers(self):
+        response = self.client.post(reverse('payment-history'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Quota-Limit'], '10')
+        self.assertEqual(response['X-Quota-Remaining'], '9')
+        self.assertGreater(int(response['X-Quota-Reset']), 0)
+
+    def test_status_is_served_from_cache(self):
+        self.client.post(reverse('payment-history'), {}, format='json')
+        self.client.post(reverse('payment-history'), {}, format='json')
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('quota_status'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['requests_made'], 2)
+        self.assertEqual(response.data['remaining'], 8)
+        self.assertEqual(response['X-Quota-Remaining'], '8')
+        # Опрос статуса квоту не списывает
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 2)
+
+    def test_status_loads_counters_on_cache_miss(self):
+        self.client.post(reverse('payment-history'), {}, format='json')
+        cache.clear()
+        response = self.client.get(reverse('quota_status'))
+        self.assertEqual(response.data['requests_made'], 1)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('quota_status'))
+        self.assertEqual(response.data['remaining'], 9)
+
+
+class FakeCallbackSession:
+    def __init__(self, fail_urls=()):
+        self.fail_urls = set(fail_urls)
+        self.sent = []
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.sent.append((url, json.loads(data), timeout, headers))
+        if url in self.fail_urls:
+            raise requests.ConnectionError('connection refused')
+        return mock.Mock(raise_for_status=mock.Mock())
+
+
+class CallbackFixtureMixin(MerchantFixtureMixin):
+    def create_withdrawal(self, callback_url='https://shop.example.com/callback'):
+        response = self.client.post(reverse('withdrawal_request'), {
+            'amount': '10.00',
+            'method': 'BITCOIN',
+            'wallet': 'wallet',
+            'subtract_from': 'balance',
+            'callback_url': callback_url,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['id']
+
+
+class CallbackOutboxTests(CallbackFixtureMixin, APITestCase):
+    def test_withdrawal_transitions_are_queued_without_network(self):
+        with mock.patch('requests.Session.post') as post:
+            withdrawal_id = self.create_withdrawal()
+            self.client.post(reverse('confirm_withdrawal'), {'id': withdrawal_id}, format='json')
+        post.assert_not_called()
+        events = list(CallbackOutbox.objects.order_by('id').values_list('event', 'object_id', 'status'))
+        self.assertEqual(events, [
+            ('withdrawal.created', str(withdrawal_id), CallbackOutbox.PENDING),
+            ('withdrawal.processing', str(withdrawal_id), CallbackOutbox.PENDING),
+        ])
+
+    def test_no_callback_url_no_event(self):
+        self.create_withdrawal(callback_url='')
+        self.assertFalse(CallbackOutbox.objects.exists())
+
+    def test_event_is_rolled_back_with_status_change(self):
+        withdrawal = WithdrawalRequest.objects.create(
+            user=self.user, company=self.company, amount=10, method='BITCOIN', wallet='w', subtract_from='balance',
+            callback_url='https://shop.example.com/callback',
+        )
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            withdrawal.status = 'cancelled'
+            withdrawal.save()
+            CallbackOutbox.objects.enqueue(withdrawal, company=self.company)
+            raise RuntimeError
+        self.assertFalse(CallbackOutbox.objects.exists())
+
+    def test_delivery_retries_with_backoff_then_dead_letters(self):
+        withdrawal_id = self.create_withdrawal()
+        session = FakeCallbackSession(fail_urls={'https://shop.example.com/callback'})
+        now = timezone.now()
+        with override_settings(CALLBACK_OUTBOX={**settings.CALLBACK_OUTBOX, 'MAX_ATTEMPTS': 2, 'BACKOFF_BASE': 10}), \
+                self.assertLogs('api.callbacks', 'WARNING'):
+            self.assertEqual(deliver_due(session=session, now=now), 1)
+            entry = CallbackOutbox.objects.get()
+            self.assertEqual((entry.status, entry.attempts), (CallbackOutbox.PENDING, 1))
+            self.assertGreaterEqual(entry.next_attempt_at, now + timedelta(seconds=8))
+            self.assertIn('connection refused', entry.last_error)
+            # До истечения паузы запись не берется повторно
+            self.assertEqual(deliver_due(session=session, now=now), 0)
+            self.assertEqual(deliver_due(session=session, now=now + timedelta(seconds=13)), 1)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), (CallbackOutbox.DEAD, 2))
+        self.assertEqual(session.sent[0][1]['id'], withdrawal_id)
+        self.assertEqual(session.sent[0][2], (3, 10))
+
+    def test_delivery_stops_before_lease_expires(self):
+        for _ in range(3):
+            self.create_withdrawal()
+        session = FakeCallbackSession()
+        now = timezone.now()
+        # Аренды хватает только на одну отправку с полными таймаутами
+        with override_settings(CALLBACK_OUTBOX={**settings.CALLBACK_OUTBOX, 'LEASE': 13}):
+            self.assertEqual(deliver_due(session=session, now=now), 1)
+            self.assertEqual(CallbackOutbox.objects.filter(status=CallbackOutbox.PENDING, next_attempt_at=now).count(), 2)
+            self.assertEqual(deliver_due(session=session, now=now), 1)
+        self.assertEqual(len(session.sent), 2)
+
+    def test_events_of_one_object_are_delivered_in_order(self):
+        withdrawal_id = self.create_withdrawal()
+        self.client.post(reverse('cancel_withdrawal'), {'id': withdrawal_id}, format='json')
+        first, second = CallbackOutbox.objects.order_by('id')
+        CallbackOutbox.objects.filter(pk=first.pk).update(next_attempt_at=timezone.now() + timedelta(minutes=5))
+        session = FakeCallbackSession()
+        self.assertEqual(deliver_due(session=session), 0)
+
+        CallbackOutbox.objects.filter(pk=first.pk).update(next_attempt_at=timezone.now())
+        with mock.patch('requests.Session.post') as post:
+            call_command('deliver_callbacks', '--once', '--sync', stdout=StringIO())
+        self.assertEqual([json.loads(call.kwargs['data'])['status'] for call in post.call_args_list],
+                         ['created', 'cancelled'])
+        self.assertEqual(CallbackOutbox.objects.filter(status=CallbackOutbox.DELIVERED).count(), 2)
+
+    def test_open_breaker_defers_without_attempt(self):
+        self.create_withdrawal()
+        session = FakeCallbackSession(fail_urls={'https://shop.example.com/callback'})
+        breaker = breaker_for('callback', 'shop.example.com')
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        now = timezone.now()
+        self.assertEqual(deliver_due(session=session, now=now), 1)
+        self.assertEqual(session.sent, [])
+        entry = CallbackOutbox.objects.get()
+        self.assertEqual((entry.status, entry.attempts), (CallbackOutbox.PENDING, 0))
+        self.assertGreater(entry.next_attempt_at, now + timedelta(seconds=50))
+
+    def test_invoice_creation_queues_callback(self):
+        response = self.client.post(reverse('create-invoice'), {
+            'amount': '5.00', 'type': 'payment', 'lifetime': 3600, 'callback_url': 'https://shop.example.com/invoice',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        entry = CallbackOutbox.objects.get()
+        self.assertEqual(entry.event, 'invoice.created')
+        self.assertEqual(entry.payload['id'], str(response.data['id']))
+
+
+class WithdrawalTransitionTests(CallbackFixtureMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.balance = 100
+        self.user.save()
+
+    def post(self, name, withdrawal_id):
+        return self.client.post(reverse(name), {'id': withdrawal_id}, format='json')
+
+    def test_transition_is_conditional(self):
+        withdrawal_id = self.create_withdrawal()
+        self.assertEqual(self.post('confirm_withdrawal', withdrawal_id).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.post('confirm_withdrawal', withdrawal_id).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('cancel_withdrawal', withdrawal_id).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(WithdrawalRequest.objects.get(pk=withdrawal_id).status, WithdrawalRequest.PROCESSING)
+        self.assertEqual(CallbackOutbox.objects.filter(event='withdrawal.processing').count(), 1)
+
+    def test_other_company_gets_not_found(self):
+        other = Company.objects.create(name='Other', business_type=self.company.business_type,
+                                       registration_number='REG-2', address='Osh')
+        withdrawal = WithdrawalRequest.objects.create(user=self.user, company=other, amount=10, method='BITCOIN',
+                                                      wallet='w', subtract_from='balance')
+        self.assertEqual(self.post('cancel_withdrawal', withdrawal.pk).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(WithdrawalRequest.objects.transition(withdrawal.pk, WithdrawalRequest.PAYED))
+        withdrawal.refresh_from_db()
+        self.assertEqual(withdrawal.status, WithdrawalRequest.CREATED)
+
+    def test_pay_deducts_balance_once(self):
+        withdrawal_id = self.create_withdrawal()
+        withdrawal = WithdrawalRequest.objects.get(pk=withdrawal_id)
+        with self.assertRaises(ValueError):
+            withdrawal.set_payed_and_deduct_balance()
+        self.post('confirm_withdrawal', withdrawal_id)
+        stale = WithdrawalRequest.objects.get(pk=withdrawal_id)
+        withdrawal.set_payed_and_deduct_balance()
+        with self.assertRaises(ValueError):
+            stale.set_payed_and_deduct_balance()
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.balance, 100 - withdrawal.deduction_amount - withdrawal.commission / 100, places=2)
+        self.assertEqual(CallbackOutbox.objects.filter(event='withdrawal.payed').count(), 1)
+
+    def test_failed_payment_keeps_status(self):
+        withdrawal_id = self.create_withdrawal()
+        self.post('confirm_withdrawal', withdrawal_id)
+        WithdrawalRequest.objects.filter(pk=withdrawal_id).update(deduction_amount=1000)
+        with self.assertRaises(ValueError):
+            WithdrawalRequest.objects.get(pk=withdrawal_id).set_payed_and_deduct_balance()
+        self.assertEqual(WithdrawalRequest.objects.get(pk=withdrawal_id).status, WithdrawalRequest.PROCESSING)
+        self.assertFalse(CallbackOutbox.objects.filter(event='withdrawal.payed').exists())
+
+
+class WithdrawalBatchTests(CallbackFixtureMixin, APITestCase):
+    def create_withdrawals(self, count, company=None):
+        return [
+            WithdrawalRequest.objects.create(
+                user=self.user, company=company or self.company, amount=10, method='BITCOIN', wallet='w',
+                subtract_from='balance', callback_url='https://shop.example.com/callback',
+            ).pk
+            for _ in range(count)
+        ]
+
+    def test_batch_confirm_returns_result_per_id(self):
+        ids = self.create_withdrawals(3)
+        WithdrawalRequest.objects.filter(pk=ids[2]).update(status=WithdrawalRequest.CANCELLED)
+        other = Company.objects.create(name='Other', business_type=self.company.business_type,
+                                       registration_number='REG-2', address='Osh')
+        foreign = self.create_withdrawals(1, company=other)[0]
+        response = self.client.post(reverse('confirm_withdrawals'), {'ids': [*ids, foreign, ids[0]]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()['results']
+        self.assertEqual(results[str(ids[0])]['status'], 'success')
+        self.assertEqual(results[str(ids[1])]['status'], 'success')
+        self.assertEqual(results[str(ids[2])]['withdrawal_status'], 'cancelled')
+        self.assertEqual(results[str(foreign)]['message'], 'Withdrawal request not found')
+        self.assertEqual(
+            sorted(CallbackOutbox.objects.filter(event='withdrawal.processing').values_list('object_id', flat=True)),
+            sorted(str(pk) for pk in ids[:2]),
+        )
+        self.assertEqual(WithdrawalRequest.objects.get(pk=foreign).status, WithdrawalRequest.CREATED)
+        # Повторный id квоту не списывает
+        self.assertEqual(response['X-Quota-Remaining'], '96')
+
+    def test_batch_queries_do_not_grow_with_size(self):
+        self.client.post(reverse('cancel_withdrawals'), {'ids': self.create_withdrawals(2)}, format='json')
+        ids = self.create_withdrawals(50)
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(reverse('cancel_withdrawals'), {'ids': ids[:2]}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.post(reverse('cancel_withdrawals'), {'ids': ids[2:]}, format='json')
+        self.assertEqual(len(large), len(small))
+        self.assertTrue(all(result['status'] == 'success' for result in response.json()['results'].values()))
+
+    def test_batch_info_and_limit(self):
+        ids = self.create_withdrawals(2)
+        response = self.client.post(reverse('get_withdrawals_info'), {'ids': ids + [999999]}, format='json')
+        results = response.json()['results']
+        self.assertEqual(results[str(ids[0])]['status'], 'created')
+        self.assertEqual(results['999999']['status'], 'failed')
+        too_many = list(range(1, settings.WITHDRAWAL_BATCH['MAX_IDS'] + 2))
+        response = self.client.post(reverse('get_withdrawals_info'), {'ids': too_many}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MassPayoutTests(CallbackFixtureMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.balance = 100
+        self.user.save()
+
+    def payouts(self, count, amount='10.00', **extra):
+        return [
+            {'amount': amount, 'method': 'BITCOIN', 'wallet': f'wallet-{index}', 'subtract_from': 'amount',
+             'callback_url': 'https://shop.example.com/callback', **extra}
+            for index in range(count)
+        ]
+
+    def submit(self, payouts):
+        return self.client.post(reverse('mass_payout'), {'payouts': payouts}, format='json')
+
+    def test_payouts_are_created_in_one_batch(self):
+        self.submit(self.payouts(1, amount='1.00'))
+        with CaptureQueriesContext(connection) as small:
+            self.submit(self.payouts(1, amount='1.00'))
+        with CaptureQueriesContext(connection) as large:
+            response = self.submit(self.payouts(20, amount='1.00'))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(response.data['count'], 20)
+        self.assertEqual(WithdrawalRequest.objects.filter(company=self.company).count(), 22)
+        self.assertEqual(CallbackOutbox.objects.filter(event='withdrawal.created').count(), 22)
+        self.assertEqual(response['X-Quota-Remaining'], '78')
+        self.assertEqual(self.user.__class__.objects.get(pk=self.user.pk).balance, 100)
+
+    def test_invalid_payout_rejects_whole_batch(self):
+        payouts = self.payouts(3)
+        payouts[1]['method'] = 'PAYPAL'
+        response = self.submit(payouts)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('method', response.data['payouts'][1])
+        self.assertFalse(WithdrawalRequest.objects.exists())
+        self.assertNotIn('X-Quota-Remaining', response)
+
+    def test_balance_covers_outstanding_requests(self):
+        self.assertEqual(self.submit(self.payouts(6)).status_code, status.HTTP_201_CREATED)
+        response = self.submit(self.payouts(4))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['message'], 'Insufficient balance for the payouts')
+        self.assertEqual(WithdrawalRequest.objects.count(), 6)
+        WithdrawalRequest.objects.filter(pk__in=WithdrawalRequest.objects.values('pk')[:2]).update(
+            status=WithdrawalRequest.CANCELLED
+        )
+        self.assertEqual(self.submit(self.payouts(3)).status_code, status.HTTP_201_CREATED)
+
+
+@override_settings(PAYOUT_BATCHING={**settings.PAYOUT_BATCHING, 'MAX_SIZE': 3, 'MAX_AGE': 600, 'METHODS': {}})
+class PayoutBatchingTests(CallbackFixtureMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.user.balance = 1000
+        self.user.save()
+        self.provider = FakePayoutProvider()
+
+    def create_processing(self, count, method='BITCOIN', currency='BTC', age=0):
+        ids = [
+            WithdrawalRequest.objects.create(
+                user=self.user, company=self.company, amount=10, method=method, wallet='w', subtract_from='amount',
+                deduction_amount=10, commission=Decimal('0.15'), currency=currency, status=WithdrawalRequest.PROCESSING,
+                callback_url='https://shop.example.com/callback',
+            ).pk
+            for _ in range(count)
+        ]
+        WithdrawalRequest.objects.filter(pk__in=ids).update(created_at=timezone.now() - timedelta(seconds=age))
+        return ids
+
+    def test_full_groups_are_paid_in_batches(self):
+        bitcoin = self.create_processing(7)
+        self.create_processing(2, method='ETHEREUM', currency='ETH')
+        self.create_processing(2, currency='USDT')
+        batches = run_payouts({'BITCOIN': self.provider, 'ETHEREUM': self.provider})
+        self.assertEqual([batch.size for batch in batches], [3, 3])
+        self.assertEqual([withdrawal_ids for _, withdrawal_ids in self.provider.batches], [bitcoin[:3], bitcoin[3:6]])
+        self.assertEqual(set(PayoutBatch.objects.values_list('status', flat=True)), {PayoutBatch.SETTLED})
+        self.assertEqual(WithdrawalRequest.objects.filter(status=WithdrawalRequest.PAYED).count(), 6)
+        self.assertEqual(CallbackOutbox.objects.filter(event='withdrawal.payed').count(), 6)
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.balance, Decimal('1000') - 6 * Decimal('10.0015'), places=2)
+
+    def test_old_requests_are_paid_without_full_batch(self):
+        young = self.create_processing(1)
+        self.assertEqual(run_payouts({'BITCOIN': self.provider}), [])
+        old = self.create_processing(1, age=900)
+        batch, = run_payouts({'BITCOIN': self.provider})
+        self.assertEqual(batch.size, 2)
+        self.assertEqual(self.provider.batches[0][1], young + old)
+
+    def test_rejected_batch_returns_requests_to_pool(self):
+        ids = self.create_processing(3)
+        with self.assertLogs('api.payouts', 'WARNING'):
+            batch, = run_payouts({'BITCOIN': FakePayoutProvider(fail=True)})
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, PayoutBatch.FAILED)
+        self.assertFalse(WithdrawalRequest.objects.filter(payout_batch__isnull=False).exists())
+        self.assertFalse(CallbackOutbox.objects.exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, 1000)
+        run_payouts({'BITCOIN': self.provider})
+        self.assertEqual(self.provider.batches[0][1], ids)
+
+    def test_parallel_batches_of_one_user_do_not_overdraw(self):
+        self.user.balance = 35
+        self.user.save()
+        self.create_processing(3)
+        self.create_processing(3, method='ETHEREUM', currency='ETH')
+        bitcoin, ethereum = form_batches(['BITCOIN', 'ETHEREUM'])
+        ethereum_provider = FakePayoutProvider()
+        results = []
+
+        class ParallelProvider(FakePayoutProvider):
+            # Второй запуск проводит свой пакет, пока первый ждет провайдера
+            def send_batch(self, batch, withdrawals):
+                results.append(execute_batch(ethereum, ethereum_provider))
+                return super().send_batch(batch, withdrawals)
+
+        with self.assertLogs('api.payouts', 'WARNING'):
+            self.assertTrue(execute_batch(bitcoin, ParallelProvider()))
+        self.assertEqual(results, [False])
+        self.assertEqual(ethereum_provider.batches, [])
+        self.user.refresh_from_db()
+        self.assertAlmostEqual(self.user.balance, Decimal('35') - 3 * Decimal('10.0015'), places=2)
+        self.assertEqual(WithdrawalRequest.objects.filter(method='ETHEREUM', payout_batch=None).count(), 3)
+
+    def test_uncovered_requests_are_not_sent(self):
+        self.user.balance = 15
+        self.user.save()
+        self.create_processing(3)
+        with self.assertLogs('api.payouts', 'WARNING'):
+            batch, = run_payouts({'BITCOIN': self.provider})
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, PayoutBatch.FAILED)
+        self.assertEqual(self.provider.batches, [])
+        self.assertEqual(WithdrawalRequest.objects.filter(status=WithdrawalRequest.PROCESSING, payout_batch=None).count(), 3)
+
+    def test_batched_request_cannot_be_paid_manually(self):
+        withdrawal_id = self.create_processing(3)[0]
+        form_batches(['BITCOIN'])
+        with self.assertRaises(ValueError):
+            WithdrawalRequest.objects.get(pk=withdrawal_id).set_payed_and_deduct_balance()
+
+    def test_command(self):
+        self.create_processing(3)
+        out = StringIO()
+        with override_settings(PAYOUT_BATCHING={**settings.PAYOUT_BATCHING,
+                                                'PROVIDERS': {'BITCOIN': 'api.payouts.FakePayoutProvider'}}):
+            call_command('process_payouts', '--once', stdout=out)
+        self.assertIn('settled: 1, failed: 0', out.getvalue())
+
+
+class BatchedCallbackTests(CallbackFixtureMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        response = self.client.post(reverse('callback_settings'), {'batching': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.secret = response.data['secret']
+        self.assertTrue(self.secret)
+
+    def window_end(self):
+        return CallbackOutbox.objects.batch_window_end()
+
+    def test_events_are_coalesced_into_signed_array(self):
+        ids = [self.create_withdrawal() for _ in range(3)]
+        self.assertEqual(CallbackOutbox.objects.filter(batched=True).count(), 3)
+        session = FakeCallbackSession()
+        # До конца окна события ждут
+        self.assertEqual(deliver_due(session=session), 0)
+
+        self.assertEqual(deliver_due(session=session, now=self.window_end()), 3)
+        (url, body, _, headers), = session.sent
+        self.assertEqual([item['data']['id'] for item in body], ids)
+        self.assertEqual({item['event'] for item in body}, {'withdrawal.created'})
+        self.assertEqual(headers['X-Callback-Batch'], '3')
+        raw = json.dumps(body).encode()
+        expected = hmac.new(self.secret.encode(), f"{headers['X-Callback-Timestamp']}.".encode() + raw,
+                            hashlib.sha256).hexdigest()
+        self.assertEqual(headers['X-Callback-Signature'], f'sha256={expected}')
+        self.assertEqual(CallbackOutbox.objects.filter(status=CallbackOutbox.DELIVERED).count(), 3)
+
+    def test_full_batch_is_sent_before_window_ends(self):
+        with override_settings(CALLBACK_OUTBOX={**settings.CALLBACK_OUTBOX, 'BATCH_MAX_SIZE': 2,
+                                                'BATCH_WINDOW': 60}):
+            for _ in range(3):
+                self.create_withdrawal()
+            session = FakeCallbackSession()
+            self.assertEqual(deliver_due(session=session), 3)
+        self.assertEqual([len(body) for _, body, _, _ in session.sent], [2, 1])
+
+    def test_failed_batch_is_retried_as_one(self):
+        for _ in range(2):
+            self.create_withdrawal()
+        session = FakeCallbackSession(fail_urls={'https://shop.example.com/callback'})
+        deliver_due(session=session, now=self.window_end())
+        self.assertEqual(len(set(CallbackOutbox.objects.values_list('next_attempt_at', flat=True))), 1)
+
+    def test_transitions_of_one_object_keep_order(self):
+        withdrawal_id = self.create_withdrawal()
+        self.client.post(reverse('confirm_withdrawal'), {'id': withdrawal_id}, format='json')
+        session = FakeCallbackSession()
+        now = self.window_end()
+        deliver_due(session=session, now=now)
+        deliver_due(session=session, now=now)
+        self.assertEqual([[item['event'] for item in body] for _, body, _, _ in session.sent],
+                         [['withdrawal.created'], ['withdrawal.processing']])
+
+
+class CallbackSinkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path, json.loads(body), self.client_address[1]))
+        if self.path == '/slow':
+            time.sleep(0.5)
+        code = 500 if self.path == '/fail' else 200
+        try:
+            self.send_response(code)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        except ConnectionError:
+            # Клиент уже ушел по таймауту
+            self.close_connection = True
+            return
+        if self.path == '/drop':
+            # Закрываем keep-alive соединение без предупреждения
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CallbackSinkMixin:
+    def start_sink(self):
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+        self.sink = ThreadingHTTPServer(('127.0.0.1', 0), CallbackSinkHandler)
+        self.sink.daemon_threads = True
+        self.sink.received = []
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        self.addCleanup(self.sink.server_close)
+        self.addCleanup(self.sink.shutdown)
+        return f'http://127.0.0.1:{self.sink.server_address[1]}'
+
+
+class CallbackDispatcherTests(CallbackSinkMixin, SimpleTestCase):
+    def setUp(self):
+        self.base_url = self.start_sink()
+
+    def entries(self, path, count):
+        return [
+            CallbackOutbox(pk=index, event='withdrawal.created', url=self.base_url + path, payload={'id': index})
+            for index in range(count)
+        ]
+
+    def deliver(self, entries, **kwargs):
+        async def run():
+            options = {'global_limit': 100, 'host_limit': 4, 'connect_timeout': 1, 'read_timeout': 1, **kwargs}
+            dispatcher = CallbackDispatcher(**options)
+            try:
+                return await dispatcher.deliver(entries), dispatcher.connections_opened()
+            finally:
+                dispatcher.close()
+        return asyncio.run(run())
+
+    def test_callbacks_reuse_pooled_connections(self):
+        results, opened = self.deliver(self.entries('/ok', 50))
+        self.assertEqual([error for _, error in results], [None] * 50)
+        self.assertLessEqual(opened, 4)
+        self.assertEqual(sorted(payload['id'] for _, payload, _ in self.sink.received), list(range(50)))
+        self.assertLessEqual(len({port for _, _, port in self.sink.received}), 4)
+
+    def test_errors_are_reported_per_callback(self):
+        (_, read_timeout), = self.deliver(self.entries('/slow', 1), read_timeout=0.1)[0]
+        (_, server_error), = self.deliver(self.entries('/fail', 1))[0]
+        self.assertIn('Read timeout', read_timeout)
+        self.assertEqual(server_error, 'HTTP 500')
+
+        with socket.socket() as closed:
+            closed.bind(('127.0.0.1', 0))
+            url = f'http://127.0.0.1:{closed.getsockname()[1]}/'
+        (_, refused), = self.deliver([CallbackOutbox(pk=1, event='e', url=url, payload={})])[0]
+        self.assertIn('failed', refused)
+
+    def test_failing_host_trips_breaker(self):
+        results, _ = self.deliver(self.entries('/fail', 10), host_limit=1)
+        errors = [error for _, error in results]
+        threshold = breaker_for('callback', urlsplit(self.base_url).netloc).failure_threshold
+        self.assertEqual(errors[:threshold], ['HTTP 500'] * threshold)
+        self.assertTrue(all(isinstance(error, CircuitOpenError) for error in errors[threshold:]))
+        self.assertEqual(len(self.sink.received), threshold)
+
+    def test_delivery_past_lease_deadline_is_not_sent(self):
+        async def run():
+            dispatcher = CallbackDispatcher(global_limit=10, host_limit=1, connect_timeout=1, read_timeout=1)
+            try:
+                return await dispatcher.send(self.entries('/ok', 1), deadline=time.monotonic() - 1)
+            finally:
+                dispatcher.close()
+        self.assertIsInstance(asyncio.run(run()), LeaseExpired)
+        self.assertEqual(self.sink.received, [])
+
+    def test_write_is_bounded_by_timeout(self):
+        with socket.socket() as stalled:
+            # Соединение принимается ядром, но никто не читает - буферы заполняются
+            stalled.bind(('127.0.0.1', 0))
+            stalled.listen()
+            entry = CallbackOutbox(pk=1, event='e', url=f'http://127.0.0.1:{stalled.getsockname()[1]}/',
+                                   payload={'data': 'x' * 64 * 1024 * 1024})
+            (_, error), = self.deliver([entry], read_timeout=0.2)[0]
+        self.assertIn('Write timeout', error)
+
+    def test_connection_closed_by_server_is_reopened(self):
+        async def run():
+            dispatcher = CallbackDispatcher(global_limit=10, host_limit=1, connect_timeout=1, read_timeout=1)
+            first = await dispatcher.send(self.entries('/drop', 1))
+            await asyncio.sleep(0.05)
+            second = await dispatcher.send(self.entries('/ok', 1))
+            dispatcher.close()
+            return first, second, dispatcher.connections_opened()
+        self.assertEqual(asyncio.run(run()), (None, None, 2))
+
+
+class CallbackDispatcherOutboxTests(CallbackSinkMixin, TransactionTestCase):
+    def test_run_delivers_queue_and_records_results(self):
+        base_url = self.start_sink()
+        for index in range(20):
+            CallbackOutbox.objects.create(event='withdrawal.created', object_type='withdrawal',
+                                          object_id=str(index % 5), url=f'{base_url}/ok', payload={'n': index})
+        CallbackOutbox.objects.create(event='withdrawal.created', object_type='withdrawal', object_id='x',
+                                      url=f'{base_url}/fail', payload={'n': -1})
+        dispatcher = CallbackDispatcher(global_limit=8, host_limit=4, connect_timeout=1, read_timeout=1)
+        processed = asyncio.run(run_dispatcher(dispatcher, asyncio.Event(), once=True))
+
+        self.assertEqual(processed, 21)
+        self.assertEqual(CallbackOutbox.objects.filter(status=CallbackOutbox.DELIVERED).count(), 20)
+        failed = CallbackOutbox.objects.get(object_id='x')
+        self.assertEqual((failed.status, failed.attempts, failed.last_error), (CallbackOutbox.PENDING, 1, 'HTTP 500'))
+        # События одного объекта дошли в порядке постановки
+        for object_id in range(5):
+            sent = [payload['n'] for _, payload, _ in self.sink.received if payload['n'] >= 0 and payload['n'] % 5 == object_id]
+            self.assertEqual(sent, sorted(sent))
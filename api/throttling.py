@@ -0,0 +1,122 @@
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from .utils import MerchantContext
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_CACHE_KEY = 'api:throttle:{}:{}'
+
+
+class TokenBucketStore:
+    """
+    Token buckets in GCRA form: a bucket is a single "theoretical arrival
+    time" value, so each check is one cache read and, when allowed, one write.
+
+    The state lives in the Django cache and is shared between workers when
+    CACHE_URL points to a shared backend. If the cache is unavailable the
+    buckets fall back to process memory. Concurrent workers may admit a few
+    extra requests because the read and write are not atomic.
+    """
+
+    def __init__(self):
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            return cache.get(key)
+        except Exception:
+            logger.warning('Throttle cache unavailable, using process memory', exc_info=True)
+            with self._lock:
+                return self._local.get(key)
+
+    def _set(self, key, value, timeout):
+        try:
+            cache.set(key, value, timeout=timeout)
+        except Exception:
+            with self._lock:
+                self._local[key] = value
+
+    def acquire(self, key, rate, burst, cost=1):
+        """
+        Берет cost токенов из корзины емкостью burst, пополняемой со скоростью rate в секунду.
+        Возвращает (allowed, remaining, reset, retry_after) - reset и retry_after в секундах.
+        """
+        interval = 1.0 / rate
+        now = time.time()
+        tat = max(self._get(key) or now, now)
+        new_tat = tat + interval * cost
+        allow_at = new_tat - interval * burst
+        if now < allow_at:
+            return False, 0, tat - now, allow_at - now
+        self._set(key, new_tat, timeout=math.ceil(new_tat - now) + 1)
+        # Погрешность float не должна съедать целый токен
+        return True, int((now - allow_at) / interval + 1e-9), new_tat - now, 0
+
+    def release(self, key, rate, cost=1):
+        """
+        Возвращает cost токенов, взятых acquire для запроса, который так и не был выполнен.
+        """
+        now = time.time()
+        tat = self._get(key)
+        if tat is None or tat <= now:
+            return
+        new_tat = max(tat - cost / rate, now)
+        self._set(key, new_tat, timeout=math.ceil(new_tat - now) + 1)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+
+
+bucket_store = TokenBucketStore()
+
+
+class MerchantBurstThrottle(BaseThrottle):
+    """
+    Per-key and per-company burst limit on top of the monthly quota.
+
+    Rates come from settings.MERCHANT_THROTTLE by subscription plan. The plan
+    and ids are taken from the MerchantContext, so a rejected request costs
+    no database query when the credentials are cached or sent as a token.
+    Invalid credentials are left to the view.
+    """
+    scopes = ('key', 'company')
+
+    def allow_request(self, request, view):
+        context = view.get_merchant_context(request)
+        if not isinstance(context, MerchantContext):
+            return True
+
+        config = settings.MERCHANT_THROTTLE
+        plan = context.subscription.name if context.subscription else config['DEFAULT_PLAN']
+        rates = config['PLANS'].get(plan, config['PLANS'][config['DEFAULT_PLAN']])
+        owners = {'key': context.api_key_id, 'company': context.company.pk}
+
+        self.retry_after = None
+        acquired = []
+        for scope in self.scopes:
+            rate = rates[scope]
+            key = THROTTLE_CACHE_KEY.format(scope, owners[scope])
+            allowed, remaining, reset, retry_after = bucket_store.acquire(key, rate['RATE'], rate['BURST'])
+            # В заголовки попадает самая строгая из корзин
+            if view.rate_limit is None or remaining < view.rate_limit['remaining']:
+                view.rate_limit = {'limit': rate['BURST'], 'remaining': remaining, 'reset': reset}
+            if not allowed:
+                # Отклоненный запрос не расходует токены корзин, которые его пропустили
+                for acquired_key, acquired_rate in acquired:
+                    bucket_store.release(acquired_key, acquired_rate)
+                self.retry_after = retry_after
+                return False
+            acquired.append((key, rate['RATE']))
+        return True
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS
+
+from user.models import Company, Subscription, User
+from .utils import MerchantContext, get_current_month, get_key_generation
+
+MERCHANT_TOKEN_SALT = 'api.merchant-token'
+
+
+def issue_merchant_token(context):
+    """
+    Подписывает HMAC-токен с идентификаторами мерчанта и тарифом.
+    Поколение ключей компании зашивается в токен, поэтому отзыв ключа сразу делает его недействительным.
+    """
+    subscription = context.subscription
+    payload = {
+        'c': context.company.pk,
+        'u': context.user.pk,
+        'e': context.user.email,
+        'k': context.api_key_id,
+        's': subscription.pk if subscription else None,
+        't': subscription.name if subscription else None,
+        'l': subscription.max_requests_per_month if subscription else None,
+        'g': get_key_generation(context.company.pk),
+    }
+    return signing.dumps(payload, salt=MERCHANT_TOKEN_SALT, compress=False)
+
+
+def read_merchant_token(token):
+    """
+    Проверяет подпись, срок жизни и поколение ключей. Поколение берется из кэша,
+    к БД запрос идет, только если его там нет.
+    Возвращает MerchantContext или None.
+    """
+    try:
+        payload = signing.loads(
+            token, salt=MERCHANT_TOKEN_SALT, max_age=settings.MERCHANT_TOKEN_LIFETIME
+        )
+    except signing.BadSignature:
+        return None
+    if payload['g'] != get_key_generation(payload['c']):
+        return None
+
+    # Незагруженные поля остаются отложенными и читаются из БД только при обращении
+    user = User.from_db(DEFAULT_DB_ALIAS, ['id', 'email'], [payload['u'], payload['e']])
+    company = Company.from_db(DEFAULT_DB_ALIAS, ['id', 'subscription_id'], [payload['c'], payload['s']])
+    if payload['s'] is not None:
+        company.subscription = Subscription.from_db(
+            DEFAULT_DB_ALIAS, ['id', 'name', 'max_requests_per_month'], [payload['s'], payload['t'], payload['l']]
+        )
+    return MerchantContext(
+        user=user,
+        company=company,
+        api_key_id=payload['k'],
+        month=get_current_month(),
+        company_requests_made=None,
+        user_requests_made=None,
+        usage_loaded=False,
+    )
@@ -12,6 +12,9 @@ urlpatterns = [
     path('check-key', CheckKeyView.as_view(), name='check_key'),
     path('regenerate-key', RegenerateKeyView.as_view(), name='regenerate_key'),
     path('deactivate-key', DeactivateKeyView.as_view(), name='deactivate_key'),
+    path('merchant-token', MerchantTokenView.as_view(), name='merchant_token'),
+    path('quota-status', QuotaStatusView.as_view(), name='quota_status'),
+    path('callback-settings', CallbackSettingsView.as_view(), name='callback_settings'),
 
     path('change-subscription/<int:pk>/', ChangeSubscriptionView.as_view(), name='change-subscription'),
     path('subscription-history/', SubscriptionHistoryListView.as_view(), name='subscription-history-list'),
@@ -19,9 +22,13 @@ urlpatterns = [
 
 
     path('payoff/vyvod', WithdrawalRequestView.as_view(), name='withdrawal_request'),
+    path('payoff/mass_payout', MassPayoutView.as_view(), name='mass_payout'),
     path('payoff/confirm_withdrawal', ConfirmWithdrawalRequestView.as_view(), name='confirm_withdrawal'),
     path('payoff/cancel_withdrawal', CancelWithdrawalRequestView.as_view(), name='cancel_withdrawal'),
     path('payoff/get_withdrawal_info', GetWithdrawalRequestView.as_view(), name='get_withdrawal_info'),
+    path('payoff/confirm_withdrawals', ConfirmWithdrawalBatchView.as_view(), name='confirm_withdrawals'),
+    path('payoff/cancel_withdrawals', CancelWithdrawalBatchView.as_view(), name='cancel_withdrawals'),
+    path('payoff/get_withdrawals_info', GetWithdrawalBatchInfoView.as_view(), name='get_withdrawals_info'),
 
     path('create_invoice/', CreateInvoiceView.as_view(), name='create-invoice'),
     path('invoice_info/', InvoiceDetailView.as_view(), name='invoice-info'),
@@ -1,10 +1,373 @@
+import copy
+import hmac
+import threading
+import uuid
+from dataclasses import dataclass, replace
+from datetime import date, datetime, time, timezone as dt_timezone
+from typing import Optional
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from user.models import Company, MonthlyCompanyStatistics, MonthlyUserStatistics, Subscription, UserCompanyRelation, \
+    consume_monthly_requests
+from user.counters import is_buffered, request_counters
 from .models import APIKey, User
-from django.core.exceptions import ObjectDoesNotExist
+
+KEY_GENERATION_CACHE_KEY = 'api:key-generation:{}'
+
+# Кэши в памяти процесса: сброс в одном воркере не виден остальным
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def shared_cache():
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+def get_key_generation(company_id):
+    """
+    Поколение учетных данных компании. Источник - колонка Company.key_generation,
+    общий кэш Django лишь избавляет от запроса; потерянное значение перечитывается из БД.
+    Если кэш не общий для воркеров (нет CACHE_URL), значение всегда читается из БД,
+    иначе отозванный ключ принимался бы другими воркерами до истечения TTL.
+    Для удаленной компании - None.
+    """
+    if not shared_cache():
+        return Company.objects.filter(pk=company_id).values_list('key_generation', flat=True).first()
+    key = KEY_GENERATION_CACHE_KEY.format(company_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = Company.objects.filter(pk=company_id).values_list('key_generation', flat=True).first()
+        if generation is not None:
+            remember_key_generation(company_id, generation)
+    return generation
+
+
+def remember_key_generation(company_id, generation):
+    """
+    Кладет в кэш поколение, прочитанное из БД. add, а не set: не затираем значение,
+    записанное после нового сброса; срок жизни ограничивает ошибку, если чтение
+    пришлось на момент до коммита сброса.
+    """
+    cache.add(KEY_GENERATION_CACHE_KEY.format(company_id), generation,
+              timeout=settings.API_CREDENTIAL_CACHE['TTL'])
+
+
+def bump_key_generation(company_id):
+    """
+    Инвалидирует все закэшированные учетные данные и токены компании.
+    Счетчик хранится в БД, кэш сбрасывается, поэтому новое значение видят все воркеры.
+    Сигналы вызывают сброс еще раз после коммита, так что в кэш не попадет
+    значение, прочитанное до фиксации транзакции.
+    """
+    Company.objects.filter(pk=company_id).update(key_generation=F('key_generation') + 1)
+    cache.delete(KEY_GENERATION_CACHE_KEY.format(company_id))
+
+
+def _detached(user, company):
+    """
+    Копии экземпляров для кэша: параллельные запросы не должны менять общие объекты.
+    """
+    user = copy.copy(user)
+    company = copy.copy(company)
+    if Company.subscription.is_cached(company) and company.subscription is not None:
+        company.subscription = copy.copy(company.subscription)
+    return user, company
+
+
+class CredentialCache:
+    """
+    In-process LRU cache of resolved (auth_login, auth_secret) pairs.
+
+    Positive entries remember the company key generation they were resolved
+    under and are dropped as soon as the generation moves on. Unknown
+    credentials are cached separately with a shorter TTL. Model instances are
+    copied on the way in and out, so every request gets its own.
+    """
+
+    def __init__(self, ttl, negative_ttl, max_size):
+        self._positive = TTLCache(maxsize=max_size, ttl=ttl)
+        self._negative = TTLCache(maxsize=max_size, ttl=negative_ttl)
+        self._lock = threading.Lock()
+
+    def get(self, auth_login, auth_secret):
+        """
+        Returns (found, user, company, api_key_id). found is False on a cache miss.
+        """
+        cache_key = (auth_login, auth_secret)
+        with self._lock:
+            entry = self._positive.get(cache_key)
+            if entry is None:
+                if cache_key in self._negative:
+                    return True, None, None, None
+                return False, None, None, None
+
+        user, company, api_key_id, generation = entry
+        if generation != get_key_generation(company.pk):
+            with self._lock:
+                self._positive.pop(cache_key, None)
+            return False, None, None, None
+        user, company = _detached(user, company)
+        return True, user, company, api_key_id
+
+    def set(self, auth_login, auth_secret, user, company, api_key_id, generation):
+        user, company = _detached(user, company)
+        with self._lock:
+            self._positive[(auth_login, auth_secret)] = (user, company, api_key_id, generation)
+
+    def set_invalid(self, auth_login, auth_secret):
+        with self._lock:
+            self._negative[(auth_login, auth_secret)] = True
+
+    def invalidate(self, company_id=None, user_id=None):
+        with self._lock:
+            stale = [
+                cache_key for cache_key, (user, company, _, _) in self._positive.items()
+                if company.pk == company_id or user.pk == user_id
+            ]
+            for cache_key in stale:
+                self._positive.pop(cache_key, None)
+            # Новый ключ или связь могут сделать ранее неверную пару валидной
+            self._negative.clear()
+
+    def clear(self):
+        with self._lock:
+            self._positive.clear()
+            self._negative.clear()
+
+
+credential_cache = CredentialCache(
+    ttl=settings.API_CREDENTIAL_CACHE['TTL'],
+    negative_ttl=settings.API_CREDENTIAL_CACHE['NEGATIVE_TTL'],
+    max_size=settings.API_CREDENTIAL_CACHE['MAX_SIZE'],
+)
+
+
+def invalidate_company_credentials(company_id):
+    credential_cache.invalidate(company_id=company_id)
+    bump_key_generation(company_id)
+
+
+def invalidate_user_credentials(user_id, company_ids):
+    credential_cache.invalidate(user_id=user_id)
+    for company_id in company_ids:
+        bump_key_generation(company_id)
+
+
+def get_current_month():
+    now = timezone.now()
+    return date(now.year, now.month, 1)
+
+
+def get_next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+QUOTA_USAGE_CACHE_KEY = 'api:quota-usage:{}:{}'
+
+
+def seconds_until_next_month(month):
+    next_month = datetime.combine(get_next_month(month), time.min, tzinfo=dt_timezone.utc)
+    return max(int((next_month - timezone.now()).total_seconds()), 0)
+
+
+def set_quota_usage(company_id, month, requests_made):
+    """
+    Последнее известное число запросов компании за месяц, посчитанное при списании квоты.
+    Живет до конца месяца, чтобы статус квоты не читал таблицы статистики.
+    """
+    cache.set(QUOTA_USAGE_CACHE_KEY.format(company_id, month.isoformat()), requests_made,
+              timeout=seconds_until_next_month(month) + 1)
+
+
+def get_quota_usage(company_id, month):
+    return cache.get(QUOTA_USAGE_CACHE_KEY.format(company_id, month.isoformat()))
+
+
+@dataclass(frozen=True)
+class MerchantContext:
+    """
+    Everything a merchant endpoint needs about the caller, loaded in one query:
+    the user, the active key, the company with its subscription and the
+    current month request counters (None when the month row does not exist yet).
+    """
+    user: User
+    company: Company
+    api_key_id: int
+    month: date
+    company_requests_made: Optional[int]
+    user_requests_made: Optional[int]
+    usage_loaded: bool = True
+
+    @property
+    def subscription(self) -> Optional[Subscription]:
+        return self.company.subscription
+
+    @property
+    def requests_limit(self):
+        if self.subscription is None:
+            return None
+        return self.subscription.max_requests_per_month
+
+    def requests_remaining(self):
+        if self.requests_limit is None:
+            return 0
+        return self.requests_limit - (self.company_requests_made or 0)
+
+    def can_make_request(self):
+        return self.requests_remaining() > 0
+
+    def with_usage(self):
+        """
+        Контекст из токена или кэша учетных данных приходит без счетчиков; догружает их одним запросом.
+        """
+        if self.usage_loaded:
+            return self
+        counters = UserCompanyRelation.objects.filter(user_id=self.user.pk, company_id=self.company.pk).values(
+            **_monthly_requests_made(self.month)
+        ).first() or {}
+        return replace(
+            self,
+            company_requests_made=counters.get('company_requests_made'),
+            user_requests_made=counters.get('user_requests_made'),
+            usage_loaded=True,
+        )
+
+    def consume_requests(self, units=1):
+        """
+        Атомарно списывает units запросов из месячной квоты компании и, при успехе,
+        прибавляет их к счетчику пользователя. Возвращает (allowed, remaining)
+        без повторного чтения строк статистики.
+        """
+        if self.requests_limit is None:
+            return False, 0
+        if is_buffered():
+            allowed, remaining = request_counters.consume(
+                self.company.pk, self.user.pk, self.month, units, self.requests_limit,
+                company_requests_made=(self.company_requests_made or 0) if self.usage_loaded else None,
+            )
+        else:
+            allowed, remaining = consume_monthly_requests(self.company.pk, self.month, units, self.requests_limit)
+            if allowed:
+                MonthlyUserStatistics.objects.consume(units, user_id=self.user.pk, month=self.month)
+        set_quota_usage(self.company.pk, self.month, self.requests_limit - remaining)
+        return allowed, remaining
+
+
+def _monthly_requests_made(month):
+    company_stats = MonthlyCompanyStatistics.objects.filter(
+        company_id=OuterRef('company_id'), month=month
+    ).values('requests_made')[:1]
+    user_stats = MonthlyUserStatistics.objects.filter(
+        user_id=OuterRef('user_id'), month=month
+    ).values('requests_made')[:1]
+    return {
+        'company_requests_made': Subquery(company_stats),
+        'user_requests_made': Subquery(user_stats),
+    }
+
+
+def _load_by_key_id(auth_login, auth_secret, month):
+    """
+    Ключ нового формата: выборка по первичному ключу и сравнение хэша за постоянное время.
+    """
+    key_id, _ = APIKey.parse_raw_key(auth_secret)
+    api_key = APIKey.objects.select_related('user', 'company__subscription').filter(
+        pk=key_id, is_active=True
+    ).annotate(**_monthly_requests_made(month)).first()
+    if api_key is None or not api_key.check_secret(auth_secret):
+        return None
+    if api_key.user is None or api_key.user.email != auth_login:
+        # Ключ без владельца или выданный другому сотруднику компании
+        return _load_by_relation(auth_login, auth_secret, month)
+    return api_key.user, api_key.company, api_key.pk, api_key
+
+
+def _load_by_relation(auth_login, auth_secret, month):
+    """
+    Старые UUID-ключи и ключи без владельца проверяются через связь пользователя с компанией.
+    """
+    key_id, secret = APIKey.parse_raw_key(auth_secret)
+    if key_id is not None:
+        lookup = Q(company__apikey__id=key_id)
+    else:
+        lookup = Q(company__apikey__secret_hash=APIKey.hash_legacy_key(auth_secret))
+        try:
+            lookup |= Q(company__apikey__key=uuid.UUID(str(auth_secret)))
+        except ValueError:
+            pass
+    relation = UserCompanyRelation.objects.select_related('user', 'company__subscription').filter(
+        lookup, user__email=auth_login, company__apikey__is_active=True
+    ).annotate(
+        api_key_id=F('company__apikey__id'),
+        api_key_secret_hash=F('company__apikey__secret_hash'),
+        **_monthly_requests_made(month)
+    ).first()
+    if relation is None:
+        return None
+    if key_id is not None and not (
+        relation.api_key_secret_hash and hmac.compare_digest(APIKey.hash_secret(secret), relation.api_key_secret_hash)
+    ):
+        return None
+    return relation.user, relation.company, relation.api_key_id, relation
+
+
+def load_merchant_context(auth_login, auth_secret):
+    """
+    Resolves merchant credentials into a MerchantContext or returns None.
+    Cached credentials cost no query; the counters are then loaded on demand
+    by with_usage(). Otherwise a single query: a primary-key fetch for
+    ak_<id>_<secret> keys, or one join over the relation, user, key, company
+    and subscription.
+    """
+    month = get_current_month()
+    found, user, company, api_key_id = credential_cache.get(auth_login, auth_secret)
+    if found:
+        if user is None:
+            return None
+        return MerchantContext(
+            user=user,
+            company=company,
+            api_key_id=api_key_id,
+            month=month,
+            company_requests_made=None,
+            user_requests_made=None,
+            usage_loaded=False,
+        )
+
+    key_id, _ = APIKey.parse_raw_key(auth_secret)
+    if key_id is not None:
+        loaded = _load_by_key_id(auth_login, auth_secret, month)
+    else:
+        loaded = _load_by_relation(auth_login, auth_secret, month)
+    if loaded is None:
+        credential_cache.set_invalid(auth_login, auth_secret)
+        return None
+
+    user, company, api_key_id, row = loaded
+    # Поколение прочитано тем же запросом, что и компания
+    remember_key_generation(company.pk, company.key_generation)
+    credential_cache.set(auth_login, auth_secret, user, company, api_key_id, company.key_generation)
+    return MerchantContext(
+        user=user,
+        company=company,
+        api_key_id=api_key_id,
+        month=month,
+        company_requests_made=row.company_requests_made,
+        user_requests_made=row.user_requests_made,
+    )
+
 
 def verify_key(auth_login, auth_secret):
-    try:
-        user = User.objects.get(email=auth_login)
-        api_key = APIKey.objects.get(key=auth_secret, is_active=True, company__usercompanyrelation__user=user)
-        return True, user, api_key.company
-    except (ObjectDoesNotExist, ValueError):
-        return False, None, None
+    found, user, company, _ = credential_cache.get(auth_login, auth_secret)
+    if not found:
+        context = load_merchant_context(auth_login, auth_secret)
+        if context is not None:
+            user, company = context.user, context.company
+    return user is not None, user, company
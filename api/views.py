@@ -1,8 +1,9 @@
 
+import math
 from decimal import Decimal
 
-import requests
-
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Sum
 
 from rest_framework import generics, status
@@ -17,18 +18,25 @@ from user.serializers import SubscriptionSerializer, CompanySerializer, Subscrip
 
 from django.shortcuts import get_object_or_404
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import Throttled
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 
-from .authentication import APIKeyAuthentication
+from user.authentication import ClaimsJWTAuthentication
+from .authentication import APIKeyAuthentication, MerchantTokenAuthentication
+from .concurrency import acquire_company_slot, release_company_slot
+from .throttling import MerchantBurstThrottle
 
-from .utils import verify_key
+from .tokens import issue_merchant_token
+from .utils import MerchantContext, get_current_month, get_quota_usage, load_merchant_context, \
+    seconds_until_next_month, set_quota_usage
 
-from .models import APIKey, APIKey, Invoice, Withdrawal,WithdrawalRequest
+from .models import APIKey, APIKey, CallbackOutbox, Invoice, Withdrawal,WithdrawalRequest
 from .serializers import InvoiceSerializer, WithdrawalSerializer,WithdrawalRequestSerializer, ConfirmWithdrawalRequestSerializer, \
-    CancelWithdrawalRequestSerializer, GetWithdrawalRequestSerializer
+    CancelWithdrawalRequestSerializer, GetWithdrawalRequestSerializer, CallbackSettingsSerializer, \
+    MassPayoutSerializer, WithdrawalBatchSerializer
 
 
 
@@ -90,9 +98,9 @@ class GenerateKeyView(APIView):
                 'error': 'Company not found or not associated with the user'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        api_key = APIKey.objects.create(company=company)
+        api_key, raw_key = APIKey.objects.create_key(company=company, user=user)
         return Response({
-            'api_key': str(api_key.key),
+            'api_key': raw_key,
         }, status=status.HTTP_201_CREATED)
 
 class CheckKeyView(APIView):
@@ -116,7 +124,8 @@ class CheckKeyView(APIView):
         key_value = request.data.get('key')
         try:
 
-            api_key = APIKey.objects.get(key=key_value, company__usercompanyrelation__user=request.user, is_active=True)
+            api_key = APIKey.objects.get_by_raw_key(key_value, company__usercompanyrelation__user=request.user,
+                                                    is_active=True)
 
             return Response({'valid': True}, status=status.HTTP_200_OK)
         except APIKey.DoesNotExist:
@@ -142,12 +151,13 @@ class RegenerateKeyView(APIView):
     def post(self, request):
         key_value = request.data.get('key')
         try:
-            old_key = APIKey.objects.get(key=key_value, company__usercompanyrelation__user=request.user, is_active=True)
+            old_key = APIKey.objects.get_by_raw_key(key_value, company__usercompanyrelation__user=request.user,
+                                                    is_active=True)
             old_key.is_active = False
             old_key.save()
-            new_key = APIKey.objects.create(company=old_key.company)
+            new_key, raw_key = APIKey.objects.create_key(company=old_key.company, user=request.user)
             return Response({
-                'new_api_key': str(new_key.key),
+                'new_api_key': raw_key,
             }, status=status.HTTP_201_CREATED)
         except APIKey.DoesNotExist:
             return Response({'error': 'API key not found or inactive'}, status=status.HTTP_404_NOT_FOUND)
@@ -173,7 +183,7 @@ class DeactivateKeyView(APIView):
     def post(self, request):
         key_value = request.data.get('key')
         try:
-            api_key = APIKey.objects.get(key=key_value, company__usercompanyrelation__user=request.user)
+            api_key = APIKey.objects.get_by_raw_key(key_value, company__usercompanyrelation__user=request.user)
             api_key.is_active = False
             api_key.save()
             return Response({'message': 'API key deactivated'}, status=status.HTTP_200_OK)
@@ -183,18 +193,175 @@ class DeactivateKeyView(APIView):
 
 
 
+class MerchantAPIView(APIView):
+    """
+    Базовое представление для мерчантских эндпоинтов.
+    Мерчант передает ключ (API-Login/API-Key) или подписанный токен в заголовках,
+    либо auth_login/auth_secret в теле запроса. Basic и сессия здесь не принимаются.
+    """
+    authentication_classes = [APIKeyAuthentication, MerchantTokenAuthentication, ClaimsJWTAuthentication]
+    throttle_classes = [MerchantBurstThrottle]
+    quota_remaining = None
+    quota_limit = None
+    rate_limit = None
+    company_slot = None
+
+    def get_merchant_context(self, request):
+        if isinstance(request.auth, MerchantContext):
+            return request.auth
+        # Троттлинг и сам обработчик читают контекст один раз за запрос
+        if not hasattr(self, '_merchant_context'):
+            self._merchant_context = load_merchant_context(
+                request.data.get('auth_login'), request.data.get('auth_secret')
+            )
+        return self._merchant_context
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        context = self.get_merchant_context(request)
+        if context is not None:
+            # Слот занимается до выполнения обработчика и освобождается в finalize_response
+            acquired, self.company_slot = acquire_company_slot(context)
+            if not acquired:
+                raise Throttled(wait=1, detail='Too many concurrent requests for this company.')
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        release_company_slot(self.company_slot)
+        self.company_slot = None
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.rate_limit is not None:
+            response['RateLimit-Limit'] = str(self.rate_limit['limit'])
+            response['RateLimit-Remaining'] = str(self.rate_limit['remaining'])
+            response['RateLimit-Reset'] = str(math.ceil(self.rate_limit['reset']))
+        if self.quota_remaining is not None:
+            # Значения из проверки квоты, без дополнительных запросов
+            response['X-Quota-Limit'] = str(self.quota_limit)
+            response['X-Quota-Remaining'] = str(self.quota_remaining)
+            response['X-Quota-Reset'] = str(seconds_until_next_month(get_current_month()))
+        return response
+
+    def consume_quota(self, context, units=1):
+        """
+        Списывает запросы из месячной квоты компании одним UPDATE.
+        Возвращает ответ об исчерпанном лимите или None.
+        """
+        allowed, self.quota_remaining = context.consume_requests(units)
+        self.quota_limit = context.requests_limit or 0
+        if allowed:
+            return None
+        return Response(
+            {
+                "status": "failed",
+                "message": "Request limit reached for this month"
+            },
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+class MerchantTokenView(MerchantAPIView):
 
-class PaymentHistoryView(APIView):
+    @swagger_auto_schema(
+        tags=["Key"],
+        operation_description="Exchange auth_login/auth_secret for a short-lived signed merchant token",
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                'auth_login': openapi.Schema(type=openapi.TYPE_STRING, description='User email'),
+                'auth_secret': openapi.Schema(type=openapi.TYPE_STRING, description='API key'),
+            }
+        ),
+        responses={
+            200: 'Merchant token issued',
+            403: 'Invalid auth_login or auth_secret'
+        }
+    )
     def post(self, request):
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
+        context = self.get_merchant_context(request)
+        if context is None:
+            return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
-        try:
-            is_valid, user, company = verify_key(auth_login, auth_secret)
-        except (User.DoesNotExist, APIKey.DoesNotExist):
+        return Response({
+            'token': issue_merchant_token(context),
+            'token_type': MerchantTokenAuthentication.keyword,
+            'expires_in': settings.MERCHANT_TOKEN_LIFETIME,
+        }, status=status.HTTP_200_OK)
+
+
+class QuotaStatusView(MerchantAPIView):
+    """
+    Остаток месячной квоты из кэша, который обновляется при каждом списании.
+    Сам запрос квоту не списывает; таблицы статистики читаются только при пустом кэше.
+    """
+
+    @swagger_auto_schema(tags=["Key"], operation_description="Remaining monthly request quota of the company")
+    def get(self, request):
+        context = self.get_merchant_context(request)
+        if context is None:
+            return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
+
+        requests_made = get_quota_usage(context.company.pk, context.month)
+        if requests_made is None:
+            requests_made = context.with_usage().company_requests_made or 0
+            set_quota_usage(context.company.pk, context.month, requests_made)
+
+        self.quota_limit = context.requests_limit or 0
+        self.quota_remaining = max(self.quota_limit - requests_made, 0)
+        return Response({
+            'month': context.month.isoformat(),
+            'limit': self.quota_limit,
+            'requests_made': requests_made,
+            'remaining': self.quota_remaining,
+            'reset': seconds_until_next_month(context.month),
+        }, status=status.HTTP_200_OK)
+
+    def post(self, request):
+        return self.get(request)
+
+
+class CallbackSettingsView(MerchantAPIView):
+    """
+    Настройки callback-ов компании: пакетная доставка и секрет подписи пакетов.
+    Квоту не списывает.
+    """
+
+    @swagger_auto_schema(
+        tags=["Key"],
+        operation_description="Enable or disable batched callbacks; the response carries the signing secret",
+        request_body=CallbackSettingsSerializer,
+    )
+    def post(self, request):
+        serializer = CallbackSettingsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        context = self.get_merchant_context(request)
+        if context is None:
+            return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
+
+        company = context.company
+        batching = serializer.validated_data.get('batching', company.callback_batching)
+        rotate_secret = serializer.validated_data['rotate_secret']
+        if batching != company.callback_batching or rotate_secret or (batching and not company.callback_secret):
+            company.set_callback_batching(batching, rotate_secret=rotate_secret)
+        return Response({
+            'batching': company.callback_batching,
+            'secret': company.callback_secret or None,
+            'window': settings.CALLBACK_OUTBOX['BATCH_WINDOW'],
+            'max_size': settings.CALLBACK_OUTBOX['BATCH_MAX_SIZE'],
+        }, status=status.HTTP_200_OK)
+
+
+class PaymentHistoryView(MerchantAPIView):
+    def post(self, request):
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
-        payments = Invoice.objects.filter(user=user)
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
+
+        payments = Invoice.objects.filter(user=context.user)
         serializer = InvoiceSerializer(payments, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -239,21 +406,22 @@ class SubscriptionHistoryListView(generics.ListAPIView):
 
 
 
-class WithdrawalRequestView(APIView):
+def withdrawal_charges(amount, subtract_from):
+    """
+    Комиссия и сумма к списанию для заявки на вывод.
+    """
+    commission_percentage = Decimal('0.015')  # Пример комиссии 1.5%, можете заменить на вашу логику расчета
+    commission = amount * commission_percentage
+    return commission, amount + commission if subtract_from == 'balance' else amount
+
+
+class WithdrawalRequestView(MerchantAPIView):
     permission_classes = [IsAuthenticated]
 
     @swagger_auto_schema(tags=["Conclusion"], request_body=WithdrawalRequestSerializer)
     def post(self, request):
-
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
-
-        is_valid, user, company = verify_key(auth_login, auth_secret)
-
-        company.increment_request_count()
-        user.increment_request_count()
-        if not is_valid:
-
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response(
                 {
                     "status": "failed",
@@ -262,52 +430,28 @@ class WithdrawalRequestView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        if not company.can_make_request():
-            return Response(
-                {
-                    "status": "failed",
-                    "message": "Request limit reached for this month"
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
 
         amount = Decimal(request.data.get('amount'))
         subtract_from = request.data.get('subtract_from')
-        commission_percentage = Decimal('0.015')  # Пример комиссии 1.5%, можете заменить на вашу логику расчета
-        commission = amount * commission_percentage
+        commission, deduction_amount = withdrawal_charges(amount, subtract_from)
 
         serializer = WithdrawalRequestSerializer(data=request.data)
         if serializer.is_valid():
-            withdrawal_request = serializer.save(
-                user=user,
-                company=company,
-                commission=commission,
-                deduction_amount=amount + commission if subtract_from == 'balance' else amount
-            )
-
-            # Отправка callback запроса
-            callback_url = withdrawal_request.callback_url
-            if callback_url:
-                callback_data = {
-                    "status": "created",
-                    "id": withdrawal_request.id,
-                    "method": withdrawal_request.method,
-                    "amount": float(withdrawal_request.amount),
-                    "deduction_amount": float(withdrawal_request.deduction_amount),
-                    "subtract_from": withdrawal_request.subtract_from,
-                    "currency": withdrawal_request.currency
-                }
-                try:
-                    response = requests.post(callback_url, json=callback_data)
-                    response.raise_for_status()
-                except requests.RequestException as e:
-                    return Response(
-                        {
-                            "status": "failed",
-                            "message": f"Callback request failed: {e}"
-                        },
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
+            with transaction.atomic():
+                withdrawal_request = serializer.save(
+                    user=context.user,
+                    company=context.company,
+                    auth_login=context.user.email,
+                    # Секрет ключа хранится только в виде хэша, в заявке его не сохраняем
+                    auth_secret='',
+                    commission=commission,
+                    deduction_amount=deduction_amount
+                )
+                # Callback отправит deliver_callbacks после коммита
+                CallbackOutbox.objects.enqueue(withdrawal_request, company=context.company)
 
             response_data = {
                 "status": "created",
@@ -322,41 +466,116 @@ class WithdrawalRequestView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ConfirmWithdrawalRequestView(APIView):
+class MassPayoutView(MerchantAPIView):
+    """
+    Массовая выплата: {"payouts": [...]} с полями как у /payoff/vyvod.
+    Все выплаты проверяются одним проходом сериализатора. Затем в одной транзакции
+    (строка пользователя заблокирована) проверяется, что баланс покрывает неоплаченные
+    заявки вместе с новыми, списывается квота на их число, заявки создаются одним
+    bulk_create, а callback-и ставятся в outbox. Либо создаются все выплаты, либо ни одной.
+    """
     permission_classes = [IsAuthenticated]
 
-    @swagger_auto_schema(tags=["Conclusion"], request_body=ConfirmWithdrawalRequestSerializer)
+    @swagger_auto_schema(tags=["Conclusion"], request_body=MassPayoutSerializer)
     def post(self, request):
-        serializer = ConfirmWithdrawalRequestSerializer(data=request.data)
-        if serializer.is_valid():
-            auth_login = serializer.validated_data.get('auth_login')
-            auth_secret = serializer.validated_data.get('auth_secret')
-            request_id = serializer.validated_data.get('id')
-            signature = serializer.validated_data.get('signature')
+        context = self.get_merchant_context(request)
+        if context is None:
+            return Response(
+                {
+                    "status": "failed",
+                    "message": "Invalid credentials"
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            is_valid, user, company = verify_key(auth_login, auth_secret)
-            if not is_valid:
+        serializer = MassPayoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        withdrawal_requests = []
+        for payout in serializer.validated_data['payouts']:
+            payout.pop('auth_login', None)
+            payout.pop('auth_secret', None)
+            commission, deduction_amount = withdrawal_charges(payout['amount'], payout['subtract_from'])
+            withdrawal_requests.append(WithdrawalRequest(
+                user=context.user,
+                company=context.company,
+                auth_login=context.user.email,
+                auth_secret='',
+                commission=commission,
+                deduction_amount=deduction_amount,
+                **payout
+            ))
+        total = sum(withdrawal_request.payment_total() for withdrawal_request in withdrawal_requests)
+
+        with transaction.atomic():
+            # Блокировка строки пользователя упорядочивает параллельные массовые выплаты
+            balance = User.objects.select_for_update().values_list('balance', flat=True).get(pk=context.user.pk)
+            available = balance - WithdrawalRequest.objects.outstanding_total(context.user)
+            if total > available:
                 return Response(
                     {
                         "status": "failed",
-                        "message": "Invalid credentials"
+                        "message": "Insufficient balance for the payouts",
+                        "required": float(total),
+                        "available": float(available)
                     },
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            try:
-                withdrawal_request = WithdrawalRequest.objects.get(id=request_id, company=company)
-            except WithdrawalRequest.DoesNotExist:
+            quota_exceeded = self.consume_quota(context, units=len(withdrawal_requests))
+            if quota_exceeded:
+                return quota_exceeded
+
+            created = WithdrawalRequest.objects.bulk_create(withdrawal_requests)
+            # Callback-и отправит deliver_callbacks после коммита
+            CallbackOutbox.objects.enqueue_many(created, company=context.company)
+
+        return Response(
+            {
+                "status": "created",
+                "count": len(created),
+                "payouts": [withdrawal_request.callback_payload() for withdrawal_request in created]
+            },
+            status=status.HTTP_201_CREATED
+        )
+
+
+class ConfirmWithdrawalRequestView(MerchantAPIView):
+    permission_classes = [IsAuthenticated]
+
+    @swagger_auto_schema(tags=["Conclusion"], request_body=ConfirmWithdrawalRequestSerializer)
+    def post(self, request):
+        serializer = ConfirmWithdrawalRequestSerializer(data=request.data)
+        if serializer.is_valid():
+            request_id = serializer.validated_data.get('id')
 
+            context = self.get_merchant_context(request)
+            if context is None:
                 return Response(
                     {
                         "status": "failed",
-                        "message": "Withdrawal request not found"
+                        "message": "Invalid credentials"
                     },
-                    status=status.HTTP_404_NOT_FOUND
+                    status=status.HTTP_400_BAD_REQUEST
                 )
 
-            if withdrawal_request.status != 'created':
+            quota_exceeded = self.consume_quota(context)
+            if quota_exceeded:
+                return quota_exceeded
+
+            withdrawal_request = WithdrawalRequest.objects.advance(
+                request_id, WithdrawalRequest.PROCESSING, company=context.company
+            )
+            if withdrawal_request is None:
+                if not WithdrawalRequest.objects.filter(id=request_id, company=context.company).exists():
+                    return Response(
+                        {
+                            "status": "failed",
+                            "message": "Withdrawal request not found"
+                        },
+                        status=status.HTTP_404_NOT_FOUND
+                    )
                 return Response(
                     {
                         "status": "failed",
@@ -365,9 +584,6 @@ class ConfirmWithdrawalRequestView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            withdrawal_request.status = 'processing'
-            withdrawal_request.save()
-
             return Response(
                 {
                     "status": "success",
@@ -378,20 +594,17 @@ class ConfirmWithdrawalRequestView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class CancelWithdrawalRequestView(APIView):
+class CancelWithdrawalRequestView(MerchantAPIView):
     permission_classes = [IsAuthenticated]
 
     @swagger_auto_schema(tags=["Conclusion"], request_body=CancelWithdrawalRequestSerializer)
     def post(self, request):
         serializer = CancelWithdrawalRequestSerializer(data=request.data)
         if serializer.is_valid():
-            auth_login = serializer.validated_data.get('auth_login')
-            auth_secret = serializer.validated_data.get('auth_secret')
             request_id = serializer.validated_data.get('id')
-            signature = serializer.validated_data.get('signature')
 
-            is_valid, user, company = verify_key(auth_login, auth_secret)
-            if not is_valid:
+            context = self.get_merchant_context(request)
+            if context is None:
                 return Response(
                     {
                         "status": "failed",
@@ -400,18 +613,22 @@ class CancelWithdrawalRequestView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            try:
-                withdrawal_request = WithdrawalRequest.objects.get(id=request_id, company=company)
-            except WithdrawalRequest.DoesNotExist:
-                return Response(
-                    {
-                        "status": "failed",
-                        "message": "Withdrawal request not found"
-                    },
-                    status=status.HTTP_404_NOT_FOUND
-                )
+            quota_exceeded = self.consume_quota(context)
+            if quota_exceeded:
+                return quota_exceeded
 
-            if withdrawal_request.status != 'created':
+            withdrawal_request = WithdrawalRequest.objects.advance(
+                request_id, WithdrawalRequest.CANCELLED, company=context.company
+            )
+            if withdrawal_request is None:
+                if not WithdrawalRequest.objects.filter(id=request_id, company=context.company).exists():
+                    return Response(
+                        {
+                            "status": "failed",
+                            "message": "Withdrawal request not found"
+                        },
+                        status=status.HTTP_404_NOT_FOUND
+                    )
                 return Response(
                     {
                         "status": "failed",
@@ -420,9 +637,6 @@ class CancelWithdrawalRequestView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            withdrawal_request.status = 'cancelled'
-            withdrawal_request.save()
-
             return Response(
                 {
                     "status": "success",
@@ -433,19 +647,17 @@ class CancelWithdrawalRequestView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class GetWithdrawalRequestView(APIView):
+class GetWithdrawalRequestView(MerchantAPIView):
     permission_classes = [IsAuthenticated]
 
     @swagger_auto_schema(tags=["Conclusion"], request_body=GetWithdrawalRequestSerializer)
     def post(self, request):
         serializer = GetWithdrawalRequestSerializer(data=request.data)
         if serializer.is_valid():
-            auth_login = serializer.validated_data.get('auth_login')
-            auth_secret = serializer.validated_data.get('auth_secret')
             request_id = serializer.validated_data.get('id')
 
-            is_valid, user, company = verify_key(auth_login, auth_secret)
-            if not is_valid:
+            context = self.get_merchant_context(request)
+            if context is None:
                 return Response(
                     {
                         "status": "failed",
@@ -454,8 +666,12 @@ class GetWithdrawalRequestView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            quota_exceeded = self.consume_quota(context)
+            if quota_exceeded:
+                return quota_exceeded
+
             try:
-                withdrawal_request = WithdrawalRequest.objects.get(id=request_id, company=company)
+                withdrawal_request = WithdrawalRequest.objects.get(id=request_id, company=context.company)
             except WithdrawalRequest.DoesNotExist:
                 return Response(
                     {
@@ -479,76 +695,163 @@ class GetWithdrawalRequestView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class WithdrawalBatchView(MerchantAPIView):
+    """
+    Основа пакетных эндпоинтов: до WITHDRAWAL_BATCH['MAX_IDS'] id за запрос,
+    одна аутентификация и одна выборка по компании. Квота списывается за каждый id.
+    Ответ - {"status": "success", "results": {id: результат}}.
+    """
+    permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        serializer = WithdrawalBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        ids = serializer.validated_data['ids']
+
+        context = self.get_merchant_context(request)
+        if context is None:
+            return Response(
+                {
+                    "status": "failed",
+                    "message": "Invalid credentials"
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        quota_exceeded = self.consume_quota(context, units=len(ids))
+        if quota_exceeded:
+            return quota_exceeded
 
+        results = self.process(ids, context.company)
+        return Response({"status": "success", "results": results}, status=status.HTTP_200_OK)
 
+    def process(self, ids, company):
+        raise NotImplementedError
 
-class CreateInvoiceView(APIView):
+    @staticmethod
+    def not_found():
+        return {"status": "failed", "message": "Withdrawal request not found"}
+
+
+class WithdrawalBatchTransitionView(WithdrawalBatchView):
+    target = None
+    action = None
+
+    def process(self, ids, company):
+        rows, advanced = WithdrawalRequest.objects.advance_many(ids, self.target, company)
+        results = {}
+        for pk in ids:
+            if pk not in rows:
+                results[pk] = self.not_found()
+            elif pk in advanced:
+                results[pk] = {"status": "success", "message": f"Withdrawal request {self.action}"}
+            else:
+                results[pk] = {
+                    "status": "failed",
+                    "message": f"Withdrawal request cannot be {self.action}",
+                    "withdrawal_status": rows[pk].status,
+                }
+        return results
+
+
+class ConfirmWithdrawalBatchView(WithdrawalBatchTransitionView):
+    target = WithdrawalRequest.PROCESSING
+    action = 'confirmed'
+
+    @swagger_auto_schema(tags=["Conclusion"], request_body=WithdrawalBatchSerializer)
     def post(self, request):
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
+        return super().post(request)
 
-        try:
-            is_valid, user, company = verify_key(auth_login, auth_secret)
-        except (User.DoesNotExist, APIKey.DoesNotExist):
+
+class CancelWithdrawalBatchView(WithdrawalBatchTransitionView):
+    target = WithdrawalRequest.CANCELLED
+    action = 'cancelled'
+
+    @swagger_auto_schema(tags=["Conclusion"], request_body=WithdrawalBatchSerializer)
+    def post(self, request):
+        return super().post(request)
+
+
+class GetWithdrawalBatchInfoView(WithdrawalBatchView):
+
+    @swagger_auto_schema(tags=["Conclusion"], request_body=WithdrawalBatchSerializer)
+    def post(self, request):
+        return super().post(request)
+
+    def process(self, ids, company):
+        rows = {row.pk: row for row in WithdrawalRequest.objects.filter(company=company, pk__in=ids)}
+        return {pk: rows[pk].callback_payload() if pk in rows else self.not_found() for pk in ids}
+
+
+class CreateInvoiceView(MerchantAPIView):
+    def post(self, request):
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
+
         data = request.data.copy()
-        data['user'] = user.id
-        data.pop('auth_login')
-        data.pop('auth_secret')
+        data['user'] = context.user.id
+        data.pop('auth_login', None)
+        data.pop('auth_secret', None)
 
         serializer = InvoiceSerializer(data=data)
         if serializer.is_valid():
-            invoice = serializer.save()
+            with transaction.atomic():
+                invoice = serializer.save()
+                CallbackOutbox.objects.enqueue(invoice, company=context.company)
             return Response({'id': invoice.id, 'status': invoice.status}, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class InvoiceDetailView(APIView):
+class InvoiceDetailView(MerchantAPIView):
     def post(self, request):
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
         invoice_id = request.data.get('id')
 
-        try:
-             is_valid, user, company = verify_key(auth_login, auth_secret)
-        except (User.DoesNotExist, APIKey.DoesNotExist):
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
-        invoice = get_object_or_404(Invoice, id=invoice_id, user=user)
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
+
+        invoice = get_object_or_404(Invoice, id=invoice_id, user=context.user)
         serializer = InvoiceSerializer(invoice)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class WithdrawalHistoryView(APIView):
+class WithdrawalHistoryView(MerchantAPIView):
     def post(self, request):
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
-
-        try:
-            user = User.objects.get(email=auth_login)
-            api_secret = APIKey.objects.get(user=user, secret=auth_secret, is_active=True)
-        except (User.DoesNotExist, APIKey.DoesNotExist):
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
-        withdrawals = Withdrawal.objects.filter(user=user)
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
+
+        withdrawals = Withdrawal.objects.filter(user=context.user)
         serializer = WithdrawalSerializer(withdrawals, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class GeneralStatisticsView(APIView):
+class GeneralStatisticsView(MerchantAPIView):
     def post(self, request):
-        auth_login = request.data.get('auth_login')
-        auth_secret = request.data.get('auth_secret')
-
-        try:
-             is_valid, user, company = verify_key(auth_login, auth_secret)
-        except (User.DoesNotExist, APIKey.DoesNotExist):
+        context = self.get_merchant_context(request)
+        if context is None:
             return Response({'error': 'Invalid auth_login or auth_secret'}, status=status.HTTP_403_FORBIDDEN)
 
-        total_invoices = Invoice.objects.filter(user=user).aggregate(total=Sum('amount'))['total'] or 0
-        total_withdrawals = Withdrawal.objects.filter(user=user).aggregate(total=Sum('amount'))['total'] or 0
+        quota_exceeded = self.consume_quota(context)
+        if quota_exceeded:
+            return quota_exceeded
+
+        total_invoices = Invoice.objects.filter(user=context.user).aggregate(total=Sum('amount'))['total'] or 0
+        total_withdrawals = Withdrawal.objects.filter(user=context.user).aggregate(total=Sum('amount'))['total'] or 0
 
         data = {
             'total_invoices': total_invoices,
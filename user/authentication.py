@@ -0,0 +1,159 @@
+import hashlib
+import hmac
+import os
+import threading
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from user.models import User
+
+
+class ActiveUserCache:
+    """
+    Per-process cache of User.is_active keyed by user id.
+    Entries are dropped by the user signals whenever a user is saved or deleted.
+    """
+
+    def __init__(self, ttl, max_size):
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def is_active(self, user_id):
+        with self._lock:
+            is_active = self._cache.get(user_id)
+        if is_active is None:
+            # Удаленный пользователь считается неактивным
+            is_active = bool(User.objects.filter(pk=user_id).values_list('is_active', flat=True).first())
+            with self._lock:
+                self._cache[user_id] = is_active
+        return is_active
+
+    def set(self, user_id, is_active):
+        with self._lock:
+            self._cache[user_id] = is_active
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+active_user_cache = ActiveUserCache(
+    ttl=settings.JWT_ACTIVE_USER_CACHE['TTL'],
+    max_size=settings.JWT_ACTIVE_USER_CACHE['MAX_SIZE'],
+)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that builds request.user from the token claims.
+
+    The user is a regular User instance with only the id loaded; the claims
+    may be out of date, so every other field is deferred and the full row is
+    loaded on the first access to any of them.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        if not active_user_cache.is_active(user_id):
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+
+        return User.from_claims(validated_token)
+
+
+BASIC_CREDENTIALS_GENERATION_CACHE_KEY = 'user:basic-credentials-generation:{}'
+
+
+def get_basic_credentials_generation(user_id):
+    return cache.get(BASIC_CREDENTIALS_GENERATION_CACHE_KEY.format(user_id), 0)
+
+
+class BasicCredentialCache:
+    """
+    Per-process cache of successful Basic credential checks.
+
+    Entries are keyed by an HMAC of email and password under a random
+    per-process salt, so plain passwords never stay in memory. Each entry
+    remembers the user's credentials generation from the shared Django cache;
+    invalidate() bumps it and thereby drops the entry in every worker.
+    """
+
+    def __init__(self, ttl, max_size):
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._salt = os.urandom(32)
+        self._lock = threading.Lock()
+
+    def _digest(self, userid, password):
+        message = '{}\0{}'.format(userid, password).encode()
+        return hmac.new(self._salt, message, hashlib.sha256).digest()
+
+    def get(self, userid, password):
+        digest = self._digest(userid, password)
+        with self._lock:
+            entry = self._cache.get(digest)
+        if entry is None:
+            return None
+        user_id, generation = entry
+        if generation != get_basic_credentials_generation(user_id):
+            with self._lock:
+                self._cache.pop(digest, None)
+            return None
+        return user_id
+
+    def set(self, userid, password, user_id, generation):
+        with self._lock:
+            self._cache[self._digest(userid, password)] = (user_id, generation)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            stale = [digest for digest, (cached_id, _) in self._cache.items() if cached_id == user_id]
+            for digest in stale:
+                self._cache.pop(digest, None)
+        key = BASIC_CREDENTIALS_GENERATION_CACHE_KEY.format(user_id)
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+basic_credential_cache = BasicCredentialCache(
+    ttl=settings.BASIC_AUTH_CACHE['TTL'],
+    max_size=settings.BASIC_AUTH_CACHE['MAX_SIZE'],
+)
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+    """
+    HTTP Basic authentication that runs the password hasher only once per TTL
+    for the same credentials. Cached users are built like JWT users: only the
+    id is loaded, the rest of the row on first access.
+    """
+
+    def authenticate_credentials(self, userid, password, request=None):
+        user_id = basic_credential_cache.get(userid, password)
+        if user_id is not None and active_user_cache.is_active(user_id):
+            return User.from_claims({api_settings.USER_ID_CLAIM: user_id}), None
+
+        user, auth = super().authenticate_credentials(userid, password, request)
+        basic_credential_cache.set(userid, password, user.pk, get_basic_credentials_generation(user.pk))
+        active_user_cache.set(user.pk, user.is_active)
+        return user, auth
@@ -0,0 +1,191 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from user.models import MonthlyCompanyStatistics, MonthlyUserStatistics
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedCounter:
+    """
+    In-memory increments for one monthly statistics model.
+
+    Increments are kept per (owner_id, month) and written by flush() with a
+    single multi-row upsert. The totals returned by the upsert become the
+    last flushed values that quota checks start from; keys without local
+    increments are included with zero so their totals follow other workers.
+    Totals of past months are dropped.
+    """
+
+    def __init__(self, model, owner_field):
+        self.model = model
+        self.owner_field = owner_field
+        self._pending = defaultdict(int)
+        self._in_flight = {}
+        self._flushed = {}
+        self._lock = threading.Lock()
+
+    def total(self, owner_id, month, flushed=None):
+        """
+        Последнее записанное значение плюс локальные незаписанные приращения.
+        flushed - значение из БД, если оно уже известно вызывающему.
+        """
+        key = (owner_id, month)
+        with self._lock:
+            known = self._flushed.get(key)
+        if known is None:
+            if flushed is None:
+                flushed = self.model.objects.filter(
+                    **{self.owner_field: owner_id}, month=month
+                ).values_list('requests_made', flat=True).first() or 0
+            with self._lock:
+                known = self._flushed.setdefault(key, flushed)
+        with self._lock:
+            return known + self._pending.get(key, 0) + self._in_flight.get(key, 0)
+
+    def add(self, owner_id, month, units=1):
+        with self._lock:
+            self._pending[(owner_id, month)] += units
+
+    def pending(self):
+        with self._lock:
+            return sum(self._pending.values())
+
+    def flush(self):
+        current_month = timezone.now().date().replace(day=1)
+        with self._lock:
+            # Счетчики прошлых месяцев для проверки квот больше не нужны
+            for key in [key for key in self._flushed if key[1] < current_month]:
+                del self._flushed[key]
+            deltas, self._pending = dict(self._pending), defaultdict(int)
+            self._in_flight = deltas
+            # Известные счетчики без приращений обновляются тем же upsert (+0):
+            # так видны запросы, записанные другими воркерами
+            deltas = {**dict.fromkeys(self._flushed, 0), **deltas}
+            if not deltas:
+                return
+        try:
+            totals = self.model.objects.bulk_consume(self.owner_field, deltas)
+        except Exception:
+            # Не потерять приращения: вернуть их в буфер до следующей попытки
+            with self._lock:
+                for key, units in deltas.items():
+                    if units:
+                        self._pending[key] += units
+                self._in_flight = {}
+            raise
+        with self._lock:
+            self._flushed.update(totals)
+            self._in_flight = {}
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._in_flight = {}
+            self._flushed.clear()
+
+
+class RequestCounters:
+    """
+    Write-behind request counters for companies and users.
+
+    consume() checks the company limit against the last flushed value plus
+    pending deltas of this process and only touches memory. Buffers are
+    written every flush_interval seconds by a daemon thread, as soon as
+    flush_events requests have accumulated, and at interpreter exit.
+    Other workers' pending deltas are not visible, so a company may exceed
+    its limit by up to `overshoot` requests per worker.
+    """
+
+    def __init__(self, flush_interval, flush_events, overshoot=0):
+        self.companies = BufferedCounter(MonthlyCompanyStatistics, 'company_id')
+        self.users = BufferedCounter(MonthlyUserStatistics, 'user_id')
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.overshoot = overshoot
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def consume(self, company_id, user_id, month, units, limit, company_requests_made=None):
+        """
+        Возвращает (allowed, remaining), как consume_monthly_requests.
+        company_requests_made - значение счетчика из БД, если оно уже загружено.
+        """
+        self.start()
+        # Первое обращение к компании может прочитать счетчик из БД - вне блокировки
+        self.companies.total(company_id, month, company_requests_made)
+        with self._lock:
+            used = self.companies.total(company_id, month)
+            if used + units > limit + self.overshoot:
+                return False, max(limit - used, 0)
+            self.companies.add(company_id, month, units)
+            self.users.add(user_id, month, units)
+            self._events += 1
+            flush_now = self._events >= self.flush_events
+        if flush_now:
+            self.flush()
+        return True, max(limit - used - units, 0)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._events = 0
+            self.companies.flush()
+            self.users.flush()
+
+    def start(self):
+        if self._thread is not None or not self.flush_interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-counters-flush', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush request counters')
+            finally:
+                close_old_connections()
+
+    def clear(self):
+        with self._lock:
+            self._events = 0
+        self.companies.clear()
+        self.users.clear()
+
+
+request_counters = RequestCounters(
+    flush_interval=settings.REQUEST_COUNTERS['FLUSH_INTERVAL_MS'] / 1000,
+    flush_events=settings.REQUEST_COUNTERS['FLUSH_EVENTS'],
+    overshoot=settings.REQUEST_COUNTERS['OVERSHOOT'],
+)
+
+
+def is_buffered():
+    return settings.REQUEST_COUNTERS['MODE'] == 'buffered'
+
+
+@atexit.register
+def _flush_on_exit():
+    # Незаписанные счетчики сохраняются при штатной остановке воркера
+    if request_counters.companies.pending() or request_counters.users.pending():
+        try:
+            request_counters.stop()
+        except Exception:
+            logger.exception('Failed to flush request counters on exit')
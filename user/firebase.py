@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+
+import firebase_admin
+import requests
+from cachecontrol import CacheControl
+from cachetools import TLRUCache
+from django.conf import settings
+from firebase_admin import credentials
+from google.auth import exceptions as google_exceptions
+from google.auth import jwt
+
+from AralashAPI.resilience import DependencyUnavailable, breaker_for, timeout_for
+
+logger = logging.getLogger(__name__)
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    """
+    Приложение Firebase создается при первом обращении, а не при импорте настроек.
+    """
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                cred = credentials.Certificate(settings.FIREBASE['CREDENTIALS'])
+                _app = firebase_admin.initialize_app(cred)
+    return _app
+
+
+class InvalidIdToken(ValueError):
+    pass
+
+
+class GoogleCertificates:
+    """
+    Public keys Google signs Firebase ID tokens with.
+
+    The first call fetches them synchronously; afterwards a daemon timer
+    refetches them shortly before the Cache-Control max-age runs out, so
+    verification never waits for the network while the timer keeps up.
+    Fetches go through the "firebase" circuit breaker; while Google is
+    unreachable the last keys keep being used past their max-age.
+    """
+    MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+    def __init__(self, url, session=None, min_refresh=60, timeout=10):
+        self.url = url
+        self.session = session or CacheControl(requests.Session())
+        self.min_refresh = min_refresh
+        self.timeout = timeout
+        self._certs = None
+        self._expires_at = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._certs is None or time.time() >= self._expires_at:
+            with self._lock:
+                if self._certs is None or time.time() >= self._expires_at:
+                    try:
+                        self._fetch()
+                    except requests.RequestException as e:
+                        if self._certs is None:
+                            raise DependencyUnavailable('firebase') from e
+                        self._use_expired(e)
+                    except DependencyUnavailable as e:
+                        if self._certs is None:
+                            raise
+                        self._use_expired(e)
+        return self._certs
+
+    def _use_expired(self, error):
+        # Google держит старые ключи еще какое-то время после ротации
+        logger.warning('Using expired Google signing certificates: %s', error)
+
+    def _fetch(self):
+        timeout = timeout_for('firebase', self.timeout)
+        with breaker_for('firebase').guard(failures=(requests.RequestException,)):
+            response = self.session.get(self.url, timeout=timeout)
+            response.raise_for_status()
+        match = self.MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        max_age = int(match.group(1)) if match else self.min_refresh
+        self._certs = response.json()
+        self._expires_at = time.time() + max_age
+        self._schedule(max(max_age * 0.9, self.min_refresh))
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self):
+        try:
+            with self._lock:
+                self._fetch()
+        except Exception:
+            # Старые ключи остаются до истечения max-age, следующий get() повторит запрос
+            logger.exception('Failed to refresh Google signing certificates')
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class FirebaseTokenVerifier:
+    """
+    Verifies Firebase ID tokens locally, the same checks firebase_admin.auth
+    performs, and caches the decoded claims until the token's exp.
+    """
+    ISSUER = 'https://securetoken.google.com/{}'
+
+    def __init__(self, project_id, certificates, max_size=10000):
+        self.project_id = project_id
+        self.certificates = certificates
+        self._cache = TLRUCache(maxsize=max_size, ttu=lambda _, claims, now: claims['exp'], timer=time.time)
+        self._lock = threading.Lock()
+
+    def verify(self, token):
+        cache_key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            claims = self._cache.get(cache_key)
+        if claims is not None:
+            return dict(claims)
+
+        try:
+            claims = jwt.decode(token, certs=self.certificates.get(), audience=self.project_id)
+        except (ValueError, google_exceptions.GoogleAuthError) as e:
+            raise InvalidIdToken(str(e))
+        if claims.get('iss') != self.ISSUER.format(self.project_id):
+            raise InvalidIdToken('Token has an incorrect "iss" claim')
+        sub = claims.get('sub')
+        if not isinstance(sub, str) or not sub or len(sub) > 128:
+            raise InvalidIdToken('Token has an invalid "sub" claim')
+        claims['uid'] = sub
+
+        with self._lock:
+            self._cache[cache_key] = claims
+        return dict(claims)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                config = settings.FIREBASE
+                _verifier = FirebaseTokenVerifier(
+                    project_id=config['PROJECT_ID'] or get_app().project_id,
+                    certificates=GoogleCertificates(
+                        config['CERTS_URL'],
+                        min_refresh=config['CERTS_MIN_REFRESH'],
+                        timeout=settings.RESILIENCE['DEPENDENCIES']['firebase']['TIMEOUT'],
+                    ),
+                    max_size=config['TOKEN_CACHE_SIZE'],
+                )
+    return _verifier
+
+
+def verify_id_token(token):
+    return get_verifier().verify(token)
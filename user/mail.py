@@ -0,0 +1,16 @@
+from smtplib import SMTPRecipientsRefused, SMTPSenderRefused
+
+from django.core import mail
+
+from AralashAPI.resilience import breaker_for, timeout_for
+
+
+def send_mail(subject, message, from_email, recipient_list, **kwargs):
+    """
+    django.core.mail.send_mail с таймаутом SMTP из бюджета запроса и circuit
+    breaker-ом: пока релей недоступен, вызов сразу завершается DependencyUnavailable.
+    Отказ принять конкретный адрес отказом релея не считается.
+    """
+    connection = mail.get_connection(timeout=timeout_for('smtp'))
+    with breaker_for('smtp').guard(failures=(OSError,), ignore=(SMTPRecipientsRefused, SMTPSenderRefused)):
+        return mail.send_mail(subject, message, from_email, recipient_list, connection=connection, **kwargs)
@@ -0,0 +1,91 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from user.models import Company, MonthlyCompanyStatistics, MonthlyUserStatistics, User
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class Command(BaseCommand):
+    help = (
+        'Pre-create monthly statistics rows for every company and user ahead of the month start, '
+        'so quota checks only update existing rows, and merge duplicate rows of the previous month'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Month to prepare, YYYY-MM (default: next month)')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--all-months', action='store_true',
+                            help='Merge duplicate company rows in every month, not only the previous one')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        current_month = date(now.year, now.month, 1)
+        if options['month']:
+            try:
+                year, month = map(int, options['month'].split('-'))
+                target_month = date(year, month, 1)
+            except ValueError:
+                raise CommandError('--month must be in YYYY-MM format')
+        else:
+            target_month = add_months(current_month, 1)
+        chunk_size = options['chunk_size']
+
+        # Дубликаты нужно слить до миграции с unique_together (company, month)
+        merged = self.merge_duplicates(None if options['all_months'] else add_months(target_month, -2))
+        self.stdout.write(f'Merged {merged} duplicate company statistics rows.')
+
+        companies = self.precreate(Company, MonthlyCompanyStatistics, 'company_id', target_month, chunk_size)
+        users = self.precreate(User, MonthlyUserStatistics, 'user_id', target_month, chunk_size)
+        self.stdout.write(self.style.SUCCESS(
+            f'Statistics rows for {target_month:%Y-%m}: {companies} companies, {users} users.'
+        ))
+
+    def precreate(self, owner_model, statistics_model, owner_field, month, chunk_size):
+        """
+        Создает строки месяца пачками; существующие пропускаются (ON CONFLICT DO NOTHING).
+        """
+        total = 0
+        last_pk = 0
+        while True:
+            owner_ids = list(
+                owner_model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:chunk_size]
+            )
+            if not owner_ids:
+                break
+            statistics_model.objects.bulk_create(
+                [statistics_model(**{owner_field: owner_id}, month=month) for owner_id in owner_ids],
+                ignore_conflicts=True,
+            )
+            total += len(owner_ids)
+            last_pk = owner_ids[-1]
+        return total
+
+    def merge_duplicates(self, month=None):
+        """
+        Сводит повторные строки (company, month) в одну с суммой requests_made.
+        """
+        duplicates = MonthlyCompanyStatistics.objects.values('company_id', 'month').annotate(
+            rows=Count('id'), keep_id=Min('id'), total=Sum('requests_made')
+        ).filter(rows__gt=1)
+        if month is not None:
+            duplicates = duplicates.filter(month=month)
+
+        merged = 0
+        for duplicate in duplicates:
+            with transaction.atomic():
+                MonthlyCompanyStatistics.objects.filter(pk=duplicate['keep_id']).update(
+                    requests_made=duplicate['total']
+                )
+                deleted, _ = MonthlyCompanyStatistics.objects.filter(
+                    company_id=duplicate['company_id'], month=duplicate['month']
+                ).exclude(pk=duplicate['keep_id']).delete()
+            merged += deleted
+        return merged
@@ -1,11 +1,13 @@
+import secrets
 from datetime import datetime
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
 from django.utils import timezone
 from django.utils.timezone import now
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
 
 from AralashAPI import settings  # Update to your app name
 from .enum import Role
@@ -59,6 +61,37 @@ class User(AbstractUser):
     REQUIRED_FIELDS = ['phone', 'username']
     objects = UserManager()
 
+    # Поля, которые MyTokenObtainPairSerializer кладет в JWT
+    @classmethod
+    def from_claims(cls, claims):
+        """
+        Пользователь из JWT без запроса к БД. Загруженным считается только id:
+        email, username и прочие поля в токене могут быть устаревшими, поэтому
+        они отложены и читаются из БД одним запросом при первом обращении.
+        save() такого экземпляра не запишет в строку значения из токена.
+        """
+        user = cls.from_db(DEFAULT_DB_ALIAS, ['id'], [claims[api_settings.USER_ID_CLAIM]])
+        user._from_claims = True
+        return user
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Значения из БД; по ним сигналы api узнают, менялись ли email и is_active
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        if fields is not None and getattr(self, '_from_claims', False):
+            fields = set(fields) | self.get_deferred_fields()
+        super().refresh_from_db(using=using, fields=fields)
+        # Догруженные (в том числе отложенные) поля тоже считаются значениями из БД
+        loaded = fields if fields is not None else [field.attname for field in self._meta.concrete_fields]
+        self._loaded_values = {
+            **getattr(self, '_loaded_values', {}),
+            **{name: self.__dict__[name] for name in loaded if name in self.__dict__},
+        }
+
     def get_current_month(self):
         return datetime(now().year, now().month, 1)
 
@@ -71,10 +104,8 @@ class User(AbstractUser):
         current_month = self.get_current_month()
         MonthlyUserStatistics.objects.filter(user=self, month=current_month).update(requests_made=0)
 
-    def increment_request_count(self):
-        stats = self.get_or_create_monthly_statistics()
-        stats.requests_made += 1
-        stats.save()
+    def increment_request_count(self, units=1):
+        return MonthlyUserStatistics.objects.consume(units, user_id=self.pk, month=self.get_current_month())
 
     def can_make_request(self):
         stats = self.get_or_create_monthly_statistics()
@@ -103,11 +134,85 @@ class Subscription(models.Model):
         return self.name
 
 
+class MonthlyStatisticsQuerySet(models.QuerySet):
+
+    def consume(self, units=1, limit=None, **lookup):
+        """
+        Прибавляет units к requests_made строки месяца, создавая ее при необходимости,
+        если результат не превышает limit (None - без лимита).
+        lookup - владелец и месяц, например company_id=1, month=date(2024, 5, 1).
+        Возвращает новое значение requests_made или None, если лимит не позволяет.
+        """
+        if limit is not None and units > limit:
+            return None
+        connection = connections[self.db]
+        if connection.features.can_return_columns_from_insert:
+            rows = self._upsert(connection, list(lookup), [(*lookup.values(), units)], limit)
+            return rows[0][-1] if rows else None
+        return self._consume_atomic(units, limit, lookup)
+
+    def bulk_consume(self, owner_field, deltas):
+        """
+        Прибавляет накопленные приращения одним многострочным upsert без лимита.
+        deltas - {(owner_id, month): units}. Возвращает {(owner_id, month): requests_made}.
+        """
+        if not deltas:
+            return {}
+        connection = connections[self.db]
+        if not connection.features.can_return_columns_from_insert:
+            return {
+                (owner_id, month): self._consume_atomic(units, None, {owner_field: owner_id, 'month': month})
+                for (owner_id, month), units in deltas.items()
+            }
+        month_field = self.model._meta.get_field('month')
+        rows = self._upsert(
+            connection, [owner_field, 'month'], [(*key, units) for key, units in deltas.items()]
+        )
+        return {(owner_id, month_field.to_python(month)): requests_made for owner_id, month, requests_made in rows}
+
+    def _upsert(self, connection, key_fields, rows, limit=None):
+        # PostgreSQL и SQLite >= 3.35: INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        counter = qn(opts.get_field('requests_made').column)
+        fields = [opts.get_field(name) for name in key_fields]
+        key = ', '.join(qn(field.column) for field in fields)
+        placeholders = '({})'.format(', '.join(['%s'] * (len(fields) + 1)))
+        params = []
+        for row in rows:
+            params.extend(field.get_db_prep_value(value, connection) for field, value in zip(fields, row))
+            params.append(row[-1])
+        sql = (
+            f'INSERT INTO {table} ({key}, {counter}) VALUES {", ".join([placeholders] * len(rows))} '
+            f'ON CONFLICT ({key}) DO UPDATE SET {counter} = {table}.{counter} + EXCLUDED.{counter}'
+        )
+        if limit is not None:
+            sql += f' WHERE {table}.{counter} + EXCLUDED.{counter} <= %s'
+            params.append(limit)
+        sql += f' RETURNING {key}, {counter}'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def _consume_atomic(self, units, limit, lookup):
+        with transaction.atomic(using=self.db):
+            self.get_or_create(**lookup)
+            rows = self.filter(**lookup)
+            if limit is not None:
+                rows = rows.filter(requests_made__lte=limit - units)
+            if not rows.update(requests_made=models.F('requests_made') + units):
+                return None
+            return self.filter(**lookup).values_list('requests_made', flat=True).get()
+
+
 class MonthlyUserStatistics(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     month = models.DateField()
     requests_made = models.IntegerField(default=0)
 
+    objects = MonthlyStatisticsQuerySet.as_manager()
+
     class Meta:
         unique_together = ('user', 'month')
 
@@ -136,6 +241,21 @@ class Company(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     subscription = models.ForeignKey(Subscription, on_delete=models.SET_NULL, null=True, blank=True)
     requests_made_this_month = models.IntegerField(default=0)
+    # Пакетные callback-и: события по одному callback_url уходят массивом, подписанным callback_secret
+    callback_batching = models.BooleanField(default=False)
+    callback_secret = models.CharField(max_length=64, blank=True, default='')
+    # Поколение учетных данных мерчанта (api.utils.bump_key_generation): растет при смене
+    # ключей, связей и тарифа, отзывая закэшированные проверки и подписанные токены
+    key_generation = models.PositiveIntegerField(default=0, editable=False)
+
+    def save(self, *args, **kwargs):
+        # Полное сохранение не должно откатывать поколение, увеличенное после загрузки экземпляра
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'key_generation'
+            ]
+        super().save(*args, **kwargs)
 
     def get_current_month(self):
         now = timezone.now()
@@ -150,10 +270,27 @@ class Company(models.Model):
         current_month = self.get_current_month()
         MonthlyCompanyStatistics.objects.filter(company=self, month=current_month).update(requests_made=0)
 
-    def increment_request_count(self):
-        stats = self.get_or_create_monthly_statistics()
-        stats.requests_made += 1
-        stats.save()
+    def increment_request_count(self, units=1):
+        return MonthlyCompanyStatistics.objects.consume(units, company_id=self.pk, month=self.get_current_month())
+
+    def consume_requests(self, units=1):
+        """
+        Атомарно списывает units запросов из месячного лимита подписки.
+        Возвращает (allowed, remaining).
+        """
+        if not self.subscription:
+            return False, 0
+        return consume_monthly_requests(self.pk, self.get_current_month(), units, self.subscription.max_requests_per_month)
+
+    def set_callback_batching(self, enabled, rotate_secret=False):
+        """
+        Включает или выключает пакетную доставку callback-ов. Секрет подписи
+        создается при первом включении или по rotate_secret.
+        """
+        self.callback_batching = enabled
+        if rotate_secret or (enabled and not self.callback_secret):
+            self.callback_secret = secrets.token_hex(32)
+        self.save(update_fields=['callback_batching', 'callback_secret'])
 
     def can_make_request(self):
         stats = self.get_or_create_monthly_statistics()
@@ -184,6 +321,11 @@ class MonthlyCompanyStatistics(models.Model):
     month = models.DateField()
     requests_made = models.IntegerField(default=0)
 
+    objects = MonthlyStatisticsQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('company', 'month')
+
     def requests_remaining(self):
         return self.company.subscription.max_requests_per_month - self.requests_made
 
@@ -191,6 +333,19 @@ class MonthlyCompanyStatistics(models.Model):
         return f"{self.company.name} - {self.month.strftime('%B %Y')}"
 
 
+def consume_monthly_requests(company_id, month, units, limit):
+    """
+    Один запрос к БД при успехе; при отказе дочитывает текущее значение для остатка.
+    """
+    requests_made = MonthlyCompanyStatistics.objects.consume(units, limit, company_id=company_id, month=month)
+    if requests_made is None:
+        requests_made = MonthlyCompanyStatistics.objects.filter(
+            company_id=company_id, month=month
+        ).values_list('requests_made', flat=True).first() or 0
+        return False, max(limit - requests_made, 0)
+    return True, limit - requests_made
+
+
 class SubscriptionHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     company = models.ForeignKey('Company', on_delete=models.CASCADE)
@@ -201,3 +356,14 @@ class SubscriptionHistory(models.Model):
     def __str__(self):
         return f"{self.user.email} - {self.company.name} - {self.subscription.name} - {self.amount}"
 
+
+class RevokedToken(models.Model):
+    """
+    JTI refresh-токенов, отозванных при ротации. Строки удаляются после истечения exp.
+    """
+    jti = models.CharField(max_length=255, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return self.jti
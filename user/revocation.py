@@ -0,0 +1,149 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from user.models import RevokedToken
+
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings using double hashing of one blake2b digest.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        if item in self:
+            return
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationStore:
+    """
+    Revoked refresh-token JTIs: a Bloom filter in memory backed by RevokedToken.
+
+    A miss in the filter answers "not revoked" without touching the database;
+    only filter hits are confirmed by a primary lookup. The filter picks up rows
+    written by other processes every SYNC_INTERVAL seconds and is rebuilt after
+    expired rows are pruned.
+    """
+
+    def __init__(self, capacity, error_rate, sync_interval, prune_interval):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._filter = None
+        self._watermark = None
+        self._synced_at = 0.0
+        self._pruned_at = 0.0
+
+    def _rebuild(self):
+        rows = list(RevokedToken.objects.filter(expires_at__gt=timezone.now()).values_list('jti', 'created_at'))
+        bloom = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+        for jti, _ in rows:
+            bloom.add(jti)
+        self._filter = bloom
+        self._watermark = max((created_at for _, created_at in rows), default=timezone.now())
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._filter is not None and now - self._synced_at < self.sync_interval:
+            return
+        with self._lock:
+            if self._filter is not None and now - self._synced_at < self.sync_interval:
+                return
+            if self._filter is None or now - self._pruned_at >= self.prune_interval:
+                RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+                self._rebuild()
+                self._pruned_at = now
+            else:
+                # Строки других процессов с прошлой синхронизации; запас покрывает расхождение часов
+                for jti, created_at in RevokedToken.objects.filter(
+                    created_at__gte=self._watermark - SYNC_OVERLAP
+                ).values_list('jti', 'created_at'):
+                    self._filter.add(jti)
+                    self._watermark = max(self._watermark, created_at)
+                if self._filter.count > self._filter.capacity:
+                    self._rebuild()
+            self._synced_at = now
+
+    def is_revoked(self, jti):
+        self._sync()
+        if jti not in self._filter:
+            return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    def revoke(self, jti, exp):
+        """
+        Записывает JTI. Возвращает False, если токен уже был отозван:
+        уникальный индекс не дает использовать один refresh-токен дважды даже между процессами.
+        """
+        expires_at = datetime.fromtimestamp(exp, tz=dt_timezone.utc)
+        try:
+            with transaction.atomic():
+                RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        self._sync()
+        with self._lock:
+            self._filter.add(jti)
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._synced_at = 0.0
+            self._pruned_at = 0.0
+
+
+revocation_store = RevocationStore(
+    capacity=settings.REFRESH_TOKEN_REVOCATION['CAPACITY'],
+    error_rate=settings.REFRESH_TOKEN_REVOCATION['ERROR_RATE'],
+    sync_interval=settings.REFRESH_TOKEN_REVOCATION['SYNC_INTERVAL'],
+    prune_interval=settings.REFRESH_TOKEN_REVOCATION['PRUNE_INTERVAL'],
+)
+
+
+class RevocableRefreshToken(RefreshToken):
+    """
+    RefreshToken с отзывом через RevocationStore вместо приложения token_blacklist.
+    TokenRefreshSerializer вызывает blacklist() при ротации (BLACKLIST_AFTER_ROTATION).
+    """
+
+    def verify(self, *args, **kwargs):
+        super().verify(*args, **kwargs)
+        if revocation_store.is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+    def blacklist(self):
+        if not revocation_store.revoke(self.payload[api_settings.JTI_CLAIM], self.payload['exp']):
+            raise TokenError('Token is blacklisted')
@@ -4,10 +4,11 @@ from django.contrib.auth.password_validation import validate_password
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from user.enum import Role
+from user.revocation import RevocableRefreshToken
 from user.models import User, MonthlyUserStatistics, BusinessType, Company, UserCompanyRelation, Subscription, \
     MonthlyCompanyStatistics, SubscriptionHistory
 
@@ -25,6 +26,11 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
         return token
 
 
+class RotatingTokenRefreshSerializer(TokenRefreshSerializer):
+    # Ротированный refresh-токен отзывается и не может быть использован повторно
+    token_class = RevocableRefreshToken
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(
         write_only=True, required=True,
@@ -0,0 +1,10 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from user.authentication import active_user_cache
+from user.models import User
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_active_user(sender, instance, **kwargs):
+    active_user_cache.invalidate(instance.pk)
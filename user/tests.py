@@ -1,8 +1,41 @@
+import base64
+import time
+from datetime import date, datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+from django.core import mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import override_settings
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from rest_framework.authentication import BasicAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APITestCase, APIRequestFactory
 from rest_framework import status
 from django.contrib.auth import get_user_model
 
+from AralashAPI.metrics import metrics
+from AralashAPI.resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, breaker_for, \
+    request_deadline, reset_breakers, timeout_for
+from user.authentication import CachedBasicAuthentication, ClaimsJWTAuthentication, active_user_cache, \
+    basic_credential_cache
+from user.counters import RequestCounters
+from user.firebase import FirebaseTokenVerifier, GoogleCertificates, InvalidIdToken
+from user.models import BusinessType, Company, MonthlyCompanyStatistics, MonthlyStatisticsQuerySet, \
+    MonthlyUserStatistics, RevokedToken, Subscription, UserCompanyRelation
+from user.throttling import SlidingWindowLimiter
+from user.revocation import BloomFilter, revocation_store
+
 User = get_user_model()
 
 class BalanceTopUpTests(APITestCase):
@@ -24,3 +57,481 @@ class BalanceTopUpTests(APITestCase):
         data = {'amount': 'invalid_amount'}
         response = self.client.post(self.url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ClaimsJWTAuthenticationTests(APITestCase):
+    def setUp(self):
+        active_user_cache.clear()
+        self.user = User.objects.create_user(username='awesth', email='a@a.com', password='1234', balance=15)
+        response = self.client.post(reverse('token_obtain_pair'), {'email': 'a@a.com', 'password': '1234'})
+        self.access = response.data['access']
+
+    def authenticate(self):
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        return ClaimsJWTAuthentication().authenticate(request)
+
+    def test_user_is_built_from_claims(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user, token = self.authenticate()
+            self.assertEqual(user.pk, self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'a@a.com')
+            self.assertEqual(user.username, 'awesth')
+            self.assertEqual(user.balance, 15)
+            self.assertEqual(user.phone, self.user.phone)
+
+    def test_stale_claims_are_not_written_back(self):
+        User.objects.filter(pk=self.user.pk).update(email='new@a.com', username='renamed')
+        user, token = self.authenticate()
+        user.balance += 5
+        user.save()
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.email, self.user.username, self.user.balance), ('new@a.com', 'renamed', 20))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        self.assertEqual(self.client.get(reverse('user-detail')).data['email'], 'new@a.com')
+
+    def test_deactivated_user_is_rejected(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_user_detail_view(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+        response = self.client.get(reverse('user-detail'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['email'], 'a@a.com')
+        self.assertEqual(float(response.data['balance']), 15)
+
+
+class CachedBasicAuthenticationTests(APITestCase):
+    def setUp(self):
+        active_user_cache.clear()
+        basic_credential_cache.clear()
+        self.user = User.objects.create_user(username='awesth', email='a@a.com', password='1234')
+
+    def authenticate(self, email='a@a.com', password='1234'):
+        credentials = base64.b64encode(f'{email}:{password}'.encode()).decode()
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Basic {credentials}')
+        return CachedBasicAuthentication().authenticate(request)
+
+    def test_verified_credentials_are_cached(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate()
+            self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(user.email, 'a@a.com')
+
+    def test_wrong_password_is_not_cached(self):
+        self.authenticate()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(password='wrong')
+
+    def test_change_password_invalidates_cache(self):
+        self.authenticate()
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse('change-password'), {'old_password': '1234', 'new_password': '5678'})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+        user, _ = self.authenticate(password='5678')
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_merchant_views_do_not_accept_basic(self):
+        from api.views import MerchantAPIView
+        self.assertFalse(any(issubclass(cls, BasicAuthentication) for cls in MerchantAPIView.authentication_classes))
+
+
+class RefreshTokenRotationTests(APITestCase):
+    def setUp(self):
+        revocation_store.reset()
+        User.objects.create_user(username='awesth', email='a@a.com', password='1234')
+        response = self.client.post(reverse('token_obtain_pair'), {'email': 'a@a.com', 'password': '1234'})
+        self.refresh = response.data['refresh']
+
+    def test_rotated_token_cannot_be_reused(self):
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['refresh'], self.refresh)
+
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        revocation_store.reset()
+        response = self.client.post(reverse('token_refresh'), {'refresh': self.refresh})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_unrevoked_lookup_stays_in_memory(self):
+        revocation_store.is_revoked('warm-up')
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation_store.is_revoked('unknown-jti'))
+
+    def test_expired_entries_are_pruned(self):
+        RevokedToken.objects.create(jti='expired', expires_at=timezone.now() - timedelta(minutes=1))
+        revocation_store.is_revoked('warm-up')
+        self.assertFalse(RevokedToken.objects.filter(jti='expired').exists())
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        items = [f'jti-{i}' for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+        false_positives = sum(f'other-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class FakeCertificateSession:
+    def __init__(self, certs, max_age=3600):
+        self.certs = certs
+        self.max_age = max_age
+        self.calls = 0
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        return mock.Mock(
+            headers={'Cache-Control': f'public, max-age={self.max_age}'},
+            json=lambda: self.certs,
+            raise_for_status=lambda: None,
+        )
+
+
+class FirebaseTokenVerifierTests(APITestCase):
+    PROJECT_ID = 'aralash-test'
+
+    def setUp(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'test')])
+        now = datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+            key.public_key()
+        ).serial_number(1).not_valid_before(now).not_valid_after(now + timedelta(days=1)).sign(key, hashes.SHA256())
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+        self.signer = crypt.RSASigner.from_string(private_pem, key_id='kid-1')
+        self.session = FakeCertificateSession({'kid-1': cert.public_bytes(serialization.Encoding.PEM).decode()})
+        self.certificates = GoogleCertificates('https://certs.test', session=self.session)
+        self.verifier = FirebaseTokenVerifier(self.PROJECT_ID, self.certificates)
+
+    def tearDown(self):
+        self.certificates.stop()
+
+    def make_token(self, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://securetoken.google.com/{self.PROJECT_ID}',
+            'aud': self.PROJECT_ID,
+            'sub': 'firebase-uid',
+            'iat': now,
+            'exp': now + 3600,
+            'name': 'awesth',
+            'email': 'a@a.com',
+        }
+        payload.update(claims)
+        return jwt.encode(self.signer, payload).decode()
+
+    def test_token_is_verified_once(self):
+        token = self.make_token()
+        claims = self.verifier.verify(token)
+        self.assertEqual(claims['uid'], 'firebase-uid')
+        self.assertEqual(claims['email'], 'a@a.com')
+        with mock.patch('user.firebase.jwt.decode') as decode:
+            self.assertEqual(self.verifier.verify(token), claims)
+            decode.assert_not_called()
+        self.assertEqual(self.session.calls, 1)
+
+    def test_certificates_are_fetched_once(self):
+        self.verifier.verify(self.make_token(sub='first'))
+        self.verifier.verify(self.make_token(sub='second'))
+        self.assertEqual(self.session.calls, 1)
+
+    def test_wrong_audience_is_rejected(self):
+        with self.assertRaises(InvalidIdToken):
+            self.verifier.verify(self.make_token(aud='other-project'))
+
+    def test_wrong_issuer_is_rejected(self):
+        with self.assertRaises(InvalidIdToken):
+            self.verifier.verify(self.make_token(iss='https://securetoken.google.com/other-project'))
+
+    def test_expired_token_is_rejected(self):
+        now = int(time.time())
+        with self.assertRaises(InvalidIdToken):
+            self.verifier.verify(self.make_token(iat=now - 7200, exp=now - 3600))
+
+    def test_google_login(self):
+        with mock.patch('user.firebase._verifier', self.verifier):
+            response = self.client.post(reverse('google_login'), {'token': self.make_token()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('access', response.data)
+        self.assertTrue(User.objects.filter(email='a@a.com').exists())
+
+
+class ConsumeRequestsTests(APITestCase):
+    def setUp(self):
+        business_type = BusinessType.objects.create(name='IT', code='IT')
+        subscription = Subscription.objects.create(name='BASIC', max_requests_per_month=3)
+        self.company = Company.objects.create(name='Shop', business_type=business_type, registration_number='REG-1',
+                                              address='Bishkek', subscription=subscription)
+        self.month = self.company.get_current_month().date()
+
+    def consume(self, units=1, limit=3):
+        return MonthlyCompanyStatistics.objects.consume(units, limit, company_id=self.company.pk, month=self.month)
+
+    def test_upsert_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.consume(), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.consume(units=2), 3)
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.consume())
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 3)
+
+    def test_atomic_fallback(self):
+        with mock.patch.object(MonthlyStatisticsQuerySet, '_upsert') as returning, \
+                mock.patch.object(connection.features, 'can_return_columns_from_insert', False):
+            self.assertEqual(self.consume(units=2), 2)
+            self.assertIsNone(self.consume(units=2))
+            self.assertEqual(self.consume(), 3)
+            returning.assert_not_called()
+
+    def test_company_consume_requests_returns_remaining(self):
+        self.assertEqual(self.company.consume_requests(units=2), (True, 1))
+        self.assertEqual(self.company.consume_requests(units=2), (False, 1))
+        self.assertEqual(self.company.consume_requests(), (True, 0))
+
+    def test_unlimited_user_counter(self):
+        user = User.objects.create_user(username='awesth', email='a@a.com', password='1234')
+        user.increment_request_count()
+        user.increment_request_count(units=5)
+        self.assertEqual(MonthlyUserStatistics.objects.get(user=user).requests_made, 6)
+
+
+class BufferedRequestCountersTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='awesth', email='a@a.com', password='1234')
+        business_type = BusinessType.objects.create(name='IT', code='IT')
+        self.company = Company.objects.create(name='Shop', business_type=business_type, registration_number='REG-1',
+                                              address='Bishkek')
+        UserCompanyRelation.objects.create(user=self.user, company=self.company, is_verified=True)
+        self.month = self.company.get_current_month().date()
+        self.counters = RequestCounters(flush_interval=None, flush_events=100)
+
+    def consume(self, units=1, limit=3):
+        return self.counters.consume(self.company.pk, self.user.pk, self.month, units, limit, company_requests_made=0)
+
+    def test_quota_is_checked_in_memory(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.consume(units=2), (True, 1))
+            self.assertEqual(self.consume(), (True, 0))
+            self.assertEqual(self.consume(), (False, 0))
+        self.assertFalse(MonthlyCompanyStatistics.objects.exists())
+
+    def test_flush_writes_totals(self):
+        MonthlyCompanyStatistics.objects.create(company=self.company, month=self.month, requests_made=1)
+        self.counters.consume(self.company.pk, self.user.pk, self.month, 2, 10, company_requests_made=1)
+        with self.assertNumQueries(2):
+            self.counters.flush()
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 3)
+        self.assertEqual(MonthlyUserStatistics.objects.get(user=self.user).requests_made, 2)
+        self.assertEqual(self.counters.companies.total(self.company.pk, self.month), 3)
+
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('company-statistics-list'))
+        self.assertEqual(response.data['results'][0]['requests_made'], 3)
+        response = self.client.get(reverse('user-statistics-list'))
+        self.assertEqual(response.data['results'][0]['requests_made'], 2)
+
+    def test_flush_after_n_events(self):
+        self.counters.flush_events = 2
+        self.consume(limit=10)
+        self.assertFalse(MonthlyCompanyStatistics.objects.exists())
+        self.consume(limit=10)
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 2)
+
+    def test_overshoot_tolerance(self):
+        self.counters.overshoot = 1
+        self.assertTrue(self.consume(units=3)[0])
+        self.assertTrue(self.consume()[0])
+        self.assertFalse(self.consume()[0])
+
+    def test_flush_refreshes_totals_of_other_workers(self):
+        other = RequestCounters(flush_interval=None, flush_events=100)
+        self.assertEqual(self.consume(limit=10), (True, 9))
+        self.counters.flush()
+        other.consume(self.company.pk, self.user.pk, self.month, 5, 10)
+        other.flush()
+        # Своих приращений нет, но итог перечитывается при сбросе
+        self.counters.flush()
+        self.assertEqual(self.counters.companies.total(self.company.pk, self.month), 6)
+        self.assertEqual(self.consume(units=5, limit=10), (False, 4))
+
+    def test_past_months_are_dropped(self):
+        past_month = date(2020, 1, 1)
+        self.counters.consume(self.company.pk, self.user.pk, past_month, 1, 10, company_requests_made=0)
+        self.counters.flush()
+        self.assertIn((self.company.pk, past_month), self.counters.companies._flushed)
+        self.counters.flush()
+        self.assertNotIn((self.company.pk, past_month), self.counters.companies._flushed)
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(month=past_month).requests_made, 1)
+
+    def test_failed_flush_keeps_pending(self):
+        self.consume(units=2)
+        with mock.patch.object(MonthlyStatisticsQuerySet, 'bulk_consume', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.counters.flush()
+        self.assertEqual(self.counters.companies.total(self.company.pk, self.month), 2)
+        self.counters.flush()
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.company).requests_made, 2)
+
+
+class RolloverMonthlyStatisticsTests(APITestCase):
+    def setUp(self):
+        business_type = BusinessType.objects.create(name='IT', code='IT')
+        self.companies = [
+            Company.objects.create(name=f'Shop {i}', business_type=business_type, registration_number=f'REG-{i}',
+                                   address='Bishkek')
+            for i in range(3)
+        ]
+        self.users = [
+            User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='1234')
+            for i in range(2)
+        ]
+
+    def test_rows_are_created_in_chunks(self):
+        call_command('rollover_monthly_statistics', month='2024-06', chunk_size=2, stdout=StringIO())
+        month = date(2024, 6, 1)
+        self.assertEqual(MonthlyCompanyStatistics.objects.filter(month=month, requests_made=0).count(), 3)
+        self.assertEqual(MonthlyUserStatistics.objects.filter(month=month, requests_made=0).count(), 2)
+
+    def test_existing_rows_are_kept(self):
+        month = date(2024, 6, 1)
+        MonthlyCompanyStatistics.objects.create(company=self.companies[0], month=month, requests_made=7)
+        call_command('rollover_monthly_statistics', month='2024-06', stdout=StringIO())
+        call_command('rollover_monthly_statistics', month='2024-06', stdout=StringIO())
+        self.assertEqual(MonthlyCompanyStatistics.objects.filter(month=month).count(), 3)
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=self.companies[0], month=month).requests_made, 7)
+
+    def test_consume_updates_precreated_row(self):
+        call_command('rollover_monthly_statistics', month='2024-06', stdout=StringIO())
+        month = date(2024, 6, 1)
+        company = self.companies[0]
+        MonthlyCompanyStatistics.objects.consume(2, 10, company_id=company.pk, month=month)
+        self.assertEqual(MonthlyCompanyStatistics.objects.get(company=company, month=month).requests_made, 2)
+
+    def test_invalid_month(self):
+        with self.assertRaises(CommandError):
+            call_command('rollover_monthly_statistics', month='june', stdout=StringIO())
+
+
+@override_settings(EMAIL_SEND_THROTTLE={'WINDOW': 3600, 'IP_LIMIT': 3, 'EMAIL_LIMIT': 2})
+class EmailSendThrottleTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_limit_per_email(self):
+        for expected in (status.HTTP_200_OK, status.HTTP_200_OK, status.HTTP_429_TOO_MANY_REQUESTS):
+            response = self.client.post(reverse('start_registration'), {'email': 'a@a.com'})
+            self.assertEqual(response.status_code, expected)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('Retry-After', response)
+        response = self.client.post(reverse('start_registration'), {'email': 'A@a.com '})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_limit_per_ip(self):
+        for i in range(3):
+            response = self.client.post(reverse('start_registration'), {'email': f'user{i}@a.com'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('start_registration'), {'email': 'other@a.com'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(
+            metrics.get('email_send_throttle_total', view='StartRegistrationView', key='ip', decision='rejected'), 1
+        )
+
+    def test_forwarded_for_does_not_reset_ip_limit(self):
+        for i in range(3):
+            response = self.client.post(reverse('start_registration'), {'email': f'user{i}@a.com'},
+                                        HTTP_X_FORWARDED_FOR=f'10.0.0.{i}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('start_registration'), {'email': 'other@a.com'},
+                                    HTTP_X_FORWARDED_FOR='10.0.0.99')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_window_slides(self):
+        limiter = SlidingWindowLimiter('test', limit=2, window=100)
+        self.assertTrue(limiter.hit('x', now=1000)[0])
+        self.assertTrue(limiter.hit('x', now=1010)[0])
+        allowed, retry_after = limiter.hit('x', now=1050)
+        self.assertFalse(allowed)
+        self.assertEqual(retry_after, 50)
+        # Следующее окно: прошлое учитывается с весом 0.5, затем 0.4
+        self.assertTrue(limiter.hit('x', now=1150)[0])
+        self.assertFalse(limiter.hit('x', now=1160)[0])
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        reset_breakers()
+        self.addCleanup(reset_breakers)
+        self.user = User.objects.create_user(username='reset', email='reset@a.com', password='password')
+
+    def test_opens_after_threshold_and_probes_once(self):
+        clock = Clock()
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30, clock=clock)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        clock.now = 20
+        with self.assertRaises(CircuitOpenError) as raised:
+            breaker.check()
+        self.assertEqual(raised.exception.wait, 10)
+
+        clock.now = 31
+        self.assertTrue(breaker.allow())
+        # Пока идет пробный вызов, остальные получают отказ
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual((breaker.state, breaker.trips), (CircuitBreaker.OPEN, 2))
+
+        clock.now = 62
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+
+    def test_timeout_is_capped_by_request_budget(self):
+        self.assertEqual(timeout_for('smtp'), 5)
+        with request_deadline(2):
+            self.assertLessEqual(timeout_for('smtp'), 2)
+        with request_deadline(0), self.assertRaises(DeadlineExceeded):
+            timeout_for('smtp')
+        self.assertGreaterEqual(metrics.get('deadline_exceeded_total', dependency='smtp'), 1)
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend')
+    def test_smtp_outage_fails_fast_with_503(self):
+        config = {'TIMEOUT': 5, 'FAILURE_THRESHOLD': 1, 'RESET_TIMEOUT': 30}
+        resilience = {**settings.RESILIENCE, 'DEPENDENCIES': {**settings.RESILIENCE['DEPENDENCIES'], 'smtp': config}}
+        with override_settings(RESILIENCE=resilience), \
+                mock.patch('django.core.mail.backends.smtp.EmailBackend.open', side_effect=OSError('refused')) as smtp:
+            response = self.client.post(reverse('send_reset_email'), {'email': 'reset@a.com'})
+            self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = self.client.post(reverse('send_reset_email'), {'email': 'reset@a.com'})
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(smtp.call_count, 1)
+        self.assertEqual(breaker_for('smtp').trips, 1)
+        self.assertIn('circuit_breaker_state{name="smtp"} 2', metrics.render())
+
@@ -0,0 +1,84 @@
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from AralashAPI.metrics import metrics
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding-window counter: one integer per fixed window in the Django cache.
+
+    The current count is estimated as the previous window's count weighted by
+    the part of it still inside the sliding window, plus the current window's
+    count. Only allowed hits are counted.
+    """
+
+    def __init__(self, scope, limit, window):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+
+    def _key(self, identity, index):
+        return f'throttle:{self.scope}:{identity}:{index}'
+
+    def hit(self, identity, now=None):
+        """
+        Возвращает (allowed, retry_after) - retry_after в секундах для отказа.
+        """
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        elapsed = now - index * self.window
+        current_key, previous_key = self._key(identity, index), self._key(identity, index - 1)
+        counts = cache.get_many([current_key, previous_key])
+        current, previous = counts.get(current_key, 0), counts.get(previous_key, 0)
+
+        weight = 1 - elapsed / self.window
+        if previous * weight + current + 1 > self.limit:
+            if current + 1 > self.limit or not previous:
+                retry_after = self.window - elapsed
+            else:
+                # Момент, когда вес прошлого окна упадет достаточно для еще одного запроса
+                retry_after = self.window * (1 - (self.limit - 1 - current) / previous) - elapsed
+            return False, max(retry_after, 1)
+
+        if not cache.add(current_key, 1, timeout=self.window * 2):
+            try:
+                cache.incr(current_key)
+            except ValueError:
+                cache.set(current_key, 1, timeout=self.window * 2)
+        return True, 0
+
+
+class EmailSendThrottle(BaseThrottle):
+    """
+    Limits endpoints that send mail, per client IP and per target address.
+    Runs before the view, so a rejected request does no lookup and no SMTP.
+    """
+    email_field = 'email'
+
+    def allow_request(self, request, view):
+        config = settings.EMAIL_SEND_THROTTLE
+        scope = type(view).__name__
+        checks = [('ip', self.get_ident(request), config['IP_LIMIT'])]
+        email = request.data.get(self.email_field)
+        if isinstance(email, str) and email.strip():
+            digest = hashlib.sha256(email.strip().lower().encode()).hexdigest()[:32]
+            checks.append(('email', digest, config['EMAIL_LIMIT']))
+
+        self.retry_after = None
+        for key, identity, limit in checks:
+            allowed, retry_after = SlidingWindowLimiter(f'email-send:{key}', limit, config['WINDOW']).hit(identity)
+            if not allowed:
+                metrics.inc('email_send_throttle_total', view=scope, key=key, decision='rejected')
+                self.retry_after = math.ceil(retry_after)
+                return False
+        metrics.inc('email_send_throttle_total', view=scope, key='all', decision='allowed')
+        return True
+
+    def wait(self):
+        return self.retry_after
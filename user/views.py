@@ -2,12 +2,10 @@ import uuid
 
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.core.mail import send_mail
 from django.shortcuts import redirect
 from django.urls import reverse
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from firebase_admin import auth
 from rest_framework import generics
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -16,13 +14,18 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
+from AralashAPI.resilience import DependencyUnavailable
+from user.authentication import basic_credential_cache
+from user.firebase import verify_id_token
+from user.mail import send_mail
+from user.throttling import EmailSendThrottle
 from AralashAPI.settings import FRONTEND_BASE_URL, EMAIL_HOST_USER
 from user.models import User, MonthlyUserStatistics, Company, UserCompanyRelation, BusinessType, \
     MonthlyCompanyStatistics
 from user.serializers import MyTokenObtainPairSerializer, RegisterSerializer, ChangePasswordSerializer, \
     EmailSerializer, ResetPasswordSerializer, MonthlyUserStatisticsSerializer, CompanySerializer, \
     UserCompanyRelationSerializer, BusinessTypeSerializer, MonthlyCompanyStatisticsSerializer, BalanceTopUpSerializer, \
-    UserSerializer
+    UserSerializer, RotatingTokenRefreshSerializer
 
 
 # Create your views here.
@@ -56,6 +59,8 @@ class RegisterView(generics.CreateAPIView):
 
 
 class UserTokenRefreshView(TokenRefreshView):
+    serializer_class = RotatingTokenRefreshSerializer
+
     @swagger_auto_schema(
         operation_description="Refresh JWT token",
         tags=["Authentication"],
@@ -73,6 +78,8 @@ class StartRegistrationView(APIView):
     Отправляет письмо с подтверждением на указанный email.
     """
 
+    throttle_classes = [EmailSendThrottle]
+
     @swagger_auto_schema(tags=["User"],request_body=EmailSerializer)
     def post(self, request):
         # Извлечение email из тела запроса
@@ -158,6 +165,7 @@ class ChangeEmailView(APIView):
 
     # Ограничение доступа только для аутентифицированных пользователей
     permission_classes = [IsAuthenticated]
+    throttle_classes = [EmailSendThrottle]
 
     @swagger_auto_schema(tags=["User"],request_body=EmailSerializer)
     def post(self, request):
@@ -221,10 +229,12 @@ class ChangePasswordView(APIView):
                                 status=status.HTTP_400_BAD_REQUEST)
             user.set_password(serializer.data.get("new_password"))
             user.save()
+            basic_credential_cache.invalidate(user.pk)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class SendResetEmailView(APIView):
+    throttle_classes = [EmailSendThrottle]
 
     @swagger_auto_schema(tags=["User"],request_body=EmailSerializer)
     def post(self, request):
@@ -248,6 +258,8 @@ class SendResetEmailView(APIView):
                 [email],
                 fail_silently=False,
             )
+        except DependencyUnavailable:
+            raise
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -279,6 +291,7 @@ class ResetPasswordConfirmView(APIView):
         try:
             user.set_password(new_password)
             user.save()
+            basic_credential_cache.invalidate(user.pk)
         except ValidationError as e:
             return Response({'error': e.messages}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -300,6 +313,8 @@ class ConfirmEmailChangeView(APIView):
             user.email = request.data.get('new_email')
             try:
                 user.save()
+                # Старый email с прежним паролем не должен проходить Basic из кэша
+                basic_credential_cache.invalidate(user.pk)
                 refresh = RefreshToken.for_user(user)
                 return Response({
                     'message': 'Email address has been successfully updated.',
@@ -343,13 +358,15 @@ class GoogleLogin(APIView):
             return Response({'error': 'No token provided'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            decoded_token = auth.verify_id_token(token)
+            decoded_token = verify_id_token(token)
             uid = decoded_token['uid']
             name = decoded_token['name']
             email = decoded_token.get('email')
             picture = decoded_token.get('picture')
             phone_number = decoded_token.get('phone_number')  # Получение номера телефона
 
+        except DependencyUnavailable:
+            raise
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 